@@ -0,0 +1,346 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import typing
+from urllib.parse import parse_qs
+
+import flask
+
+from . import stream, variants
+from .server import BAD_REQUEST_MSG, STREAM_HEADERS, parse_fps
+
+PRODUCER_TIMEOUT = 1.0
+# Threads running the requests handled by the flask app
+WSGI_THREADS = 32
+MISSING_DEPENDENCIES_MSG = (
+    "The asgi server requires uvicorn and asgiref."
+    + " Install them with `pip install picamip[asgi]`"
+)
+
+
+class Subscriber:
+    """
+    Holds the latest chunk published to one connection. A connection that
+    is still sending doesn't queue frames, the newest one replaces the
+    pending chunk.
+
+    Args:
+        client (picamip.stream.StreamClient): Pacing and counters
+    """
+
+    def __init__(self, client: stream.StreamClient):
+        self.client = client
+        self.sequence = 0
+        self.chunk: typing.Optional[bytes] = None
+        self.event = asyncio.Event()
+
+    def offer(self, sequence: int, chunk: bytes) -> None:
+        self.sequence = sequence
+        self.chunk = chunk
+        self.event.set()
+
+    async def next_chunk(self) -> bytes:
+        await asyncio.sleep(self.client.delay())
+        await self.event.wait()
+        self.event.clear()
+        self.client.account(self.sequence)
+        return self.chunk
+
+
+class FrameHub:
+    """
+    Fans out the frames of `stream_buffer` to many connections from a
+    single producer task. The producer runs while there are subscribers.
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+        stream_buffer (picamip.stream.JpegStreamIO): Ring to read the
+            frames from. Default: `camera.stream_buffer`
+    """
+
+    def __init__(
+        self,
+        camera: stream.StreamCamera,
+        stream_buffer: stream.JpegStreamIO = None,
+    ):
+        self.camera = camera
+        self.stream_buffer = stream_buffer or camera.stream_buffer
+        self.subscribers: typing.Set[Subscriber] = set()
+        self.producer: typing.Optional[asyncio.Task] = None
+
+    def subscribe(self, fps: float = None) -> Subscriber:
+        stream_buffer = self.stream_buffer
+        client = stream.StreamClient(fps, stream_buffer.sequence)
+        stream_buffer.clients.add(client)
+        subscriber = Subscriber(client)
+        self.subscribers.add(subscriber)
+        if self.producer is None or self.producer.done():
+            self.producer = asyncio.ensure_future(self.produce())
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.subscribers.discard(subscriber)
+        self.stream_buffer.clients.discard(subscriber.client)
+
+    async def produce(self) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.camera.start_stream)
+        stream_buffer = self.stream_buffer
+        sequence = stream_buffer.sequence
+        while self.subscribers:
+            sequence, chunk = await loop.run_in_executor(
+                None, stream_buffer.read_chunk, sequence, PRODUCER_TIMEOUT
+            )
+            if chunk is None:
+                await loop.run_in_executor(None, self.camera.start_stream)
+                continue
+            for subscriber in self.subscribers:
+                subscriber.offer(sequence, chunk)
+
+
+def wsgi_adapter(app: flask.Flask, executor: ThreadPoolExecutor):
+    """
+    Wraps the flask `app` as an ASGI application. asgiref runs every WSGI
+    request on a single shared thread, one at a time, so a long-poll would
+    block all the other routes. Here each request runs in a thread of
+    `executor`.
+
+    Args:
+        app (flask.Flask)
+        executor (concurrent.futures.ThreadPoolExecutor)
+    """
+    from asgiref.sync import SyncToAsync  # type: ignore
+    from asgiref.wsgi import WsgiToAsgiInstance  # type: ignore
+
+    class Instance(WsgiToAsgiInstance):
+        run_wsgi_app = SyncToAsync(
+            WsgiToAsgiInstance.__dict__["run_wsgi_app"].func,
+            thread_sensitive=False,
+            executor=executor,
+        )
+
+    async def adapter(scope, receive, send):
+        await Instance(app)(scope, receive, send)
+
+    return adapter
+
+
+class AsgiApp:
+    """
+    ASGI application for picamip. The default `/stream` route is served
+    natively by a `FrameHub`, every other request is handled by the flask
+    app in a pool of `wsgi_threads` threads, so routes and overloads behave
+    as in the flask server.
+
+    Args:
+        app (flask.Flask): App built with `picamip.build_app`
+        wsgi_threads (int): Requests handled by flask at the same time
+    """
+
+    def __init__(self, app: flask.Flask, wsgi_threads: int = WSGI_THREADS):
+        try:
+            self.executor = ThreadPoolExecutor(
+                max_workers=wsgi_threads, thread_name_prefix="picamip-wsgi"
+            )
+            self.wsgi = wsgi_adapter(app, self.executor)
+        except ImportError as error:
+            raise ImportError(MISSING_DEPENDENCIES_MSG) from error
+
+        self.app = app
+        self.camera = app.extensions["picamip"]["camera"]
+        self.variants = app.extensions["picamip"]["variants"]
+        self.hub = FrameHub(self.camera)
+        self.variant_hubs: typing.Dict[stream.JpegStreamIO, FrameHub] = {}
+        # With stream workers /stream is redirected to them by the app
+        self.native_stream = (
+            "/stream" in app.extensions["picamip"]["default_routes"]
+            and app.extensions["picamip"]["stream_port"] is None
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif (
+            scope["type"] == "http"
+            and self.native_stream
+            and scope["path"] == "/stream"
+            and scope["method"] == "GET"
+        ):
+            await self.stream(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _hub(self, variant: variants.VariantKey = None) -> FrameHub:
+        if variant is None:
+            return self.hub
+        stream_buffer = self.variants.get(*variant)
+        if stream_buffer not in self.variant_hubs:
+            # Drops the hubs of the variants that were replaced
+            for key in list(self.variant_hubs):
+                if key not in self.variants.variants.values():
+                    del self.variant_hubs[key]
+            self.variant_hubs[stream_buffer] = FrameHub(
+                self.camera, stream_buffer
+            )
+        return self.variant_hubs[stream_buffer]
+
+    async def error(self, send, status: int, message: str):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"text/plain")],
+            }
+        )
+        await send({"type": "http.response.body", "body": message.encode()})
+
+    async def stream(self, scope, receive, send):
+        query = {
+            name: values[-1]
+            for name, values in parse_qs(
+                scope["query_string"].decode()
+            ).items()
+        }
+        try:
+            fps = parse_fps(query.get("fps"))
+            hub = self._hub(
+                variants.parse_variant(
+                    query.get("width"), query.get("quality")
+                )
+            )
+        except ValueError:
+            await self.error(send, 400, BAD_REQUEST_MSG)
+            return
+        except ImportError as error:
+            await self.error(send, 501, str(error))
+            return
+        except LookupError as error:
+            await self.error(send, 503, str(error))
+            return
+        subscriber = hub.subscribe(fps)
+
+        async def send_frames():
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (k.lower().encode(), str(v).encode())
+                        for k, v in STREAM_HEADERS
+                    ],
+                }
+            )
+            while True:
+                chunk = await subscriber.next_chunk()
+                # Awaiting send applies the server's write backpressure
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    }
+                )
+
+        async def wait_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        tasks = [
+            asyncio.ensure_future(send_frames()),
+            asyncio.ensure_future(wait_disconnect()),
+        ]
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    if not isinstance(task.exception(), OSError):
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            hub.unsubscribe(subscriber)
+
+
+class AsgiMounts:
+    """
+    Dispatches the requests to the app mounted at their url prefix, or to
+    `app`. The prefix is moved from the path to the root path.
+
+    Args:
+        app (flask.Flask): App built with `picamip.build_app`
+        mounts (dict[str, flask.Flask]): {url prefix: app}
+    """
+
+    def __init__(
+        self, app: flask.Flask, mounts: typing.Dict[str, flask.Flask]
+    ):
+        self.app = AsgiApp(app)
+        self.mounts = {
+            prefix: AsgiApp(mounted) for prefix, mounted in mounts.items()
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            path = scope["path"]
+            for prefix, app in self.mounts.items():
+                if path == prefix or path.startswith(prefix + "/"):
+                    scope = dict(
+                        scope,
+                        path=path[len(prefix) :] or "/",
+                        root_path=scope.get("root_path", "") + prefix,
+                    )
+                    await app(scope, receive, send)
+                    return
+        await self.app(scope, receive, send)
+
+
+def serve(
+    app: flask.Flask,
+    host: str,
+    port: int,
+    fd: int = None,
+    mounts: typing.Dict[str, flask.Flask] = None,
+) -> None:
+    """
+    Serves `app` with uvicorn
+
+    Args:
+        app (flask.Flask): App built with `picamip.build_app`
+        host (str): RPi host
+        port (int): host port
+        fd (int): Listens on this bound socket instead (optional)
+        mounts (dict[str, flask.Flask]): Other apps, by url prefix
+            (optional)
+    """
+    try:
+        import uvicorn  # type: ignore
+    except ImportError as error:
+        raise ImportError(MISSING_DEPENDENCIES_MSG) from error
+    asgi_app = AsgiMounts(app, mounts) if mounts else AsgiApp(app)
+    uvicorn.run(asgi_app, host=host, port=port, fd=fd)
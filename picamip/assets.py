@@ -0,0 +1,284 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Precompresses the static files and writes their fingerprints. Usage:
+
+    python -m picamip.assets [STATIC_DIR ...]
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+from os import path
+import os
+from stat import S_ISREG
+from threading import Lock
+import typing
+
+from werkzeug.security import safe_join
+
+from . import optional
+
+ROOT = path.dirname(__file__)
+MANIFEST_FILENAME = "assets.json"
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+COMPRESSIBLE = {".css", ".js", ".map", ".svg", ".html", ".json", ".ico"}
+MIN_COMPRESS_BYTES = 1024
+FINGERPRINT_LENGTH = 12
+READ_BYTES = 64 * 1024
+
+
+def fingerprint(filename: str) -> str:
+    """
+    Args:
+        filename (str)
+    Returns:
+        fingerprint (str): Start of the SHA-256 of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(READ_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compresses `data` at the highest level. gzip is written without a
+    timestamp, so builds are reproducible.
+
+    Args:
+        data (bytes)
+        encoding (str): "br" (requires brotli) or "gzip"
+    Returns:
+        compressed (bytes)
+    """
+    if encoding == "br":
+        return optional.load("brotli").compress(data)  # type: ignore
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode="wb", mtime=0) as fp:
+        fp.write(data)
+    return output.getvalue()
+
+
+def build(directory: str) -> dict:
+    """
+    Writes .gz, and .br when brotli is installed, next to every
+    compressible file of `directory` that gets smaller, and the
+    fingerprints of all files to `directory`/assets.json
+
+    Args:
+        directory (str): Static files directory
+    Returns:
+        manifest (dict): {relative path: {fingerprint, size, mtime}}
+    """
+    encodings = [
+        encoding
+        for encoding in ENCODINGS
+        if encoding != "br" or optional.available("brotli")
+    ]
+    manifest = {}
+    for root, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            full_path = path.join(root, filename)
+            name = path.relpath(full_path, directory).replace(os.sep, "/")
+            if not _servable(name):
+                continue
+            stat = os.stat(full_path)
+            manifest[name] = {
+                "fingerprint": fingerprint(full_path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+            if (
+                path.splitext(name)[1] not in COMPRESSIBLE
+                or stat.st_size < MIN_COMPRESS_BYTES
+            ):
+                continue
+            with open(full_path, "rb") as fp:
+                data = fp.read()
+            for encoding in encodings:
+                compressed = compress(data, encoding)
+                target = full_path + ENCODINGS[encoding]
+                if len(compressed) < len(data):
+                    with open(target, "wb") as fp:
+                        fp.write(compressed)
+                elif path.exists(target):
+                    os.remove(target)
+    with open(path.join(directory, MANIFEST_FILENAME), "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    return manifest
+
+
+def _servable(name: str) -> bool:
+    return name != MANIFEST_FILENAME and not any(
+        name.endswith(suffix) for suffix in ENCODINGS.values()
+    )
+
+
+class Asset:
+    """
+    A static file, its fingerprint and its precompressed versions
+
+    Args:
+        filename (str): Full path
+        fingerprint (str)
+        encodings (dict[str, str]): {encoding: full path}
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        fingerprint: str,
+        encodings: typing.Dict[str, str],
+    ):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.encodings = encodings
+        self.mimetype = (
+            mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+
+    def negotiate(
+        self, accept_encodings: typing.Mapping[str, float]
+    ) -> typing.Tuple[typing.Optional[str], str]:
+        """
+        Picks the smallest version the client accepts
+
+        Args:
+            accept_encodings (werkzeug.datastructures.Accept): Parsed
+                Accept-Encoding header
+        Returns:
+            encoding (str): "br", "gzip" or None for the original file
+            filename (str): Full path of that version
+        """
+        for encoding in ENCODINGS:
+            if encoding in self.encodings and accept_encodings[encoding]:
+                return encoding, self.encodings[encoding]
+        return None, self.filename
+
+
+class AssetIndex:
+    """
+    Finds static files in a list of directories, the first one that has
+    a file wins, so custom static files replace the default ones.
+
+    Fingerprints are read from the assets.json written by `build`, or
+    computed on the first request of a file. A file that changed is
+    fingerprinted again and its precompressed versions are ignored until
+    the next build.
+
+    Args:
+        directories (list[str]): Static files directories
+    """
+
+    def __init__(self, directories: typing.List[str]):
+        self.directories = directories
+        self._manifests: typing.Dict[str, dict] = {}
+        for directory in directories:
+            try:
+                with open(path.join(directory, MANIFEST_FILENAME)) as fp:
+                    self._manifests[directory] = json.load(fp)
+            except (OSError, ValueError):
+                self._manifests[directory] = {}
+        self._assets: typing.Dict[str, typing.Tuple[tuple, Asset]] = {}
+        self._lock = Lock()
+
+    def get(self, name: str) -> typing.Optional[Asset]:
+        """
+        Args:
+            name (str): Path relative to the static directories
+        Returns:
+            asset (Asset): The asset or None if there is no such file
+        """
+        if not _servable(name):
+            return None
+        for directory in self.directories:
+            filename = safe_join(directory, name)
+            if filename is None:
+                return None
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if not S_ISREG(stat.st_mode):
+                return None
+            version = (filename, stat.st_size, stat.st_mtime)
+            with self._lock:
+                cached = self._assets.get(name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            asset = self._load(directory, name, filename, stat)
+            with self._lock:
+                self._assets[name] = (version, asset)
+            return asset
+        return None
+
+    def _load(
+        self, directory: str, name: str, filename: str, stat: os.stat_result
+    ) -> Asset:
+        entry = self._manifests[directory].get(name)
+        built = (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime
+        )
+        encodings = {}
+        if built:
+            for encoding, suffix in ENCODINGS.items():
+                if path.isfile(filename + suffix):
+                    encodings[encoding] = filename + suffix
+        return Asset(
+            filename,
+            entry["fingerprint"] if built else fingerprint(filename),
+            encodings,
+        )
+
+    def fingerprint(self, name: str) -> typing.Optional[str]:
+        """
+        Args:
+            name (str): Path relative to the static directories
+        Returns:
+            fingerprint (str): The fingerprint or None if there is no such
+                file
+        """
+        asset = self.get(name)
+        return asset.fingerprint if asset is not None else None
+
+
+def main(argv: typing.List[str] = None) -> dict:
+    parser = argparse.ArgumentParser(
+        prog="python -m picamip.assets",
+        description="Precompresses and fingerprints static files",
+    )
+    parser.add_argument(
+        "directories",
+        nargs="*",
+        default=[path.join(ROOT, "static")],
+        help="Static files directories. Default: picamip's static files",
+    )
+    args = parser.parse_args(argv)
+    manifests = {}
+    for directory in args.directories:
+        manifests[directory] = build(directory)
+        print(f"Built {len(manifests[directory])} assets in {directory}")
+    return manifests
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from fractions import Fraction
+import hashlib
+import os
+import struct
+import typing
+
+CHUNK_SIZE = 64 * 1024
+# Maximum size of the frames of a RIFF list. Players that don't read the
+# OpenDML indexes play only the first list.
+RIFF_BYTES = 1 << 30
+MAX_FPS_DENOMINATOR = 1001
+HEADER_READ_BYTES = 64 * 1024
+
+CHUNK = struct.Struct("<4sL")
+LIST = struct.Struct("<4sL4s")
+MAIN_HEADER = struct.Struct("<14L")
+STREAM_HEADER = struct.Struct("<4s4sLHH8L4h")
+BITMAP_INFO = struct.Struct("<LllHH4sLllLL")
+SUPER_INDEX = struct.Struct("<HBBL4s3L")
+SUPER_INDEX_ENTRY = struct.Struct("<QLL")
+STANDARD_INDEX = struct.Struct("<HBBL4sQL")
+STANDARD_INDEX_ENTRY = struct.Struct("<LL")
+LEGACY_INDEX_ENTRY = struct.Struct("<4sLLL")
+ODML_HEADER_SIZE = 248
+
+FRAME_ID = b"00dc"
+INDEX_ID = b"ix00"
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+AVI_INDEX_OF_INDEXES = 0x00
+AVI_INDEX_OF_CHUNKS = 0x01
+
+
+class _Frame:
+    def __init__(self, filename: str):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        # Absolute offset of the chunk header
+        self.offset = 0
+
+    @property
+    def chunk_size(self) -> int:
+        return CHUNK.size + self.size + (self.size & 1)
+
+
+class _Riff:
+    """
+    A RIFF list of the file: its frames followed by their index
+    """
+
+    def __init__(self, frames: typing.List[_Frame]):
+        self.frames = frames
+        self.offset = 0
+        self.movi_offset = 0
+        self.index_offset = 0
+
+    @property
+    def index_size(self) -> int:
+        return (
+            CHUNK.size
+            + STANDARD_INDEX.size
+            + STANDARD_INDEX_ENTRY.size * len(self.frames)
+        )
+
+    @property
+    def movi_size(self) -> int:
+        return (
+            LIST.size
+            + sum(frame.chunk_size for frame in self.frames)
+            + self.index_size
+        )
+
+
+class AviStream:
+    """
+    Streaming MJPEG AVI of JPEG files. The files are the frames, they are
+    copied to the video without decoding them.
+
+    Like `picamip.zipstream.ZipStream`, the layout is computed from the
+    file sizes before any file is read, so the length is known, byte
+    ranges can be served and memory is bounded. Videos larger than
+    RIFF_BYTES are split in RIFF lists with OpenDML (AVI 2.0) indexes.
+
+    A file that changes while it's streamed is cut or padded to its
+    previous size.
+
+    Args:
+        filenames (list[str]): JPEG files. Files that don't exist are
+            skipped.
+        fps (float): Frames per second
+        chunk_size (int): Size of the chunks read from the files
+        riff_bytes (int): Maximum size of the frames of a RIFF list
+    """
+
+    def __init__(
+        self,
+        filenames: typing.Iterable[str],
+        fps: float,
+        chunk_size: int = CHUNK_SIZE,
+        riff_bytes: int = RIFF_BYTES,
+    ):
+        self.frames = []
+        for filename in filenames:
+            try:
+                self.frames.append(_Frame(filename))
+            except FileNotFoundError:
+                continue
+        self.fps = fps
+        self.chunk_size = chunk_size
+        rate = Fraction(fps).limit_denominator(MAX_FPS_DENOMINATOR)
+        self.rate, self.scale = rate.numerator, rate.denominator
+        self.width, self.height = self._frame_size()
+        self.riffs: typing.List[_Riff] = []
+        current: typing.List[_Frame] = []
+        used = 0
+        for frame in self.frames:
+            if current and used + frame.chunk_size > riff_bytes:
+                self.riffs.append(_Riff(current))
+                current, used = [], 0
+            current.append(frame)
+            used += frame.chunk_size
+        self.riffs.append(_Riff(current))
+        self._layout()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        yield from self.generate()
+
+    @property
+    def etag(self) -> str:
+        """
+        Returns:
+            etag (str): Digest of the frame rate and the names, sizes and
+                mtimes of the frames
+        """
+        digest = hashlib.sha1(struct.pack("<LL", self.rate, self.scale))
+        for frame in self.frames:
+            digest.update(frame.filename.encode("utf-8"))
+            digest.update(struct.pack("<QQ", frame.size, frame.mtime_ns))
+        return digest.hexdigest()
+
+    def _frame_size(self) -> typing.Tuple[int, int]:
+        # picamip.thumbnail imports the storage, which imports this module
+        from .thumbnail import jpeg_size
+
+        for frame in self.frames:
+            try:
+                with open(frame.filename, "rb") as fp:
+                    size = jpeg_size(fp.read(HEADER_READ_BYTES))
+            except FileNotFoundError:
+                continue
+            if size is not None:
+                return size
+        return 0, 0
+
+    @property
+    def _header_size(self) -> int:
+        stream_list = (
+            LIST.size
+            + CHUNK.size
+            + STREAM_HEADER.size
+            + CHUNK.size
+            + BITMAP_INFO.size
+            + CHUNK.size
+            + SUPER_INDEX.size
+            + SUPER_INDEX_ENTRY.size * len(self.riffs)
+        )
+        odml_list = LIST.size + CHUNK.size + ODML_HEADER_SIZE
+        main_header = CHUNK.size + MAIN_HEADER.size
+        return LIST.size + main_header + stream_list + odml_list
+
+    @property
+    def _legacy_index_size(self) -> int:
+        return CHUNK.size + LEGACY_INDEX_ENTRY.size * len(self.riffs[0].frames)
+
+    def _layout(self) -> None:
+        offset = 0
+        for number, riff in enumerate(self.riffs):
+            riff.offset = offset
+            offset += LIST.size
+            if number == 0:
+                offset += self._header_size
+            riff.movi_offset = offset
+            offset += LIST.size
+            for frame in riff.frames:
+                frame.offset = offset
+                offset += frame.chunk_size
+            riff.index_offset = offset
+            offset += riff.index_size
+            if number == 0:
+                offset += self._legacy_index_size
+        self.length = offset
+
+    def _riff_header(self, number: int) -> bytes:
+        riff = self.riffs[number]
+        if number == 0:
+            size = (
+                4
+                + self._header_size
+                + riff.movi_size
+                + self._legacy_index_size
+            )
+            return LIST.pack(b"RIFF", size, b"AVI ")
+        return LIST.pack(b"RIFF", 4 + riff.movi_size, b"AVIX")
+
+    def _header(self) -> bytes:
+        """
+        The hdrl list: main header, stream header and format, OpenDML
+        super index and total frames
+        """
+        count = len(self.frames)
+        largest = max((frame.size for frame in self.frames), default=0)
+        buffer_size = largest + CHUNK.size
+        main_header = MAIN_HEADER.pack(
+            round(1e6 * self.scale / self.rate),
+            int(largest * self.rate / self.scale),
+            0,
+            AVIF_HASINDEX,
+            len(self.riffs[0].frames),
+            0,
+            1,
+            buffer_size,
+            self.width,
+            self.height,
+            0,
+            0,
+            0,
+            0,
+        )
+        stream_header = STREAM_HEADER.pack(
+            b"vids",
+            b"MJPG",
+            0,
+            0,
+            0,
+            0,
+            self.scale,
+            self.rate,
+            0,
+            count,
+            buffer_size,
+            0xFFFFFFFF,
+            0,
+            0,
+            0,
+            self.width,
+            self.height,
+        )
+        bitmap_info = BITMAP_INFO.pack(
+            BITMAP_INFO.size,
+            self.width,
+            self.height,
+            1,
+            24,
+            b"MJPG",
+            self.width * self.height * 3,
+            0,
+            0,
+            0,
+            0,
+        )
+        super_index = SUPER_INDEX.pack(
+            4, 0, AVI_INDEX_OF_INDEXES, len(self.riffs), FRAME_ID, 0, 0, 0
+        ) + b"".join(
+            SUPER_INDEX_ENTRY.pack(
+                riff.index_offset, riff.index_size, len(riff.frames)
+            )
+            for riff in self.riffs
+        )
+        stream_list = b"".join(
+            [
+                CHUNK.pack(b"strh", STREAM_HEADER.size),
+                stream_header,
+                CHUNK.pack(b"strf", BITMAP_INFO.size),
+                bitmap_info,
+                CHUNK.pack(b"indx", len(super_index)),
+                super_index,
+            ]
+        )
+        odml_header = struct.pack("<L", count).ljust(ODML_HEADER_SIZE, b"\0")
+        odml_list = CHUNK.pack(b"dmlh", ODML_HEADER_SIZE) + odml_header
+        header = b"".join(
+            [
+                CHUNK.pack(b"avih", MAIN_HEADER.size),
+                main_header,
+                LIST.pack(b"LIST", 4 + len(stream_list), b"strl"),
+                stream_list,
+                LIST.pack(b"LIST", 4 + len(odml_list), b"odml"),
+                odml_list,
+            ]
+        )
+        return LIST.pack(b"LIST", 4 + len(header), b"hdrl") + header
+
+    @staticmethod
+    def _movi_header(riff: _Riff) -> bytes:
+        return LIST.pack(b"LIST", riff.movi_size - 8, b"movi")
+
+    @staticmethod
+    def _index(riff: _Riff) -> bytes:
+        """
+        The OpenDML index of the frames of `riff`. Offsets are relative to
+        its movi list.
+        """
+        header = STANDARD_INDEX.pack(
+            2,
+            0,
+            AVI_INDEX_OF_CHUNKS,
+            len(riff.frames),
+            FRAME_ID,
+            riff.movi_offset,
+            0,
+        )
+        return (
+            CHUNK.pack(INDEX_ID, riff.index_size - CHUNK.size)
+            + header
+            + b"".join(
+                STANDARD_INDEX_ENTRY.pack(
+                    frame.offset + CHUNK.size - riff.movi_offset, frame.size
+                )
+                for frame in riff.frames
+            )
+        )
+
+    def _legacy_index(self) -> bytes:
+        """
+        The AVI 1.0 index of the first RIFF list. Offsets are relative to
+        the "movi" identifier.
+        """
+        riff = self.riffs[0]
+        movi = riff.movi_offset + 8
+        return CHUNK.pack(
+            b"idx1", self._legacy_index_size - CHUNK.size
+        ) + b"".join(
+            LEGACY_INDEX_ENTRY.pack(
+                FRAME_ID, AVIIF_KEYFRAME, frame.offset - movi, frame.size
+            )
+            for frame in riff.frames
+        )
+
+    def _read(self, frame: _Frame, start: int = 0, stop: int = None):
+        """
+        Yields the bytes [start, stop) of `frame`, padded with zeros if
+        the file got shorter or was deleted
+        """
+        stop = frame.size if stop is None else stop
+        position = start
+        try:
+            with open(frame.filename, "rb") as fp:
+                fp.seek(start)
+                while position < stop:
+                    chunk = fp.read(min(self.chunk_size, stop - position))
+                    if not chunk:
+                        break
+                    yield chunk
+                    position += len(chunk)
+        except FileNotFoundError:
+            pass
+        while position < stop:
+            padding = min(self.chunk_size, stop - position)
+            yield bytes(padding)
+            position += padding
+
+    def _segments(self):
+        """
+        Yields (size, producer) for every contiguous part of the video,
+        where producer(start, stop) yields the bytes in that slice.
+        """
+
+        def static(build):
+            def produce(start, stop):
+                yield build()[start:stop]
+
+            return produce
+
+        for number, riff in enumerate(self.riffs):
+            yield LIST.size, static(
+                lambda number=number: self._riff_header(number)
+            )
+            if number == 0:
+                yield self._header_size, static(self._header)
+            yield LIST.size, static(lambda riff=riff: self._movi_header(riff))
+            for frame in riff.frames:
+                yield CHUNK.size, static(
+                    lambda frame=frame: CHUNK.pack(FRAME_ID, frame.size)
+                )
+                yield frame.size, lambda start, stop, frame=frame: self._read(
+                    frame, start, stop
+                )
+                yield frame.size & 1, static(lambda: b"\0")
+            yield riff.index_size, static(lambda riff=riff: self._index(riff))
+            if number == 0:
+                yield self._legacy_index_size, static(self._legacy_index)
+
+    def generate(
+        self, start: int = 0, stop: int = None
+    ) -> typing.Generator[bytes, None, None]:
+        """
+        Yields the bytes of the video in the range [start, stop)
+
+        Args:
+            start (int): First byte
+            stop (int): Byte after the last one. Default: end of video
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        offset = 0
+        for size, produce in self._segments():
+            if offset >= stop:
+                break
+            if offset + size > start and size > 0:
+                yield from produce(
+                    max(start - offset, 0), min(stop - offset, size)
+                )
+            offset += size
+
+    def write(self, fp: typing.BinaryIO) -> None:
+        """
+        Writes the whole video to the file object `fp`
+        """
+        for chunk in self.generate():
+            fp.write(chunk)
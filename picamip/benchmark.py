@@ -0,0 +1,392 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmarks that run without camera hardware, using
+`picamip.synthetic.SyntheticCamera`. Usage:
+
+    python -m picamip.benchmark --output results.json
+"""
+
+import argparse
+import asyncio
+from os import path
+import json
+import os
+import platform
+import sys
+from tempfile import TemporaryDirectory
+from threading import Thread
+import time
+import typing
+
+from . import motion, optional, server, storage, stream, synthetic
+
+SUITES = ["stream", "capture", "storage", "motion", "asgi"]
+
+
+def summary(samples: typing.List[float]) -> dict:
+    """
+    Args:
+        samples (list[float]): Durations in seconds
+    Returns:
+        summary (dict): count, mean, p50, p95, p99 and max
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": ordered[-1],
+    }
+
+
+def timeit(fn: typing.Callable, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summary(samples)
+
+
+class TimedJpegStreamIO(stream.JpegStreamIO):
+    """
+    Records when each chunk was published, to measure delivery latency
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.published: typing.Dict[int, float] = {}
+
+    def publish(self, chunk: bytes) -> int:
+        self.published[id(chunk)] = time.perf_counter()
+        return super().publish(chunk)
+
+
+def bench_stream(
+    viewers: int,
+    duration: float,
+    resolution: typing.Tuple[int, int],
+    framerate: float,
+) -> dict:
+    """
+    Fans the stream of a synthetic camera out to `viewers` generators, each
+    in its own thread as in the flask server.
+    """
+    camera = synthetic.SyntheticCamera(resolution, framerate)
+    camera._stream_buffer = TimedJpegStreamIO()
+    stream_buffer = camera._stream_buffer
+    camera.start_stream()
+    latencies: typing.List[float] = []
+    deadline = time.perf_counter() + duration
+
+    def view():
+        generator = camera.stream_generator()
+        for chunk in generator:
+            received = time.perf_counter()
+            latencies.append(received - stream_buffer.published[id(chunk)])
+            if received > deadline:
+                break
+        generator.close()
+
+    threads = [Thread(target=view) for _ in range(viewers)]
+    sequence = stream_buffer.sequence
+    cpu = time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cpu = time.process_time() - cpu
+    frames = stream_buffer.sequence - sequence
+    camera.close()
+    return {
+        "viewers": viewers,
+        "resolution": list(resolution),
+        "framerate": framerate,
+        "duration": duration,
+        "frames_published": frames,
+        "frames_delivered": len(latencies),
+        "delivered_per_second": len(latencies) / duration,
+        "cpu_seconds_per_frame": cpu / max(frames, 1),
+        "latency": summary(latencies),
+    }
+
+
+def bench_capture(
+    requests: int, capture_mode: str, capture_latency: float
+) -> dict:
+    """
+    Takes `requests` pictures with POST /picture, sequentially and then
+    concurrently
+    """
+    camera = synthetic.SyntheticCamera(capture_latency=capture_latency)
+    camera.capture_mode = capture_mode
+    with TemporaryDirectory() as picture_dir:
+        app = server.build_app(
+            camera,
+            picture_dir,
+            "Bench_",
+            path.join(server.ROOT, "template"),
+            path.join(server.ROOT, "static"),
+            None,
+        )
+        client = app.test_client()
+        sequential = timeit(lambda: client.post("/picture"), requests)
+
+        samples: typing.List[float] = []
+
+        def post():
+            start = time.perf_counter()
+            app.test_client().post("/picture")
+            samples.append(time.perf_counter() - start)
+
+        threads = [Thread(target=post) for _ in range(requests)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stored = len(app.extensions["picamip"]["storage"])
+    camera.close()
+    return {
+        "requests": requests,
+        "capture_mode": capture_mode,
+        "capture_latency": capture_latency,
+        "sequential": sequential,
+        "concurrent": summary(samples),
+        "concurrent_per_second": requests / elapsed,
+        "stored": stored,
+    }
+
+
+def bench_storage(files: int, repeat: int) -> dict:
+    """
+    Measures `IndexedFilesStorage` operations on a directory with `files`
+    files
+    """
+    with TemporaryDirectory() as directory:
+        for index in range(1, files + 1):
+            open(path.join(directory, f"Bench_{index:05d}.jpg"), "wb").close()
+        pictures_storage = storage.IndexedFilesStorage(
+            directory, "Bench_", ".jpg", 5
+        )
+        results = {
+            "files": files,
+            "scan": timeit(pictures_storage.rescan, repeat),
+            "contains": timeit(lambda: files // 2 in pictures_storage, repeat),
+            "last_index": timeit(lambda: pictures_storage.last_index, repeat),
+            "page": timeit(
+                lambda: pictures_storage.page(10, reverse=True), repeat
+            ),
+            "iterate": timeit(lambda: list(pictures_storage), repeat),
+            "zip_stream": timeit(pictures_storage.zip_stream, repeat),
+        }
+
+        def write_and_delete():
+            index = pictures_storage.last_index + 1
+            open(pictures_storage.make_filename(index), "wb").close()
+            pictures_storage.register(index)
+            pictures_storage.delete_index(index)
+
+        results["write_and_delete"] = timeit(write_and_delete, repeat)
+    return results
+
+
+def bench_motion(
+    resolution: typing.Tuple[int, int], framerate: float, repeat: int
+) -> dict:
+    """
+    Measures the motion detection per frame, from the stream frames of a
+    synthetic camera at `resolution` (requires numpy, and Pillow to decode
+    the frames)
+    """
+    np = optional.load("numpy")
+    detector = motion.MotionDetector()
+    width, height = motion.MOTION_RESOLUTION
+    frames = [
+        np.full((height, width), value, np.uint8) for value in (100, 140)
+    ]
+    detector.detect(frames[0])
+    count = [0]
+
+    def detect():
+        detector.detect(frames[count[0] % 2])
+        count[0] += 1
+
+    results = {
+        "resolution": list(motion.MOTION_RESOLUTION),
+        "detect": timeit(detect, repeat),
+    }
+    if synthetic.Image is not None:
+        monitor = motion.MotionMonitor(
+            synthetic.SyntheticCamera(resolution, framerate), None
+        )
+        monitor.detector = detector
+        chunk = stream.JpegStreamIO.frame_header(0) + (
+            synthetic.make_jpeg(resolution) + b"\r\n"
+        )
+        results["stream_resolution"] = list(resolution)
+        results["decode"] = timeit(lambda: monitor._decode(chunk), repeat)
+    return results
+
+
+def bench_asgi(requests: int, wait: float) -> dict:
+    """
+    Sends `requests` long-polls of `wait` seconds (GET /frame.jpg for a
+    frame that never arrives) to the asgi app at once, without a server
+    (requires asgiref). They overlap when the flask routes run
+    concurrently, so `elapsed` stays close to `wait`.
+    """
+    from . import asgi
+
+    camera = synthetic.SyntheticCamera()
+    with TemporaryDirectory() as picture_dir:
+        app = server.build_app(
+            camera,
+            picture_dir,
+            "Bench_",
+            path.join(server.ROOT, "template"),
+            path.join(server.ROOT, "static"),
+            None,
+        )
+        asgi_app = asgi.AsgiApp(app)
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/frame.jpg",
+            "query_string": f"after={2 ** 62}&wait={wait}".encode(),
+            "http_version": "1.1",
+            "headers": [],
+        }
+
+        async def get():
+            messages = []
+
+            async def receive():
+                return {"type": "http.request"}
+
+            async def send(message):
+                messages.append(message)
+
+            await asgi_app(scope, receive, send)
+            return messages[0]["status"]
+
+        async def get_all():
+            return await asyncio.gather(*(get() for _ in range(requests)))
+
+        start = time.perf_counter()
+        statuses = asyncio.run(get_all())
+        elapsed = time.perf_counter() - start
+        asgi_app.executor.shutdown()
+    camera.close()
+    return {
+        "requests": requests,
+        "wait": wait,
+        "elapsed": elapsed,
+        "overlapped": elapsed < 2 * wait,
+        "statuses": sorted(set(statuses)),
+    }
+
+
+def parse_list(value: str) -> typing.List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_resolution(value: str) -> typing.Tuple[int, int]:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv: typing.List[str] = None) -> dict:
+    parser = argparse.ArgumentParser(
+        prog="python -m picamip.benchmark",
+        description="picamip benchmarks with a synthetic camera",
+    )
+    parser.add_argument(
+        "-s",
+        "--suites",
+        default=",".join(SUITES),
+        help=f"Comma separated suites to run. Default: {','.join(SUITES)}",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, help="JSON output file. Default: stdout"
+    )
+    parser.add_argument("--viewers", default="1,10,50", type=parse_list)
+    parser.add_argument("--duration", default=5.0, type=float)
+    parser.add_argument(
+        "--resolution", default="640x480", type=parse_resolution
+    )
+    parser.add_argument("--framerate", default=30.0, type=float)
+    parser.add_argument("--captures", default=20, type=int)
+    parser.add_argument("--capture-latency", default=0.0, type=float)
+    parser.add_argument("--files", default="100,1000,10000", type=parse_list)
+    parser.add_argument("--repeat", default=20, type=int)
+    parser.add_argument("--long-polls", default=4, type=int)
+    parser.add_argument("--long-poll-wait", default=1.0, type=float)
+    args = parser.parse_args(argv)
+
+    suites = args.suites.split(",")
+    results: dict = {
+        "meta": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "time": time.time(),
+            "pillow": synthetic.Image is not None,
+            "numpy": optional.available("numpy"),
+        }
+    }
+    if "stream" in suites:
+        results["stream"] = [
+            bench_stream(n, args.duration, args.resolution, args.framerate)
+            for n in args.viewers
+        ]
+    if "capture" in suites:
+        results["capture"] = [
+            bench_capture(args.captures, mode, args.capture_latency)
+            for mode in stream.CAPTURE_MODES
+        ]
+    if "storage" in suites:
+        results["storage"] = [
+            bench_storage(n, args.repeat) for n in args.files
+        ]
+    if "motion" in suites and optional.available("numpy"):
+        results["motion"] = bench_motion(
+            args.resolution, args.framerate, args.repeat
+        )
+    if "asgi" in suites and optional.available("asgiref"):
+        results["asgi"] = bench_asgi(args.long_polls, args.long_poll_wait)
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as fp:
+            fp.write(output)
+    return results
+
+
+if __name__ == "__main__":
+    main()
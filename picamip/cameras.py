@@ -0,0 +1,426 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import glob
+import json
+import logging
+from os import path
+import re
+import subprocess
+from threading import Event, Thread
+from time import monotonic
+import typing
+
+import flask
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+from . import metrics, stream
+
+if typing.TYPE_CHECKING:
+    from _typeshed.wsgi import WSGIApplication
+
+SOURCES = ["picamera", "v4l2", "replay", "synthetic", "relay"]
+CAMERA_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+MOUNT_PREFIX = "/cam/"
+STREAM_READY_TIMEOUT = 5.0
+V4L2_DEVICE = "/dev/video0"
+V4L2_RESOLUTION = (640, 480)
+V4L2_FRAMERATE = 30
+REPLAY_FRAMERATE = 10
+FFMPEG = "ffmpeg"
+
+logger = logging.getLogger(__name__)
+
+CameraSource = typing.Tuple[str, str, typing.Optional[str]]
+
+
+def parse_camera(value: str) -> CameraSource:
+    """
+    Parses a camera of the command line, NAME=SOURCE[:ARGUMENT]. The
+    sources and their arguments are:
+        picamera[:NUMBER]: Raspberry Pi camera, default 0
+        v4l2[:DEVICE]: MJPEG webcam, default /dev/video0 (requires ffmpeg)
+        replay:PATTERN: JPEG files replayed in a loop, eg: 'shots/*.jpg'
+        synthetic[:WIDTHxHEIGHT]: Test pattern, default 640x480
+        relay:URL: Stream of another picamip server
+
+    Args:
+        value (str): Eg: door=v4l2:/dev/video1
+    Returns:
+        name (str)
+        source (str): One of SOURCES
+        argument (str): None if omitted
+    Raises:
+        ValueError: invalid name or source
+    """
+    name, _, source = value.partition("=")
+    if not CAMERA_NAME.match(name):
+        raise ValueError(f"camera names must match {CAMERA_NAME.pattern}")
+    source, _, argument = source.partition(":")
+    if source not in SOURCES:
+        raise ValueError(f"camera source must be one of {SOURCES}")
+    if source in ("replay", "relay") and not argument:
+        raise ValueError(f"{source} cameras require an argument")
+    return name, source, argument or None
+
+
+def open_camera(source: str, argument: str = None) -> stream.StreamCamera:
+    """
+    Args:
+        source (str): One of SOURCES
+        argument (str): See `parse_camera`
+    Returns:
+        camera (picamip.stream.StreamCamera): A context manager that
+            closes the camera
+    """
+    if source == "picamera":
+        from . import picamera
+
+        return picamera.StreamPiCamera(camera_num=int(argument or 0))
+    if source == "v4l2":
+        return V4l2Camera(argument or V4L2_DEVICE)
+    if source == "replay":
+        return ReplayCamera(argument)  # type: ignore
+    if source == "synthetic":
+        from . import synthetic
+
+        if argument is None:
+            return synthetic.SyntheticCamera()
+        width, _, height = argument.partition("x")
+        return synthetic.SyntheticCamera(resolution=(int(width), int(height)))
+    if source == "relay":
+        from . import relay
+
+        return relay.RelayCamera(argument)  # type: ignore
+    raise ValueError(f"camera source must be one of {SOURCES}")
+
+
+class V4l2Camera(stream.StreamCamera):
+    """
+    USB webcam with MJPEG output. ffmpeg copies the frames of the device
+    to the stream without decoding them. Stills are stream frames.
+
+    Args:
+        device (str): Eg: /dev/video0
+        resolution (tuple[int, int]): Stream resolution
+        framerate (float): Stream frame rate
+    """
+
+    def __init__(
+        self,
+        device: str = V4L2_DEVICE,
+        resolution: typing.Tuple[int, int] = V4L2_RESOLUTION,
+        framerate: float = V4L2_FRAMERATE,
+    ):
+        self.device = device
+        self.resolution = resolution
+        self.framerate = framerate
+        self._process: typing.Optional[subprocess.Popen] = None
+        self._thread: typing.Optional[Thread] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self.recording:
+            self.stop_recording()
+
+    @property
+    def recording(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start_recording(self) -> None:
+        width, height = self.resolution
+        self._process = subprocess.Popen(
+            [
+                FFMPEG,
+                "-loglevel",
+                "error",
+                "-f",
+                "v4l2",
+                "-input_format",
+                "mjpeg",
+                "-framerate",
+                str(self.framerate),
+                "-video_size",
+                f"{width}x{height}",
+                "-i",
+                self.device,
+                "-c:v",
+                "copy",
+                "-f",
+                "mpjpeg",
+                "-boundary_tag",
+                stream.BOUNDARY.decode(),
+                "-",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+        )
+        self._thread = Thread(
+            target=self._record, args=(self._process,), daemon=True
+        )
+        self._thread.start()
+
+    def stop_recording(self) -> None:
+        process, self._process = self._process, None
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _record(self, process: subprocess.Popen) -> None:
+        try:
+            for frame in stream.read_frames(
+                process.stdout, stream.BOUNDARY  # type: ignore
+            ):
+                self.stream_buffer.publish_frame(frame)
+        except ValueError as error:
+            logger.error(f"Can't read {self.device}: {error}")
+        finally:
+            process.stdout.close()  # type: ignore
+
+    def start_stream(self) -> None:
+        with self.camera_lock:
+            if self.recording:
+                return
+            sequence = self.stream_buffer.sequence
+            self.start_recording()
+            self.stream_buffer.read_chunk(sequence, STREAM_READY_TIMEOUT)
+
+    def camera_settings(self) -> dict:
+        return {"device": self.device, "resolution": list(self.resolution)}
+
+    def capture_burst(self, filenames: typing.List[str]) -> None:
+        self.capture_frames(filenames, STREAM_READY_TIMEOUT)
+
+
+class ReplayCamera(stream.StreamCamera):
+    """
+    Replays JPEG files as a stream, in a loop. Each file is read when it's
+    sent, so long sequences don't take memory. Stills are stream frames.
+
+    Args:
+        pattern (str): Glob of the files, sorted by name. Eg: shots/*.jpg
+        framerate (float): Stream frame rate
+    Raises:
+        FileNotFoundError: no files match `pattern`
+    """
+
+    def __init__(self, pattern: str, framerate: float = REPLAY_FRAMERATE):
+        self.filenames = sorted(glob.glob(path.expanduser(pattern)))
+        if not self.filenames:
+            raise FileNotFoundError(f"No files match {pattern}")
+        self.framerate = framerate
+        self.recording = False
+        self._stop = Event()
+        self._thread: typing.Optional[Thread] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self.recording:
+            self.stop_recording()
+
+    def start_recording(self) -> None:
+        self._stop.clear()
+        self._thread = Thread(target=self._record, daemon=True)
+        self.recording = True
+        self._thread.start()
+
+    def stop_recording(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.recording = False
+
+    def _record(self) -> None:
+        interval = 1 / self.framerate
+        next_time = monotonic()
+        count = 0
+        while not self._stop.is_set():
+            filename = self.filenames[count % len(self.filenames)]
+            count += 1
+            try:
+                with open(filename, "rb") as fp:
+                    self.stream_buffer.publish_frame(fp.read())
+            except OSError as error:
+                logger.warning(f"Skipping {filename}: {error}")
+            next_time += interval
+            delay = next_time - monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                next_time = monotonic()
+
+    def start_stream(self) -> None:
+        with self.camera_lock:
+            if self.recording:
+                return
+            sequence = self.stream_buffer.sequence
+            self.start_recording()
+            self.stream_buffer.read_chunk(sequence, STREAM_READY_TIMEOUT)
+
+    def capture_burst(self, filenames: typing.List[str]) -> None:
+        self.capture_frames(filenames, STREAM_READY_TIMEOUT)
+
+
+def _root_only(prefix: str, view: typing.Callable) -> typing.Callable:
+    """
+    Wraps `view` so it answers 404 when the app is reached under `prefix`
+    """
+
+    def root_only(*args, **kwargs):
+        if flask.request.script_root.endswith(prefix):
+            return flask.make_response("Served at the root /metrics", 404)
+        return view(*args, **kwargs)
+
+    return root_only
+
+
+class CameraRegistry:
+    """
+    Cameras served by one picamip server, each with its own app, built
+    with `picamip.build_app`, so each has its own stream, storage and
+    capture queue. The apps are mounted at /cam/<name>/ and the first one
+    is also served at /.
+    """
+
+    def __init__(self):
+        self.cameras: typing.Dict[str, stream.StreamCamera] = OrderedDict()
+        self.sources: typing.Dict[str, str] = {}
+        self.apps: typing.Dict[str, flask.Flask] = OrderedDict()
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __iter__(self):
+        return iter(self.cameras)
+
+    def add(self, name: str, source: str, camera: stream.StreamCamera) -> None:
+        """
+        Args:
+            name (str): Camera name, used in the urls
+            source (str): One of SOURCES
+            camera (picamip.stream.StreamCamera)
+        Raises:
+            ValueError: duplicated name
+        """
+        if name in self.cameras:
+            raise ValueError(f"Duplicated camera name {name}")
+        self.cameras[name] = camera
+        self.sources[name] = source
+
+    def mount(self, name: str, app: flask.Flask) -> None:
+        """
+        Mounts the app of a camera. The first app also lists the cameras
+        at /cameras. The metrics registry is shared by all the cameras, so
+        /metrics is served only at the root, not under the camera prefix.
+
+        Args:
+            name (str): Camera name
+            app (flask.Flask): App of the camera
+        """
+        if not self.apps:
+            app.add_url_rule("/cameras", "cameras", self.cameras_view)
+        view = app.view_functions.get("metrics_get")
+        if view is not None:
+            app.view_functions["metrics_get"] = _root_only(
+                MOUNT_PREFIX + name, view
+            )
+        self.apps[name] = app
+        self.register_gauges()
+
+    @property
+    def default_app(self) -> flask.Flask:
+        return next(iter(self.apps.values()))
+
+    @property
+    def mounts(self) -> typing.Dict[str, flask.Flask]:
+        """
+        Returns:
+            mounts (dict[str, flask.Flask]): {url prefix: app}
+        """
+        return {MOUNT_PREFIX + name: app for name, app in self.apps.items()}
+
+    def wsgi_app(self) -> DispatcherMiddleware:
+        """
+        Returns:
+            app (werkzeug.middleware.dispatcher.DispatcherMiddleware)
+        """
+        mounts: typing.Dict[str, "WSGIApplication"] = dict(self.mounts)
+        return DispatcherMiddleware(self.default_app, mounts)
+
+    def cameras_view(self):
+        """
+        GET:
+            Lists the cameras and their urls
+        """
+        root = flask.request.script_root
+        listing = [
+            {
+                "name": name,
+                "source": self.sources[name],
+                "url": f"{root}{MOUNT_PREFIX}{name}/",
+            }
+            for name in self.apps
+        ]
+        resp = flask.make_response(json.dumps(listing))
+        resp.headers["Content-Type"] = "application/json"
+        return resp
+
+    def _total(self, function: typing.Callable[[dict], int]) -> int:
+        return sum(
+            function(app.extensions["picamip"]) for app in self.apps.values()
+        )
+
+    def register_gauges(self) -> None:
+        """
+        Replaces the gauges of the last app built, which count only its
+        camera, with the totals of all the cameras
+        """
+        metrics.REGISTRY.gauge(
+            "picamip_stream_clients",
+            "Connected stream viewers",
+            lambda: self._total(
+                lambda ext: len(ext["camera"].stream_buffer.clients)
+            ),
+        )
+        metrics.REGISTRY.gauge(
+            "picamip_stream_variant_clients",
+            "Viewers of the re-encoded stream variants",
+            lambda: self._total(lambda ext: ext["variants"].clients),
+        )
+        metrics.REGISTRY.gauge(
+            "picamip_storage_pictures",
+            "Stored pictures",
+            lambda: self._total(lambda ext: len(ext["storage"])),
+        )
+        metrics.REGISTRY.gauge(
+            "picamip_capture_queue_depth",
+            "Capture jobs waiting for the camera",
+            lambda: self._total(lambda ext: len(ext["capture_queue"])),
+        )
@@ -0,0 +1,239 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+import itertools
+import logging
+import queue
+from threading import Condition, Lock, Thread
+from time import monotonic
+import typing
+
+from . import metrics, pipeline, storage, stream
+
+COALESCE_WINDOW = 0.05
+JOB_HISTORY = 100
+
+logger = logging.getLogger(__name__)
+
+
+class CaptureJob:
+    """
+    A request to take `len(indexes)` pictures
+
+    Args:
+        job_id (int)
+        indexes (list[int]): Indexes assigned to the pictures
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id: int, indexes: typing.List[int]):
+        self.job_id = job_id
+        self.indexes = indexes
+        self.status = self.QUEUED
+        self.error: typing.Optional[str] = None
+        self.submitted = monotonic()
+        self.condition = Condition()
+        # {index: task} when the pictures go through a pipeline
+        self.tasks: typing.Dict[int, pipeline.PipelineTask] = {}
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
+
+    def set_status(self, status: str, error: str = None) -> None:
+        with self.condition:
+            self.status = status
+            self.error = error
+            self.condition.notify_all()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits for the job to finish
+
+        Args:
+            timeout (float): Seconds to wait. Default: wait forever
+        Returns:
+            finished (bool)
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.finished, timeout)
+
+    def to_dict(self) -> dict:
+        job = {
+            "job": self.job_id,
+            "status": self.status,
+            "indexes": self.indexes,
+            "error": self.error,
+        }
+        if self.tasks:
+            job["pipeline"] = {
+                index: task.to_dict() for index, task in self.tasks.items()
+            }
+        return job
+
+
+class CaptureQueue:
+    """
+    Serializes the captures of `camera` in a single worker thread.
+
+    Indexes are assigned when the job is submitted, so concurrent requests
+    never share a filename. A lone job is taken at once. When more jobs
+    are waiting, the worker waits `coalesce_window` seconds for others and
+    takes them all in a single burst.
+
+    Jobs are done once the pictures are stored. The pictures are then
+    queued to `post_capture`, which processes them in the background.
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+        pictures_storage (picamip.storage.IndexedFilesStorage)
+        coalesce_window (float): Seconds to wait for more jobs when jobs
+            are waiting
+        history (int): Number of jobs kept for status queries
+        post_capture (picamip.pipeline.Pipeline): Post-capture pipeline
+            (optional)
+    """
+
+    def __init__(
+        self,
+        camera: stream.StreamCamera,
+        pictures_storage: storage.IndexedFilesStorage,
+        coalesce_window: float = COALESCE_WINDOW,
+        history: int = JOB_HISTORY,
+        post_capture: pipeline.Pipeline = None,
+    ):
+        self.camera = camera
+        self.storage = pictures_storage
+        self.coalesce_window = coalesce_window
+        self.history = history
+        self.post_capture = post_capture
+        self.jobs: typing.Dict[int, CaptureJob] = OrderedDict()
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = Lock()
+        self._ids = itertools.count(1)
+        self._worker: typing.Optional[Thread] = None
+
+    def __getitem__(self, job_id: int) -> CaptureJob:
+        with self._lock:
+            return self.jobs[job_id]
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, count: int = 1) -> CaptureJob:
+        """
+        Queues a job to take `count` pictures
+
+        Args:
+            count (int): Number of pictures
+        Returns:
+            job (CaptureJob)
+        """
+        with self._lock:
+            reserved = max(
+                (j.indexes[-1] for j in self.jobs.values() if not j.finished),
+                default=0,
+            )
+            first = max(self.storage.last_index, reserved) + 1
+            indexes = list(range(first, first + count))
+            self.storage.make_filename(indexes[-1])  # Raises IndexError
+            # Partial pictures are never indexed, registering them clears it
+            for index in indexes:
+                self.storage.start_writing(index)
+            job = CaptureJob(next(self._ids), indexes)
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.history:
+                oldest = next(iter(self.jobs.values()))
+                if not oldest.finished:
+                    break
+                self.jobs.pop(oldest.job_id)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = Thread(target=self._work, daemon=True)
+                self._worker.start()
+        self._queue.put(job)
+        return job
+
+    def _take_batch(self) -> typing.List[CaptureJob]:
+        batch = [self._queue.get()]
+        if self._queue.empty():
+            return batch
+        deadline = monotonic() + self.coalesce_window
+        while True:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _cancel(self, indexes: typing.List[int]) -> None:
+        """
+        Removes the pictures of a failed batch that weren't registered
+        """
+        for index in indexes:
+            try:
+                if index not in self.storage:
+                    self.storage.cancel_writing(index)
+            except Exception:
+                logger.exception(f"Removing the partial picture {index}")
+
+    def _work(self) -> None:
+        while True:
+            batch = self._take_batch()
+            for job in batch:
+                job.set_status(CaptureJob.RUNNING)
+            indexes = [index for job in batch for index in job.indexes]
+            start = monotonic()
+            try:
+                self.camera.capture_burst(
+                    [self.storage.make_filename(i) for i in indexes]
+                )
+            except Exception as error:
+                logger.exception("Capture failed")
+                metrics.CAPTURE_FAILURES.inc()
+                self._cancel(indexes)
+                for job in batch:
+                    job.set_status(CaptureJob.FAILED, str(error))
+                continue
+            done = monotonic()
+            metrics.CAPTURE_SECONDS.observe(done - start)
+            metrics.CAPTURE_PICTURES.inc(len(indexes))
+            try:
+                for index in indexes:
+                    self.storage.register(index)
+                if self.post_capture is not None:
+                    for job in batch:
+                        job.tasks = {
+                            index: self.post_capture.submit(
+                                self.storage, index
+                            )
+                            for index in job.indexes
+                        }
+            except Exception as error:
+                logger.exception("Storing the pictures failed")
+                self._cancel(indexes)
+                for job in batch:
+                    job.set_status(CaptureJob.FAILED, str(error))
+                continue
+            for job in batch:
+                metrics.CAPTURE_LATENCY.observe(done - job.submitted)
+                job.set_status(CaptureJob.DONE)
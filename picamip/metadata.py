@@ -0,0 +1,355 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Rebuilds the metadata index of a pictures directory. Usage:
+
+    python -m picamip.metadata /home/pi/Pictures
+"""
+
+import argparse
+from datetime import datetime
+import json
+from os import path
+import os
+import sqlite3
+from threading import Lock
+import typing
+
+from . import storage, stream, thumbnail
+
+DATABASE_FILENAME = ".picamip.sqlite3"
+HEADER_READ_BYTES = 128 * 1024
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pictures (
+    idx INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    captured REAL NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    settings TEXT
+);
+CREATE INDEX IF NOT EXISTS pictures_captured ON pictures (captured);
+CREATE INDEX IF NOT EXISTS pictures_size ON pictures (size);
+"""
+COLUMNS = ["idx", "filename", "captured", "size", "width", "height"]
+
+
+def parse_time(value: str) -> float:
+    """
+    Parses a time given as seconds since the epoch or in ISO 8601, eg:
+    2021-05-01T14:00. Times without a timezone are local.
+
+    Args:
+        value (str)
+    Returns:
+        timestamp (float): Seconds since the epoch
+    Raises:
+        ValueError: value is not a time
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+class MetadataIndex:
+    """
+    SQLite index of the capture time, size, dimensions and camera
+    settings of the pictures in `pictures_storage`, so the pictures can
+    be filtered without opening them.
+
+    Rows are added when the storage registers a picture, their size and
+    dimensions updated when it's rewritten in place, and removed when the
+    storage deletes it. Pictures that changed outside picamip are synced on
+    the next query, with their mtime as the capture time. The database
+    can be deleted at any time and rebuilt with `rebuild`.
+
+    Args:
+        pictures_storage (picamip.storage.IndexedFilesStorage)
+        camera (picamip.stream.StreamCamera): Source of the settings
+            stored with new pictures (optional)
+        database (str): Database file. Default:
+            {directory}/.picamip.sqlite3
+    """
+
+    def __init__(
+        self,
+        pictures_storage: storage.IndexedFilesStorage,
+        camera: stream.StreamCamera = None,
+        database: str = None,
+    ):
+        self.storage = pictures_storage
+        self.camera = camera
+        self.database = database or path.join(
+            pictures_storage.directory, DATABASE_FILENAME
+        )
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            self.database, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+        self._generation: typing.Optional[int] = None
+        pictures_storage.register_callbacks.append(self.add)
+        pictures_storage.update_callbacks.append(self.update)
+        pictures_storage.delete_callbacks.append(self.remove)
+        self.sync()
+
+    def close(self) -> None:
+        self.storage.register_callbacks.remove(self.add)
+        self.storage.update_callbacks.remove(self.update)
+        self.storage.delete_callbacks.remove(self.remove)
+        with self._lock:
+            self._connection.close()
+
+    def _row(self, index: int, filename: str, settings: dict = None) -> tuple:
+        full_path = path.join(self.storage.directory, filename)
+        stat = os.stat(full_path)
+        with open(full_path, "rb") as fp:
+            size = thumbnail.jpeg_size(fp.read(HEADER_READ_BYTES))
+        width, height = size if size is not None else (None, None)
+        return (
+            index,
+            path.basename(filename),
+            stat.st_mtime,
+            stat.st_size,
+            width,
+            height,
+            json.dumps(settings) if settings is not None else None,
+        )
+
+    def add(self, index: int) -> None:
+        """
+        Adds the metadata of `index`. The capture time and the current
+        camera settings are recorded only the first time, a picture
+        registered again keeps them and gets its file, size and dimensions
+        updated.
+        """
+        try:
+            row = self._row(
+                index,
+                self.storage[index],
+                self.camera.camera_settings() if self.camera else None,
+            )
+        except (KeyError, FileNotFoundError):
+            return
+        # The storage is never called with `_lock` held, its delete
+        # callbacks run with the storage lock held
+        generation = self.storage.generation
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO pictures"
+                    + " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    row,
+                )
+                self._connection.execute(
+                    "UPDATE pictures SET filename = ?, size = ?, width = ?,"
+                    + " height = ? WHERE idx = ?",
+                    (row[1], row[3], row[4], row[5], index),
+                )
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            self._generation = generation
+
+    def update(self, index: int) -> None:
+        """
+        Updates the size and dimensions of `index`, keeping its capture
+        time and settings
+        """
+        try:
+            row = self._row(index, self.storage[index])
+        except (KeyError, FileNotFoundError):
+            return
+        generation = self.storage.generation
+        with self._lock:
+            self._connection.execute(
+                "UPDATE pictures SET size = ?, width = ?, height = ?"
+                + " WHERE idx = ?",
+                (row[3], row[4], row[5], index),
+            )
+            self._generation = generation
+
+    def remove(self, index: int) -> None:
+        generation = self.storage.generation
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM pictures WHERE idx = ?", (index,)
+            )
+            self._generation = generation
+
+    def sync(self) -> int:
+        """
+        Adds the pictures missing from the database and removes the rows
+        of pictures that don't exist anymore
+
+        Returns:
+            changed (int): Number of rows added or removed
+        """
+        generation = self.storage.generation
+        files = dict(self.storage)
+        with self._lock:
+            known = {
+                index
+                for (index,) in self._connection.execute(
+                    "SELECT idx FROM pictures"
+                )
+            }
+            stale = [(index,) for index in known - files.keys()]
+            rows = []
+            for index in files.keys() - known:
+                try:
+                    rows.append(self._row(index, files[index]))
+                except FileNotFoundError:
+                    pass
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany(
+                    "DELETE FROM pictures WHERE idx = ?", stale
+                )
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO pictures"
+                    + " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            self._generation = generation
+        return len(stale) + len(rows)
+
+    def rebuild(self) -> int:
+        """
+        Drops all rows and reads the metadata of every picture again. The
+        camera settings of existing pictures are lost.
+
+        Returns:
+            rows (int): Number of pictures indexed
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM pictures")
+        self.storage.rescan()
+        return self.sync()
+
+    def query(
+        self,
+        limit: int = None,
+        offset: int = 0,
+        after: int = None,
+        before: int = None,
+        since: float = None,
+        until: float = None,
+        min_size: int = None,
+        max_size: int = None,
+        reverse: bool = False,
+    ) -> typing.Tuple[int, typing.List[dict]]:
+        """
+        Filters the pictures by index, capture time and size
+
+        Args:
+            limit (int): Maximum number of pictures. Default: no limit
+            offset (int): Number of pictures to skip
+            after (int): Only indexes larger than `after`
+            before (int): Only indexes smaller than `before`
+            since (float): Only captured at or after `since` (epoch)
+            until (float): Only captured before `until` (epoch)
+            min_size (int): Only files of at least `min_size` bytes
+            max_size (int): Only files of at most `max_size` bytes
+            reverse (bool): Sort from the largest index to the smallest
+        Returns:
+            total (int): Number of pictures that match the filters
+            pictures (list[dict]): Page of the matching pictures
+        """
+        if self._generation != self.storage.generation:
+            self.sync()
+        conditions = []
+        parameters: typing.List[typing.Any] = []
+        for condition, value in [
+            ("idx > ?", after),
+            ("idx < ?", before),
+            ("captured >= ?", since),
+            ("captured < ?", until),
+            ("size >= ?", min_size),
+            ("size <= ?", max_size),
+        ]:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        order = "DESC" if reverse else "ASC"
+        with self._lock:
+            (total,) = self._connection.execute(
+                "SELECT COUNT(*) FROM pictures" + where, parameters
+            ).fetchone()
+            cursor = self._connection.execute(
+                f"SELECT {', '.join(COLUMNS)}, settings FROM pictures"
+                + f"{where} ORDER BY idx {order} LIMIT ? OFFSET ?",
+                parameters + [-1 if limit is None else limit, offset],
+            )
+            pictures = []
+            for row in cursor:
+                picture = dict(zip(COLUMNS, row))
+                picture["index"] = picture.pop("idx")
+                picture["settings"] = json.loads(row[-1]) if row[-1] else None
+                pictures.append(picture)
+        return total, pictures
+
+
+def main(argv: typing.List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m picamip.metadata",
+        description="Rebuilds the metadata index of a picamip directory",
+    )
+    parser.add_argument("picture_dir", type=str, help="Pictures directory")
+    parser.add_argument(
+        "-f",
+        "--files-prefix",
+        default="Picamip_",
+        type=str,
+        help="Stored pictures prefix. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--storage",
+        default="flat",
+        choices=storage.STORAGE_LAYOUTS,
+        help="Storage layout. Default: flat",
+    )
+    args = parser.parse_args(argv)
+
+    from .server import INDEX_DIGITS, PICTURE_SUFFIX
+
+    storage_class = (
+        storage.ShardedFilesStorage
+        if args.storage == "sharded"
+        else storage.IndexedFilesStorage
+    )
+    metadata_index = MetadataIndex(
+        storage_class(
+            args.picture_dir, args.files_prefix, PICTURE_SUFFIX, INDEX_DIGITS
+        )
+    )
+    rows = metadata_index.rebuild()
+    metadata_index.close()
+    print(f"Indexed {rows} pictures")
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+from collections import OrderedDict
+from contextlib import contextmanager
+import math
+from threading import Lock
+from time import perf_counter
+import typing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+]
+
+
+def _format(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base class of the metrics. Subclasses implement `samples`.
+
+    Args:
+        name (str): Metric name, eg: picamip_stream_frames_total
+        documentation (str): HELP text
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = Lock()
+
+    def samples(self) -> typing.List[typing.Tuple[str, float]]:
+        """
+        Returns:
+            samples (list[tuple[str, float]]): (name with labels, value)
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """
+        Returns:
+            text (str): The metric in the Prometheus text format
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(
+            f"{name} {_format(value)}" for name, value in self.samples()
+        )
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """
+    Value that only goes up. With `function` its result is added to the
+    value when the metrics are collected, eg: counts of other processes.
+
+    Args:
+        name (str)
+        documentation (str)
+        function (callable): Returns the count to add (optional)
+    """
+
+    kind = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: typing.Callable[[], float] = None,
+    ):
+        super().__init__(name, documentation)
+        self.function = function
+        self.value: float = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        value = self.value + (self.function() if self.function else 0)
+        return [(self.name, value)]
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down. With `function` the value is read when
+    the metrics are collected, so the hot path doesn't pay for it.
+
+    Args:
+        name (str)
+        documentation (str)
+        function (callable): Returns the current value (optional)
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: typing.Callable[[], float] = None,
+    ):
+        super().__init__(name, documentation)
+        self.function = function
+        self.value: float = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        return [(self.name, value)]
+
+
+class Histogram(Metric):
+    """
+    Counts observations in cumulative buckets
+
+    Args:
+        name (str)
+        documentation (str)
+        buckets (list[float]): Sorted upper bounds. Default: LATENCY_BUCKETS
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: typing.List[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation)
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> typing.Iterator[None]:
+        """
+        Observes the duration of the `with` block in seconds
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [math.inf], counts):
+            cumulative += count
+            samples.append(
+                (f'{self.name}_bucket{{le="{_format(bound)}"}}', cumulative)
+            )
+        samples.append((f"{self.name}_sum", total))
+        samples.append((f"{self.name}_count", cumulative))
+        return samples
+
+
+class Registry:
+    """
+    Collection of metrics exposed together. Registering a metric with
+    the name of an existing one replaces it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics: typing.Dict[str, Metric] = OrderedDict()
+
+    def __getitem__(self, name: str) -> Metric:
+        return self._metrics[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._metrics
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.register(Counter(name, documentation))  # type: ignore
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        function: typing.Callable[[], float] = None,
+    ) -> Gauge:
+        return self.register(  # type: ignore
+            Gauge(name, documentation, function)
+        )
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        buckets: typing.List[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(  # type: ignore
+            Histogram(name, documentation, buckets)
+        )
+
+    def render(self) -> str:
+        """
+        Returns:
+            text (str): All metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+STREAM_FRAMES = REGISTRY.counter(
+    "picamip_stream_frames_total", "Frames written by the camera"
+)
+STREAM_BYTES = REGISTRY.counter(
+    "picamip_stream_bytes_total", "Bytes of the frames written by the camera"
+)
+STREAM_SENT = REGISTRY.counter(
+    "picamip_stream_frames_sent_total", "Frames sent to stream viewers"
+)
+STREAM_DROPPED = REGISTRY.counter(
+    "picamip_stream_frames_dropped_total",
+    "Frames skipped because a viewer was slower than the camera",
+)
+CAPTURE_PICTURES = REGISTRY.counter(
+    "picamip_capture_pictures_total", "Pictures taken"
+)
+CAPTURE_FAILURES = REGISTRY.counter(
+    "picamip_capture_failures_total", "Captures that raised an error"
+)
+CAPTURE_SECONDS = REGISTRY.histogram(
+    "picamip_capture_seconds", "Time the camera took to take a burst"
+)
+CAPTURE_LATENCY = REGISTRY.histogram(
+    "picamip_capture_latency_seconds",
+    "Time from the capture request to the stored picture",
+)
+STORAGE_SCAN_SECONDS = REGISTRY.histogram(
+    "picamip_storage_scan_seconds", "Time to scan the pictures directory"
+)
+TIMELAPSE_SHOTS = REGISTRY.counter(
+    "picamip_timelapse_shots_total", "Pictures taken by the time-lapse"
+)
+TIMELAPSE_SKIPPED = REGISTRY.counter(
+    "picamip_timelapse_skipped_total",
+    "Time-lapse slots skipped because a capture overran",
+)
+VIDEO_FILES = REGISTRY.counter(
+    "picamip_video_files_total", "Video segments and clips written"
+)
+VARIANT_FRAMES = REGISTRY.counter(
+    "picamip_stream_variant_frames_total",
+    "Frames re-encoded for the stream variants",
+)
+VARIANT_SKIPPED = REGISTRY.counter(
+    "picamip_stream_variant_skipped_total",
+    "Frames not re-encoded because the variant was still encoding",
+)
+VARIANT_SECONDS = REGISTRY.histogram(
+    "picamip_stream_variant_seconds", "Time to re-encode a frame"
+)
+MOTION_FRAMES = REGISTRY.counter(
+    "picamip_motion_frames_total", "Frames analyzed by the motion detection"
+)
+MOTION_EVENTS = REGISTRY.counter(
+    "picamip_motion_events_total", "Captures triggered by motion"
+)
+MOTION_SECONDS = REGISTRY.histogram(
+    "picamip_motion_seconds",
+    "Time to compare a frame with the background",
+    [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05],
+)
+RELAY_CONNECTIONS = REGISTRY.counter(
+    "picamip_relay_connections_total",
+    "Connections opened to the upstream stream by the relay",
+)
+PIPELINE_PICTURES = REGISTRY.counter(
+    "picamip_pipeline_pictures_total", "Pictures processed by the pipeline"
+)
+PIPELINE_FAILURES = REGISTRY.counter(
+    "picamip_pipeline_failures_total", "Pictures the pipeline failed on"
+)
+PIPELINE_SKIPPED = REGISTRY.counter(
+    "picamip_pipeline_skipped_total",
+    "Pictures skipped because the pipeline was full",
+)
+PIPELINE_SECONDS = REGISTRY.histogram(
+    "picamip_pipeline_seconds", "Time running the stages of a picture"
+)
@@ -0,0 +1,61 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Moves the pictures of a flat directory into the sharded layout. Usage:
+
+    python -m picamip.migrate /home/pi/Pictures
+"""
+
+import argparse
+import typing
+
+from . import server, storage
+
+
+def main(argv: typing.List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m picamip.migrate",
+        description="Moves the pictures of a flat picamip directory into"
+        + " subdirectories for '--storage sharded'",
+    )
+    parser.add_argument("picture_dir", type=str, help="Pictures directory")
+    parser.add_argument(
+        "-f",
+        "--files-prefix",
+        default="Picamip_",
+        type=str,
+        help="Stored pictures prefix. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--shard-size",
+        default=storage.SHARD_SIZE,
+        type=int,
+        help="Pictures per subdirectory. Default: %(default)s",
+    )
+    args = parser.parse_args(argv)
+
+    moved = storage.migrate_to_shards(
+        args.picture_dir,
+        args.files_prefix,
+        server.PICTURE_SUFFIX,
+        server.INDEX_DIGITS,
+        args.shard_size,
+    )
+    print(f"Moved {moved} pictures")
+    return moved
+
+
+if __name__ == "__main__":
+    main()
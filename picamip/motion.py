@@ -0,0 +1,431 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+import logging
+from threading import Event, Lock, Thread
+import time
+from time import monotonic, perf_counter
+import typing
+
+from . import capture, metrics, optional, stream
+
+if typing.TYPE_CHECKING:
+    import numpy as np  # type: ignore
+
+    from .picamera import StreamPiCamera
+
+MOTION_SOURCES = ["yuv", "mjpeg"]
+MOTION_PORT = 3
+MOTION_RESOLUTION = (160, 120)
+MOTION_THRESHOLD = 25
+MOTION_AREA = 0.01
+MOTION_COOLDOWN = 10.0
+LEARNING_RATE = 0.05
+# Frames further apart than this are not compared, eg: the stream was
+# restarted after a still and the exposure changed
+RESET_SECONDS = 1.0
+STATUS_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+Roi = typing.Tuple[float, float, float, float]
+
+
+def parse_roi(value: str) -> Roi:
+    """
+    Parses a region of interest given as "x,y,width,height", in fractions
+    of the frame. Eg: "0.5,0,0.5,1" is the right half.
+
+    Args:
+        value (str)
+    Returns:
+        roi (tuple[float, float, float, float])
+    Raises:
+        ValueError: value is not a region inside the frame
+    """
+    roi = tuple(float(v) for v in value.split(","))
+    if len(roi) != 4:
+        raise ValueError(f"roi must be x,y,width,height, got {value}")
+    x, y, width, height = roi
+    if min(roi) < 0 or x + width > 1 or y + height > 1:
+        raise ValueError(f"roi must be inside the frame, got {value}")
+    return roi  # type: ignore
+
+
+class MotionDetector:
+    """
+    Detects motion by comparing the luma of each frame with a running
+    average of the previous ones (the background). A pixel changed when it
+    differs from the background by more than `threshold`. There is motion
+    when at least `min_area` of the region of interest changed.
+
+    The buffers are allocated once and every step writes into them, so
+    `detect` doesn't allocate arrays and runs at the stream frame rate on
+    a Raspberry Pi.
+
+    Args:
+        resolution (tuple[int, int]): (width, height) of the frames
+        threshold (float): Luma difference of a changed pixel, 0-255
+        min_area (float): Fraction of the region that must change
+        roi (tuple[float, float, float, float]): Region of interest, see
+            `parse_roi`. Default: the whole frame
+        learning_rate (float): Weight of each frame in the background
+    Raises:
+        ImportError: numpy is not installed
+        ValueError: invalid threshold, area, region or learning rate
+    """
+
+    def __init__(
+        self,
+        resolution: typing.Tuple[int, int] = MOTION_RESOLUTION,
+        threshold: float = MOTION_THRESHOLD,
+        min_area: float = MOTION_AREA,
+        roi: Roi = None,
+        learning_rate: float = LEARNING_RATE,
+    ):
+        np = optional.load("numpy")
+        if np is None:
+            raise ImportError(
+                "Motion detection requires numpy: pip install picamip[motion]"
+            )
+        if not 0 <= threshold < 255:
+            raise ValueError(f"threshold must be in [0, 255), got {threshold}")
+        if not 0 < min_area <= 1:
+            raise ValueError(f"min_area must be in (0, 1], got {min_area}")
+        if not 0 < learning_rate <= 1:
+            raise ValueError(
+                f"learning_rate must be in (0, 1], got {learning_rate}"
+            )
+        width, height = resolution
+        x, y, roi_width, roi_height = roi or (0.0, 0.0, 1.0, 1.0)
+        left, top = int(x * width), int(y * height)
+        right = max(int(round((x + roi_width) * width)), left + 1)
+        bottom = max(int(round((y + roi_height) * height)), top + 1)
+        self.resolution = resolution
+        self.threshold = threshold
+        self.min_area = min_area
+        self.roi = roi
+        self.learning_rate = learning_rate
+        self._np = np
+        self._window = (slice(top, bottom), slice(left, right))
+        shape = (bottom - top, right - left)
+        self._background = np.zeros(shape, np.float32)
+        self._difference = np.zeros(shape, np.float32)
+        self._update = np.zeros(shape, np.float32)
+        self._changed = np.zeros(shape, np.bool_)
+        self.min_pixels = max(int(min_area * self._changed.size), 1)
+        self.score = 0.0
+        self._ready = False
+
+    def reset(self) -> None:
+        """
+        Starts the background again from the next frame
+        """
+        self._ready = False
+        self.score = 0.0
+
+    def detect(self, luma: "np.ndarray") -> bool:
+        """
+        Compares a frame with the background and updates the background
+
+        Args:
+            luma (numpy.ndarray): uint8 frame of shape (height, width)
+        Returns:
+            motion (bool)
+        """
+        np = self._np
+        window = luma[self._window]
+        if not self._ready:
+            np.copyto(self._background, window)
+            self._ready = True
+            return False
+        np.subtract(window, self._background, out=self._difference)
+        np.multiply(self._difference, self.learning_rate, out=self._update)
+        np.add(self._background, self._update, out=self._background)
+        np.abs(self._difference, out=self._difference)
+        np.greater(self._difference, self.threshold, out=self._changed)
+        changed = np.count_nonzero(self._changed)
+        self.score = changed / self._changed.size
+        return changed >= self.min_pixels
+
+
+class YuvOutput:
+    """
+    Output of a raw YUV recording. picamera writes one frame per call,
+    with the width padded to 32 and the height to 16; the luma plane
+    comes first and is passed to `analyze` as a view, without copying.
+
+    Args:
+        resolution (tuple[int, int]): (width, height) of the recording
+        analyze (callable): Receives the luma of each frame
+    """
+
+    def __init__(
+        self,
+        resolution: typing.Tuple[int, int],
+        analyze: typing.Callable[["np.ndarray"], None],
+    ):
+        width, height = resolution
+        self.resolution = resolution
+        self.padded = ((width + 31) // 32 * 32, (height + 15) // 16 * 16)
+        self.analyze = analyze
+        self._np = optional.load("numpy")
+
+    def write(self, buf: bytes) -> int:
+        width, height = self.resolution
+        padded_width, padded_height = self.padded
+        size = padded_width * padded_height
+        if len(buf) >= size:
+            luma = self._np.frombuffer(buf, self._np.uint8, count=size)
+            self.analyze(
+                luma.reshape(padded_height, padded_width)[:height, :width]
+            )
+        return len(buf)
+
+    def flush(self) -> None:
+        pass
+
+
+class MotionMonitor:
+    """
+    Takes a picture through a `CaptureQueue` when a `MotionDetector` sees
+    motion, then waits `cooldown` seconds before the next one.
+
+    Sources:
+        yuv: Records low resolution YUV frames from the splitter port
+            `MOTION_PORT` and analyzes their luma as it arrives. Requires
+            the "video_port" capture mode, like the video recording.
+        mjpeg: Decodes the frames of the MJPEG stream at a reduced scale
+            (requires Pillow). Works in both capture modes but costs a
+            decode per frame, frames that arrive while one is analyzed
+            are skipped. The monitor counts as a stream viewer, so the
+            stream restarts after stills in the "restart" mode.
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+        capture_queue (picamip.capture.CaptureQueue)
+    """
+
+    def __init__(
+        self, camera: stream.StreamCamera, capture_queue: capture.CaptureQueue
+    ):
+        self.camera = camera
+        self.capture_queue = capture_queue
+        self.source: typing.Optional[str] = None
+        self.cooldown = MOTION_COOLDOWN
+        self.detector: typing.Optional[MotionDetector] = None
+        self.frames = 0
+        self.skipped = 0
+        self.events = 0
+        self.last_event: typing.Optional[float] = None
+        self.last_job: typing.Optional[int] = None
+        self.error: typing.Optional[str] = None
+        self._last_frame: typing.Optional[float] = None
+        self._next_event = 0.0
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread: typing.Optional[Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def _picamera(self) -> "StreamPiCamera":
+        # The yuv source is only started on cameras with splitter ports
+        return typing.cast("StreamPiCamera", self.camera)
+
+    def start(
+        self,
+        source: str = None,
+        threshold: float = MOTION_THRESHOLD,
+        min_area: float = MOTION_AREA,
+        roi: Roi = None,
+        cooldown: float = MOTION_COOLDOWN,
+        resolution: typing.Tuple[int, int] = MOTION_RESOLUTION,
+    ) -> None:
+        """
+        Starts detecting motion, replacing the running detection
+
+        Args:
+            source (str): One of MOTION_SOURCES. Default: "yuv" in the
+                "video_port" capture mode of the Raspberry Pi camera,
+                otherwise "mjpeg"
+            threshold (float): See `MotionDetector`
+            min_area (float): See `MotionDetector`
+            roi (tuple[float, float, float, float]): See `MotionDetector`
+            cooldown (float): Seconds between captures
+            resolution (tuple[int, int]): Resolution of the analyzed frames
+        Raises:
+            ImportError: numpy or Pillow are not installed
+            ValueError: invalid source or parameters
+        """
+        yuv_capable = (
+            self.camera.splitter_ports
+            and self.camera.capture_mode == "video_port"
+        )
+        if source is None:
+            source = "yuv" if yuv_capable else "mjpeg"
+        if source not in MOTION_SOURCES:
+            raise ValueError(f"source must be one of {MOTION_SOURCES}")
+        if source == "yuv" and not yuv_capable:
+            raise ValueError(
+                "the yuv source requires the 'video_port' capture mode"
+            )
+        if source == "mjpeg" and not optional.available("PIL"):
+            raise ImportError(
+                "The mjpeg source requires Pillow: pip install picamip[motion]"
+            )
+        if cooldown < 0:
+            raise ValueError(f"cooldown must not be negative, got {cooldown}")
+        detector = MotionDetector(resolution, threshold, min_area, roi)
+        with self._lock:
+            self._halt()
+            self.source = source
+            self.cooldown = cooldown
+            self.detector = detector
+            self.frames = self.skipped = self.events = 0
+            self.last_event = self.last_job = None
+            self.error = None
+            self._last_frame = None
+            self._next_event = 0.0
+            self._stop = Event()
+            if source == "yuv":
+                self.camera.start_stream()
+                with self.camera.camera_lock:
+                    self._picamera.start_recording(
+                        YuvOutput(resolution, self._analyze),
+                        format="yuv",
+                        resize=resolution,
+                        splitter_port=MOTION_PORT,
+                    )
+                target = self._watch_yuv
+            else:
+                target = self._read_mjpeg
+            self._thread = Thread(
+                target=target, args=(self._stop,), daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops detecting motion. A capture in progress is finished.
+        """
+        with self._lock:
+            self._halt()
+
+    def _halt(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            if self.source == "yuv":
+                with self.camera.camera_lock:
+                    try:
+                        self._picamera.stop_recording(
+                            splitter_port=MOTION_PORT
+                        )
+                    except Exception as error:
+                        # The encoder failed or it wasn't recording
+                        logger.warning(f"Stopping the motion frames: {error}")
+        self._thread = None
+
+    def _analyze(self, luma: "np.ndarray") -> None:
+        now = monotonic()
+        last_frame, self._last_frame = self._last_frame, now
+        if last_frame is not None and now - last_frame > RESET_SECONDS:
+            self.detector.reset()
+        start = perf_counter()
+        motion = self.detector.detect(luma)
+        metrics.MOTION_SECONDS.observe(perf_counter() - start)
+        metrics.MOTION_FRAMES.inc()
+        self.frames += 1
+        if not motion or now < self._next_event:
+            return
+        self._next_event = now + self.cooldown
+        try:
+            job = self.capture_queue.submit()
+        except IndexError as error:
+            self.error = str(error)
+            return
+        self.events += 1
+        self.last_event = time.time()
+        self.last_job = job.job_id
+        metrics.MOTION_EVENTS.inc()
+
+    def _watch_yuv(self, stop: Event) -> None:
+        # The frames are analyzed by the encoder thread, this only reports
+        # its errors
+        while not stop.wait(STATUS_INTERVAL):
+            try:
+                self._picamera.wait_recording(0, splitter_port=MOTION_PORT)
+            except Exception as error:
+                logger.exception("Motion detection failed")
+                self.error = str(error)
+                return
+
+    def _decode(self, chunk: bytes) -> "np.ndarray":
+        frame = stream.JpegStreamIO.chunk_frame(chunk)
+        image = optional.load("PIL.Image").open(io.BytesIO(frame))
+        # Decodes the JPEG at 1/2, 1/4 or 1/8 of its size, in grayscale
+        image.draft("L", self.detector.resolution)
+        if image.mode != "L":
+            image = image.convert("L")
+        if image.size != self.detector.resolution:
+            image = image.resize(self.detector.resolution)
+        return optional.load("numpy").asarray(image)
+
+    def _read_mjpeg(self, stop: Event) -> None:
+        stream_buffer = self.camera.stream_buffer
+        client = stream.StreamClient()
+        stream_buffer.clients.add(client)
+        try:
+            self.camera.start_stream()
+            sequence = stream_buffer.sequence
+            while not stop.is_set():
+                latest, chunk = stream_buffer.read_chunk(
+                    sequence, stream.STREAM_TIMEOUT, latest=True
+                )
+                if chunk is None:
+                    # A capture stopped the camera
+                    self.camera.start_stream()
+                    continue
+                self.skipped += max(latest - sequence - 1, 0)
+                sequence = latest
+                self._analyze(self._decode(chunk))
+        except Exception as error:
+            logger.exception("Motion detection failed")
+            self.error = str(error)
+        finally:
+            stream_buffer.clients.discard(client)
+
+    def to_dict(self) -> dict:
+        detector = self.detector
+        return {
+            "running": self.running,
+            "source": self.source,
+            "threshold": detector.threshold if detector else None,
+            "min_area": detector.min_area if detector else None,
+            "roi": detector.roi if detector else None,
+            "cooldown": self.cooldown,
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "score": detector.score if detector else None,
+            "events": self.events,
+            "last_event": self.last_event,
+            "last_job": self.last_job,
+            "error": self.error,
+        }
@@ -0,0 +1,56 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Optional dependencies are imported on first use: numpy and Pillow take
+a noticeable part of the startup on a Raspberry Pi Zero.
+"""
+
+import importlib
+import importlib.util
+from types import ModuleType
+import typing
+
+_modules: typing.Dict[str, typing.Optional[ModuleType]] = {}
+
+
+def available(name: str) -> bool:
+    """
+    Checks if a top level package is installed, without importing it
+
+    Args:
+        name (str): Package name, eg: numpy
+    Returns:
+        available (bool)
+    """
+    if name in _modules:
+        return _modules[name] is not None
+    return importlib.util.find_spec(name) is not None
+
+
+def load(name: str) -> typing.Optional[ModuleType]:
+    """
+    Imports a module once
+
+    Args:
+        name (str): Module name, eg: PIL.Image
+    Returns:
+        module (module): The module or None if it's not installed
+    """
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module(name)
+        except ImportError:
+            _modules[name] = None
+    return _modules[name]
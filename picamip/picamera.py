@@ -13,80 +13,162 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import io
-from threading import Condition
-from time import sleep
-import typing
 
-from picamera import PiCamera  # type: ignore
+from time import monotonic, sleep
+import typing
 
+from picamera import PiCamera, exc  # type: ignore
 
-class JpegStreamIO(io.BytesIO):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.frame = None
-        self.condition = Condition()
+from .stream import (
+    BOUNDARY,
+    CAPTURE_MODES,
+    JpegStreamIO,
+    StreamCamera,
+    StreamClient,
+)
 
-    def write(self, buf: bytes):
-        if buf.startswith(b"\xff\xd8"):
-            self.truncate()
-            with self.condition:
-                self.frame = self.getvalue()
-                self.condition.notify_all()
-            self.seek(0)
-        return super().write(buf)
+STILL_RESOLUTION = (2592, 1944)
+STILL_FRAMERATE = 15
+STREAM_RESOLUTION = (640, 480)
+STREAM_READY_TIMEOUT = 5.0
+STREAM_PORT = 1
+SETTLE_TIMEOUT = 2.0
+SETTLE_INTERVAL = 0.05
+SETTLE_SAMPLES = 3
 
 
-class StreamPiCamera(PiCamera):
+class StreamPiCamera(StreamCamera, PiCamera):
     """
     Wrapper class for picamera.PiCamera that extends it by adding a
     stream_generator method to yield streaming frames.
+
+    Stills are taken according to `capture_mode`:
+        restart: Stops the stream, captures at `still_resolution` from the
+            still port and restarts the stream. Viewers lose the stream
+            for a moment.
+        video_port: Keeps the sensor at `still_resolution` and records
+            the stream resized to `stream_resolution`. Stills are taken
+            from the video splitter port while the stream keeps running.
     """
 
-    instance = None
+    instances: typing.Dict[int, "StreamPiCamera"] = {}
+    splitter_ports = True
+    still_resolution = STILL_RESOLUTION
+    still_framerate = STILL_FRAMERATE
+    stream_resolution = STREAM_RESOLUTION
 
-    def __new__(cls, *args, **kwargs):
-        if not cls.instance:
-            cls.instance = super().__new__(cls, *args, **kwargs)
-        return cls.instance
+    def __new__(cls, camera_num: int = 0, *args, **kwargs):
+        # The camera can't be opened twice, one instance per camera
+        if camera_num not in cls.instances:
+            cls.instances[camera_num] = super().__new__(cls)
+        return cls.instances[camera_num]
 
-    @property
-    def stream_buffer(self) -> JpegStreamIO:
-        if not hasattr(self, "_stream_buffer"):
-            self._stream_buffer = JpegStreamIO()
-        return self._stream_buffer
+    def start_stream(self) -> None:
+        """
+        Starts recording to `stream_buffer` if the camera is idle and waits
+        for the first frame
+        """
+        with self.camera_lock:
+            if self.is_recording(STREAM_PORT):
+                return
+            sequence = self.stream_buffer.sequence
+            if self.capture_mode == "video_port":
+                # The sensor mode can't change while another port records
+                if not self.recording:
+                    self.resolution = self.still_resolution
+                    self.framerate = self.still_framerate
+                self.start_recording(
+                    self.stream_buffer,
+                    format="mjpeg",
+                    resize=self.stream_resolution,
+                    splitter_port=STREAM_PORT,
+                )
+            else:
+                self.start_recording(self.stream_buffer, format="mjpeg")
+            self.stream_buffer.read_chunk(sequence, STREAM_READY_TIMEOUT)
 
-    def stream_generator(self) -> typing.Generator[bytes, None, None]:
+    def is_recording(self, splitter_port: int) -> bool:
+        """
+        Args:
+            splitter_port (int)
+        Returns:
+            recording (bool): True if `splitter_port` is recording
         """
-        Starts the camera and yields video stream frames
+        try:
+            self.wait_recording(0, splitter_port=splitter_port)
+        except exc.PiCameraNotRecording:
+            return False
+        return True
+
+    def wait_settled(self, timeout: float = SETTLE_TIMEOUT) -> bool:
         """
-        if not self.recording:
-            self.start_recording(self.stream_buffer, format="mjpeg")
-            sleep(1)
-        while True:
-            with self.stream_buffer.condition:
-                self.stream_buffer.condition.wait()
-                frame = self.stream_buffer.frame
-            yield (
-                b"--FRAME\r\n"
-                + b"Content-Type: image/jpeg\r\n\r\n"
-                + frame
-                + b"\r\n"
+        Waits until the gains and exposure stop changing
+
+        Args:
+            timeout (float): Maximum seconds to wait
+        Returns:
+            settled (bool): False if the timeout expired
+        """
+        deadline = monotonic() + timeout
+        last = None
+        stable = 0
+        while monotonic() < deadline:
+            current = (
+                self.analog_gain,
+                self.digital_gain,
+                self.exposure_speed,
             )
+            stable = stable + 1 if current == last else 0
+            if stable >= SETTLE_SAMPLES and current[0] > 0:
+                return True
+            last = current
+            sleep(SETTLE_INTERVAL)
+        return False
+
+    def capture_burst(self, filenames: typing.List[str]) -> None:
+        """
+        Takes one still per filename, back to back
 
-    def capture(self, filename: str) -> None:
-        if self.recording:
-            self.stop_recording()
-        attributes = self.list_attributes()
-        self.resolution = (2592, 1944)
-        self.start_preview()
-        sleep(2)
-        super().capture(filename)
-        self.stop_preview()
-        while self.recording:
-            self.stop_recording()
-        self.set_attributes(attributes)
-        self.start_recording(self.stream_buffer, format="mjpeg")
+        Args:
+            filenames (list[str])
+        """
+        with self.camera_lock:
+            if self.capture_mode == "video_port":
+                self.start_stream()
+                super().capture_sequence(filenames, use_video_port=True)
+                return
+            if self.recording:
+                self.stop_recording()
+            attributes = self.list_attributes()
+            self.resolution = self.still_resolution
+            self.start_preview()
+            self.wait_settled()
+            super().capture_sequence(filenames, burst=len(filenames) > 1)
+            self.stop_preview()
+            while self.recording:
+                self.stop_recording()
+            self.set_attributes(attributes)
+            # Without viewers the stream stays stopped until the next viewer
+            # starts it, so time-lapses don't restart it on every shot
+            if self.stream_buffer.clients:
+                self.start_recording(self.stream_buffer, format="mjpeg")
+
+    def camera_settings(self) -> dict:
+        """
+        Returns:
+            settings (dict): Exposure, gains and white balance
+        """
+        red, blue = self.awb_gains
+        return {
+            "resolution": list(self.still_resolution),
+            "exposure_speed": self.exposure_speed,
+            "analog_gain": float(self.analog_gain),
+            "digital_gain": float(self.digital_gain),
+            "iso": self.iso,
+            "exposure_mode": self.exposure_mode,
+            "awb_mode": self.awb_mode,
+            "awb_gains": [float(red), float(blue)],
+        }
 
     def list_attributes(self) -> dict:
         return {"resolution": self.resolution}
@@ -0,0 +1,579 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Processes the pictures after they are stored, in a pool of worker
+processes, so the captures and the requests don't wait for it.
+"""
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import importlib.util
+import io
+import logging
+import multiprocessing
+from os import path
+import os
+import struct
+from threading import Lock
+from time import perf_counter
+import typing
+
+from . import metrics, optional, storage, thumbnail
+
+STAGES = ["orient", "strip", "recompress", "checksum", "thumbnails"]
+WORKERS = 1
+# Pictures waiting for a worker, more are not processed
+MAX_PENDING = 100
+RECOMPRESS_QUALITY = 85
+ORIENT_QUALITY = 95
+CHECKSUM_ALGORITHM = "sha256"
+READ_BYTES = 64 * 1024
+# Hidden files next to the pictures, never matched by the storages
+TEMPORARY_PREFIX = ".picamip-"
+TEMPORARY_SUFFIX = ".tmp"
+# APP1 to APP15 and COM. APP0 (JFIF) tells decoders the color space.
+METADATA_MARKERS = set(range(0xE1, 0xF0)) | {0xFE}
+
+logger = logging.getLogger(__name__)
+
+
+class Picture(typing.NamedTuple):
+    """
+    Picture given to the stages
+
+    Args:
+        filename (str): Full path of the picture
+        index (int): Index of the picture in the storage
+        directory (str): Directory of the storage
+    """
+
+    filename: str
+    # Shadows tuple.index, the stages read it by name
+    index: int  # type: ignore
+    directory: str
+
+
+# (name, source, argument): source is a built-in stage or the path of a
+# script, argument is the built-in argument or the script function name
+Stage = typing.Tuple[str, str, typing.Optional[str]]
+
+
+def _replace(filename: str, data: bytes) -> None:
+    """
+    Replaces `filename` atomically, so it's never served half written
+    """
+    directory, name = path.split(filename)
+    temporary = path.join(
+        directory, TEMPORARY_PREFIX + name + TEMPORARY_SUFFIX
+    )
+    try:
+        with open(temporary, "wb") as fp:
+            fp.write(data)
+        os.replace(temporary, filename)
+    except BaseException:
+        if path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def remove_temporary(directory: str) -> int:
+    """
+    Removes the temporary files of the stages a crash interrupted, in
+    `directory` and its subdirectories
+
+    Args:
+        directory (str)
+    Returns:
+        removed (int): Number of files removed
+    """
+    removed = 0
+    for root, _, filenames in os.walk(directory):
+        for name in filenames:
+            if name.startswith(TEMPORARY_PREFIX) and name.endswith(
+                TEMPORARY_SUFFIX
+            ):
+                try:
+                    os.remove(path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                removed += 1
+    return removed
+
+
+def _signature(filename: str) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Returns:
+        signature (tuple[int, int]): (size, mtime_ns) of `filename`, None
+            if it doesn't exist
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def orient(picture: Picture, argument: str = None) -> typing.Optional[dict]:
+    """
+    Rotates the picture as its EXIF orientation says, and resets it
+
+    Args:
+        argument (str): JPEG quality. Default: ORIENT_QUALITY
+    """
+    Image = optional.load("PIL.Image")
+    ImageOps = optional.load("PIL.ImageOps")
+    if Image is None:
+        raise ImportError("The orient stage requires Pillow")
+    with Image.open(picture.filename) as image:
+        orientation = image.getexif().get(0x0112, 1)
+        if orientation == 1:
+            return None
+        rotated = ImageOps.exif_transpose(image)  # type: ignore
+        output = io.BytesIO()
+        rotated.save(
+            output,
+            "JPEG",
+            quality=int(argument or ORIENT_QUALITY),
+            exif=rotated.info.get("exif", b""),
+        )
+    _replace(picture.filename, output.getvalue())
+    return {"orientation": orientation}
+
+
+def strip(picture: Picture, argument: str = None) -> typing.Optional[dict]:
+    """
+    Removes the EXIF and other metadata segments without decoding the
+    picture
+    """
+    with open(picture.filename, "rb") as fp:
+        data = fp.read()
+    if not data.startswith(b"\xff\xd8"):
+        raise ValueError(f"{picture.filename} is not a JPEG")
+    parts = [data[:2]]
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            raise ValueError(f"{picture.filename} has an invalid segment")
+        marker = data[position + 1]
+        if marker == 0xDA:
+            break
+        (length,) = struct.unpack_from(">H", data, position + 2)
+        if marker not in METADATA_MARKERS:
+            parts.append(data[position : position + 2 + length])
+        position += 2 + length
+    parts.append(data[position:])
+    stripped = b"".join(parts)
+    if len(stripped) == len(data):
+        return None
+    _replace(picture.filename, stripped)
+    return {"stripped": len(data) - len(stripped)}
+
+
+def recompress(
+    picture: Picture, argument: str = None
+) -> typing.Optional[dict]:
+    """
+    Recompresses the picture, keeping its EXIF, if that makes it smaller
+
+    Args:
+        argument (str): JPEG quality. Default: RECOMPRESS_QUALITY
+    """
+    Image = optional.load("PIL.Image")
+    if Image is None:
+        raise ImportError("The recompress stage requires Pillow")
+    quality = int(argument or RECOMPRESS_QUALITY)
+    size = path.getsize(picture.filename)
+    with Image.open(picture.filename) as image:
+        output = io.BytesIO()
+        image.save(
+            output, "JPEG", quality=quality, exif=image.info.get("exif", b"")
+        )
+    if output.tell() >= size:
+        return None
+    _replace(picture.filename, output.getvalue())
+    return {"quality": quality, "saved": size - output.tell()}
+
+
+def checksum(picture: Picture, argument: str = None) -> dict:
+    """
+    Args:
+        argument (str): hashlib algorithm. Default: CHECKSUM_ALGORITHM
+    """
+    algorithm = argument or CHECKSUM_ALGORITHM
+    digest = hashlib.new(algorithm)
+    with open(picture.filename, "rb") as fp:
+        for block in iter(lambda: fp.read(READ_BYTES), b""):
+            digest.update(block)
+    return {algorithm: digest.hexdigest()}
+
+
+def thumbnails(picture: Picture, argument: str = None) -> dict:
+    """
+    Writes thumbnails to the disk cache of `picamip.thumbnail`, so the
+    first request of each is served from disk
+
+    Args:
+        argument (str): Comma separated sizes. Default: the size of the
+            index page thumbnails
+    """
+    if not optional.available("PIL"):
+        raise ImportError("The thumbnails stage requires Pillow")
+    sizes = sorted(
+        {
+            thumbnail.best_size(int(size))
+            for size in (argument or str(thumbnail.THUMBNAIL_SIZES[0])).split(
+                ","
+            )
+        }
+    )
+    directory = path.join(picture.directory, thumbnail.CACHE_DIRNAME)
+    os.makedirs(directory, exist_ok=True)
+    mtime_ns = os.stat(picture.filename).st_mtime_ns
+    for size in sizes:
+        data = thumbnail.downscale(
+            picture.filename, size, thumbnail.THUMBNAIL_QUALITY
+        )
+        _replace(
+            path.join(directory, f"{picture.index}_{size}_{mtime_ns}.jpg"),
+            data,
+        )
+    return {"thumbnails": sizes}
+
+
+BUILTINS: typing.Dict[str, typing.Callable[..., typing.Optional[dict]]] = {
+    "orient": orient,
+    "strip": strip,
+    "recompress": recompress,
+    "checksum": checksum,
+    "thumbnails": thumbnails,
+}
+
+
+def load_script(filename: str) -> typing.Dict[str, typing.Callable]:
+    """
+    Loads the stages of a script: its functions whose names start with
+    "stage", in the order they are defined. Each takes a `Picture` and
+    returns a dict of results to report, or None.
+
+    Args:
+        filename (str): Python file
+    Returns:
+        stages (dict[str, callable]): {function name: function}
+    Raises:
+        ImportError: the file doesn't exist or has no stage functions
+    """
+    if not path.isfile(filename):
+        raise ImportError(f"Module {filename} not found")
+    spec = importlib.util.spec_from_file_location(  # type: ignore
+        "pipeline_stages", filename
+    )
+    module = importlib.util.module_from_spec(spec)  # type: ignore
+    spec.loader.exec_module(module)
+    stage_functions = {
+        fname: module.__dict__[fname]
+        for fname in module.__dict__
+        if fname.startswith("stage") and callable(module.__dict__[fname])
+    }
+    if len(stage_functions) == 0:
+        raise ImportError(f"Module {filename} has no stage functions")
+    return stage_functions
+
+
+def parse_stages(specs: typing.List[str]) -> typing.List[Stage]:
+    """
+    Parses the stages of the command line. Each is a built-in stage,
+    NAME[:ARGUMENT], or the path of a script, see `load_script`:
+        orient[:QUALITY]: Applies the EXIF orientation (requires Pillow)
+        strip: Removes the EXIF, losslessly
+        recompress[:QUALITY]: Recompresses if it's smaller, default 85
+            (requires Pillow)
+        checksum[:ALGORITHM]: Reports a checksum, default sha256
+        thumbnails[:SIZE,...]: Pre-generates thumbnails, default 64
+            (requires Pillow)
+
+    Args:
+        specs (list[str]): Eg: ["orient", "recompress:80", "hooks.py"]
+    Returns:
+        stages (list[Stage]): In the order they run
+    Raises:
+        ValueError: unknown stage
+        ImportError: invalid script
+    """
+    stages: typing.List[Stage] = []
+    for spec in specs:
+        name, _, argument = spec.partition(":")
+        if name in BUILTINS:
+            if name == "checksum" and argument:
+                hashlib.new(argument)  # Raises ValueError
+            stages.append((name, name, argument or None))
+        elif spec.endswith(".py"):
+            filename = path.abspath(spec)
+            for fname in load_script(filename):
+                stages.append(
+                    (f"{path.basename(filename)}:{fname}", filename, fname)
+                )
+        else:
+            raise ValueError(
+                f"pipeline stages must be one of {STAGES} or a .py script"
+            )
+    return stages
+
+
+_scripts: typing.Dict[str, typing.Dict[str, typing.Callable]] = {}
+
+
+def run_stages(
+    stages: typing.List[Stage], picture: Picture
+) -> typing.Tuple[dict, typing.List[typing.Tuple[str, float]], str]:
+    """
+    Runs the stages on a picture. Runs in the worker processes, which
+    load each script once.
+
+    Args:
+        stages (list[Stage])
+        picture (Picture)
+    Returns:
+        results (dict): Results of the stages
+        timings (list[tuple[str, float]]): (stage name, seconds) of the
+            stages that ran
+        error (str): Error of the stage that failed, the next ones don't
+            run. None if all succeeded
+    """
+    results: dict = {}
+    timings = []
+    for name, source, argument in stages:
+        start = perf_counter()
+        try:
+            if source in BUILTINS:
+                result = BUILTINS[source](picture, argument)
+            else:
+                if source not in _scripts:
+                    _scripts[source] = load_script(source)
+                result = _scripts[source][argument](picture)  # type: ignore
+        except Exception as error:
+            timings.append((name, perf_counter() - start))
+            return results, timings, f"{name}: {error!r}"
+        timings.append((name, perf_counter() - start))
+        if result:
+            results.update(result)
+    return results, timings, None  # type: ignore
+
+
+class PipelineTask:
+    """
+    Processing of a picture
+
+    Args:
+        index (int): Index of the picture
+    """
+
+    QUEUED = "queued"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    def __init__(self, index: int):
+        self.index = index
+        self.status = self.QUEUED
+        self.results: dict = {}
+        self.timings: typing.Dict[str, float] = {}
+        self.error: typing.Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "results": self.results,
+            "timings": self.timings,
+            "error": self.error,
+        }
+
+
+class StageStats:
+    """
+    Timings of a stage
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "seconds": self.seconds,
+            "mean_seconds": self.seconds / self.count if self.count else 0.0,
+            "max_seconds": self.max_seconds,
+        }
+
+
+class Pipeline:
+    """
+    Runs `stages` on every picture taken, in a pool of `workers`
+    processes. The processes are spawned on the first picture, not forked,
+    so they don't inherit the camera.
+
+    The stages of a picture run in order in one worker. Stages that change
+    the picture replace it atomically, through a hidden temporary file.
+    Temporary files left by a crash are removed on the first picture of
+    each storage. The storage then updates the size of the pictures that
+    changed, keeping their capture metadata. At most `max_pending`
+    pictures wait for a worker, the next ones are skipped.
+
+    Args:
+        stages (list[Stage]): See `parse_stages`
+        workers (int): Number of worker processes
+        max_pending (int): Maximum number of pictures waiting
+    """
+
+    def __init__(
+        self,
+        stages: typing.List[Stage],
+        workers: int = WORKERS,
+        max_pending: int = MAX_PENDING,
+    ):
+        self.stages = stages
+        self.workers = workers
+        self.max_pending = max_pending
+        self.stats: typing.Dict[str, StageStats] = {
+            name: StageStats() for name, _, _ in stages
+        }
+        self._lock = Lock()
+        self._pending: typing.Set[Future] = set()
+        self._executor: typing.Optional[ProcessPoolExecutor] = None
+        self._cleaned: typing.Set[str] = set()
+        metrics.REGISTRY.gauge(
+            "picamip_pipeline_queue_depth",
+            "Pictures waiting for the post-capture pipeline",
+            lambda: len(self),
+        )
+
+    def __len__(self):
+        return len(self._pending)
+
+    def close(self) -> None:
+        """
+        Drops the pictures waiting and waits for the ones in progress
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def submit(
+        self, pictures_storage: storage.IndexedFilesStorage, index: int
+    ) -> PipelineTask:
+        """
+        Queues a stored picture
+
+        Args:
+            pictures_storage (picamip.storage.IndexedFilesStorage)
+            index (int): Index of the picture
+        Returns:
+            task (PipelineTask)
+        """
+        task = PipelineTask(index)
+        picture = Picture(
+            pictures_storage.make_filename(index),
+            index,
+            pictures_storage.directory,
+        )
+        captured = _signature(picture.filename)
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                task.status = PipelineTask.SKIPPED
+                metrics.PIPELINE_SKIPPED.inc()
+                logger.warning(f"Pipeline is full, skipping picture {index}")
+                return task
+            if pictures_storage.directory not in self._cleaned:
+                self._cleaned.add(pictures_storage.directory)
+                remove_temporary(pictures_storage.directory)
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, multiprocessing.get_context("spawn")
+                )
+            try:
+                future = self._executor.submit(
+                    run_stages, self.stages, picture
+                )
+            except RuntimeError as error:  # Closed or broken pool
+                logger.error(f"Can't process picture {index}: {error}")
+                task.status, task.error = PipelineTask.FAILED, str(error)
+                return task
+            self._pending.add(future)
+        future.add_done_callback(
+            lambda future: self._finish(
+                future, task, pictures_storage, picture, captured
+            )
+        )
+        return task
+
+    def _finish(
+        self,
+        future: Future,
+        task: PipelineTask,
+        pictures_storage: storage.IndexedFilesStorage,
+        picture: Picture,
+        captured: typing.Optional[typing.Tuple[int, int]],
+    ) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        if future.cancelled():
+            task.status, task.error = PipelineTask.FAILED, "cancelled"
+            return
+        try:
+            results, timings, error = future.result()
+        except BrokenProcessPool as exc:
+            # A worker died, the next picture starts a new pool
+            with self._lock:
+                self._executor = None
+            results, timings, error = {}, [], repr(exc)
+        except Exception as exc:
+            results, timings, error = {}, [], repr(exc)
+        with self._lock:
+            for name, seconds in timings:
+                self.stats[name].add(seconds)
+        task.results = results
+        task.timings = dict(timings)
+        metrics.PIPELINE_SECONDS.observe(sum(task.timings.values()))
+        if error is not None:
+            logger.error(f"Pipeline failed on picture {task.index}: {error}")
+            metrics.PIPELINE_FAILURES.inc()
+            task.status, task.error = PipelineTask.FAILED, error
+        else:
+            metrics.PIPELINE_PICTURES.inc()
+            task.status = PipelineTask.DONE
+        if _signature(picture.filename) != captured:
+            pictures_storage.update(task.index)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": len(self._pending),
+                "max_pending": self.max_pending,
+                "stages": {
+                    name: stats.to_dict() for name, stats in self.stats.items()
+                },
+            }
@@ -0,0 +1,159 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+from threading import Event, Lock, Thread
+from time import monotonic
+import typing
+from urllib.parse import urlsplit, urlunsplit
+from urllib.request import Request, urlopen
+
+from werkzeug.http import parse_options_header
+
+from . import metrics, stream
+
+RELAY_TIMEOUT = 10.0
+STREAM_READY_TIMEOUT = 5.0
+# The relay keeps the upstream connection this long without viewers, so
+# viewers that reload the page don't reconnect it
+IDLE_SECONDS = 10.0
+RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+def stream_url(url: str) -> str:
+    """
+    Args:
+        url (str): Upstream picamip server, eg: http://raspberrypi:8000, or
+            its stream, eg: http://raspberrypi:8000/stream?fps=10
+    Returns:
+        url (str): Url of the upstream stream
+    Raises:
+        ValueError: not an http url
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        raise ValueError(f"relay url must be an http url, got {url}")
+    if not parts.path.endswith("/stream"):
+        parts = parts._replace(path=parts.path.rstrip("/") + "/stream")
+    return urlunsplit(parts)
+
+
+class RelayCamera(stream.StreamCamera):
+    """
+    Camera that relays the stream of another picamip server. A single
+    connection to the upstream `/stream` is kept while there are viewers,
+    and its frames are published to `stream_buffer` as they arrive,
+    without decoding them, so the upstream serves one viewer however many
+    watch the relay.
+
+    Stills are the newest frames of the stream.
+
+    Args:
+        url (str): Upstream picamip server or its stream url, see
+            `stream_url`
+        timeout (float): Seconds without data before reconnecting
+    """
+
+    def __init__(self, url: str, timeout: float = RELAY_TIMEOUT):
+        self.url = stream_url(url)
+        self.timeout = timeout
+        self._lock = Lock()
+        self._requested = 0.0
+        self._stop = Event()
+        self._thread: typing.Optional[Thread] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self.recording:
+            self.stop_recording()
+
+    @property
+    def recording(self) -> bool:
+        return self._thread is not None
+
+    def stop_recording(self) -> None:
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stop.set()
+        if thread is not None:
+            thread.join(self.timeout)
+
+    def start_stream(self) -> None:
+        """
+        Connects to the upstream stream if the relay is idle and waits for
+        the first frame
+        """
+        with self._lock:
+            self._requested = monotonic()
+            if self._thread is not None:
+                return
+            sequence = self.stream_buffer.sequence
+            self._stop.clear()
+            self._thread = Thread(target=self._relay, daemon=True)
+            self._thread.start()
+        self.stream_buffer.read_chunk(sequence, STREAM_READY_TIMEOUT)
+
+    def _idle(self) -> bool:
+        return (
+            not self.stream_buffer.clients
+            and monotonic() - self._requested > IDLE_SECONDS
+        )
+
+    def _relay(self) -> None:
+        retry = RETRY_SECONDS
+        while not self._stop.is_set():
+            with self._lock:
+                if self._idle():
+                    self._thread = None
+                    return
+            try:
+                self._connect()
+                retry = RETRY_SECONDS
+            except (OSError, ValueError) as error:
+                logger.warning(f"Relay of {self.url} failed: {error}")
+                self._stop.wait(retry)
+                retry = min(retry * 2, MAX_RETRY_SECONDS)
+
+    def _connect(self) -> None:
+        request = Request(self.url, headers={"Accept": "multipart/*"})
+        with urlopen(request, timeout=self.timeout) as response:
+            mimetype, options = parse_options_header(
+                response.headers.get("Content-Type", "")
+            )
+            boundary = options.get("boundary")
+            if mimetype != "multipart/x-mixed-replace" or not boundary:
+                raise ValueError(f"{self.url} is not a multipart stream")
+            metrics.RELAY_CONNECTIONS.inc()
+            stream_buffer = self.stream_buffer
+            for frame in stream.read_frames(response, boundary.encode()):
+                stream_buffer.publish_frame(frame)
+                if self._stop.is_set() or self._idle():
+                    return
+        raise ConnectionError(f"{self.url} closed the stream")
+
+    def camera_settings(self) -> dict:
+        return {"relay": self.url}
+
+    def capture_burst(self, filenames: typing.List[str]) -> None:
+        self.capture_frames(filenames, self.timeout)
@@ -13,62 +13,337 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
-import asyncio
+from contextlib import ExitStack
 import importlib
 import os
 from os import path
 import json
-import subprocess
-from tempfile import TemporaryDirectory
+import math
 import time
 import shutil
+import typing
+from urllib.parse import urlencode, urlsplit, urlunsplit
+import zlib
 
 import flask
+import jinja2
 from werkzeug.exceptions import NotFound
+from werkzeug.wrappers import Response
 
-from . import picamera, storage
+from . import (
+    assets,
+    capture,
+    metadata,
+    metrics,
+    motion,
+    pipeline,
+    storage,
+    stream,
+    thumbnail,
+    timelapse,
+    variants,
+    video,
+)
 
 
 ROOT = path.dirname(__file__)
+TEMPLATE_DIR = path.join(ROOT, "template")
+STATIC_DIR = path.join(ROOT, "static")
+BYTECODE_CACHE_DIR = path.join(
+    os.environ.get("XDG_CACHE_HOME", path.expanduser("~/.cache")),
+    "picamip",
+    "jinja",
+)
 BAD_REQUEST_MSG = "Could not process request"
 NOT_FOUND_MSG = "File not found"
 PICTURE_SUFFIX = ".jpg"
 INDEX_DIGITS = 4
+STREAM_HEADERS = [
+    ("Access-Control-Allow-Origin", "*"),
+    ("Age", 0),
+    ("Cache-Control", "no-cache, private"),
+    ("Pragma", "no-cache"),
+    (
+        "Content-Type",
+        "multipart/x-mixed-replace; boundary=" + stream.BOUNDARY.decode(),
+    ),
+]
+SERVERS = ["flask", "asgi"]
+MAX_BURST = 100
+MAX_WAIT = 30.0
+CAPTURE_TIMEOUT = 60.0
+CAPTURE_TIMEOUT_MSG = "Timed out waiting for the capture"
+THUMBNAIL_SIZE = 64
+PAGE_SIZE = 10
+FRAME_WAIT = 10.0
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+EXPORT_FORMATS = ["avi", "mjpeg"]
+EXPORT_FPS = 10.0
+MAX_EXPORT_FPS = 120.0
+
+
+def parse_fps(fps: typing.Optional[str]) -> typing.Optional[float]:
+    """
+    Parses the `fps` query parameter of the stream
+
+    Args:
+        fps (str): Frame rate or None
+    Returns:
+        fps (float): Positive frame rate or None
+    Raises:
+        ValueError: fps is not a positive number
+    """
+    if fps is None:
+        return None
+    value = float(fps)
+    if not value > 0:
+        raise ValueError(f"fps must be positive, got {fps}")
+    return value
+
+
+def stream_response(
+    camera: stream.StreamCamera, stream_variants: variants.StreamVariants
+) -> flask.Response:
+    """
+    Responds to GET /stream
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+        stream_variants (picamip.variants.StreamVariants)
+    Returns:
+        response (flask.Response): Stream of the camera or of the variant
+            in the query parameters
+    """
+    args = flask.request.args
+    try:
+        fps = parse_fps(args.get("fps"))
+        variant = variants.parse_variant(
+            args.get("width"), args.get("quality")
+        )
+        stream_buffer = (
+            stream_variants.get(*variant) if variant is not None else None
+        )
+    except ValueError:
+        return flask.make_response(BAD_REQUEST_MSG, 400)
+    except ImportError as error:
+        return flask.make_response(str(error), 501)
+    except LookupError as error:
+        return flask.make_response(str(error), 503)
+    resp = flask.Response(camera.stream_generator(fps, stream_buffer))
+    for header, value in STREAM_HEADERS:
+        resp.headers[header] = value
+    return resp
+
+
+def frame_response(camera: stream.StreamCamera) -> Response:
+    """
+    Responds to GET /frame.jpg
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+    Returns:
+        response (werkzeug.wrappers.Response): Newest frame, 304 if no
+            frame newer than `after` arrived
+    """
+    args = flask.request.args
+    try:
+        after = int(args.get("after", 0))
+        wait = min(float(args.get("wait", FRAME_WAIT)), MAX_WAIT)
+    except ValueError:
+        return flask.make_response(BAD_REQUEST_MSG, 400)
+    stream_buffer = camera.stream_buffer
+    camera.start_stream()
+    sequence, chunk = stream_buffer.read_chunk(after, wait, latest=True)
+    if chunk is None:
+        if after:
+            resp = flask.make_response("", 304)
+            resp.headers["X-Frame-Sequence"] = after
+            return resp
+        return flask.make_response("The stream has no frames", 503)
+    resp = flask.make_response(bytes(stream_buffer.chunk_frame(chunk)))
+    resp.headers["Content-Type"] = "image/jpeg"
+    resp.headers["Cache-Control"] = "no-cache, private"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers["X-Frame-Sequence"] = sequence
+    resp.set_etag(str(sequence))
+    return resp.make_conditional(flask.request)
+
+
+def play_response(filenames: typing.List[str], fps: float) -> flask.Response:
+    """
+    Plays JPEG files as a multipart stream, like /stream. Each file is
+    read when it's sent.
+
+    Args:
+        filenames (list[str]): JPEG files, deleted ones are skipped
+        fps (float): Frames per second
+    Returns:
+        response (flask.Response)
+    """
+
+    def generate():
+        next_time = time.monotonic()
+        for filename in filenames:
+            try:
+                with open(filename, "rb") as fp:
+                    frame = fp.read()
+            except FileNotFoundError:
+                continue
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_time += 1 / fps
+            yield stream.JpegStreamIO.frame_header(len(frame))
+            yield frame
+            yield b"\r\n"
+
+    resp = flask.Response(generate())
+    for header, value in STREAM_HEADERS:
+        resp.headers[header] = value
+    return resp
+
+
+def _stream_redirect(stream_port: int) -> Response:
+    url = urlsplit(flask.request.url)
+    host = url.hostname or "localhost"
+    if ":" in host:
+        host = f"[{host}]"
+    return flask.redirect(
+        urlunsplit(url._replace(netloc=f"{host}:{stream_port}")), 307
+    )
+
+
+def build_stream_app(camera: stream.StreamCamera) -> flask.Flask:
+    """
+    Builds the app of the stream workers, which serves only /stream and
+    /frame.jpg
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+    Returns:
+        app (flask.Flask)
+    """
+    app = flask.Flask("picamip", static_folder=None)
+    stream_variants = variants.StreamVariants(camera)
+    app.add_url_rule(
+        "/stream",
+        "stream",
+        lambda: stream_response(camera, stream_variants),
+    )
+    app.add_url_rule("/frame.jpg", "frame", lambda: frame_response(camera))
+    app.extensions["picamip"] = {
+        "camera": camera,
+        "variants": stream_variants,
+        "stream_port": None,
+        "default_routes": {"/stream", "/frame.jpg"},
+    }
+    return app
+
 
 # flake8: noqa: C901
 def build_app(
-    camera: picamera.StreamPiCamera,
+    camera: stream.StreamCamera,
     picture_dir: str,
     files_prefix: str,
     flask_template: str,
     flask_static: str,
     flask_overload: str,
     default_route: str = "index.html",
+    video_recorder: video.VideoRecorder = None,
+    pictures_storage: storage.IndexedFilesStorage = None,
+    metadata_index: metadata.MetadataIndex = None,
+    stream_port: int = None,
+    post_capture: pipeline.Pipeline = None,
 ) -> flask.Flask:
     """
     Builds flask app for picamip
 
     Args:
-        camera (picamip.picamera.StreamPiCamera)
+        camera (picamip.stream.StreamCamera)
         picture_dir (str): Directory to store the pictures
         files_prefix (str): Stored pictures prefix
-        flask_template (str): Additional templates directory
-        flask_static (str): Additional static files directory
+        flask_template (str): Additional templates directory. Its
+            templates replace the default ones with the same name
+        flask_static (str): Additional static files directory. Its
+            files replace the default ones with the same path
         flask_overload (str): Flask app functions overload
         default_route (str): Default root route. Eg: index.html
+        video_recorder (picamip.video.VideoRecorder): Adds the video
+            routes (optional)
+        pictures_storage (picamip.storage.IndexedFilesStorage): Storage
+            of the pictures. Default: a flat storage at `picture_dir`
+        metadata_index (picamip.metadata.MetadataIndex): Enables the
+            time and size filters of /files (optional)
+        stream_port (int): Redirects /stream and /frame.jpg to the stream
+            workers on this port (optional)
+        post_capture (picamip.pipeline.Pipeline): Processes the pictures
+            after they are stored (optional)
     Returns:
         app (flask.Flask): Picamip flaksk app
     """
-    pictures_storage = storage.IndexedFilesStorage(
-        picture_dir, files_prefix, PICTURE_SUFFIX, INDEX_DIGITS
+    if pictures_storage is None:
+        pictures_storage = storage.IndexedFilesStorage(
+            picture_dir, files_prefix, PICTURE_SUFFIX, INDEX_DIGITS
+        )
+    capture_queue = capture.CaptureQueue(
+        camera, pictures_storage, post_capture=post_capture
     )
-    app = flask.Flask(
-        "picamip",
-        template_folder=flask_template,
-        static_folder=flask_static,
-        static_url_path="/static",
+    thumbnails = thumbnail.ThumbnailCache(pictures_storage)
+    scheduler = timelapse.TimelapseScheduler(capture_queue)
+    motion_monitor = motion.MotionMonitor(camera, capture_queue)
+    stream_variants = variants.StreamVariants(camera)
+    app = flask.Flask("picamip", static_folder=None)
+    app.jinja_loader = jinja2.ChoiceLoader(  # type: ignore
+        [
+            jinja2.FileSystemLoader(directory)
+            for directory in [flask_template, TEMPLATE_DIR]
+            if directory is not None
+        ]
+    )
+    static_assets = assets.AssetIndex(
+        [
+            directory
+            for directory in [flask_static, STATIC_DIR]
+            if directory is not None
+        ]
     )
 
+    def static(filename):
+        """
+        GET:
+            Serves a static file, precompressed with gzip or brotli when
+            the client accepts it (see `python -m picamip.assets`)
+
+            Query parameters:
+                v (str): Fingerprint of the file. Responses to
+                    fingerprinted URLs are cached as immutable
+        """
+        asset = static_assets.get(filename)
+        if asset is None:
+            return flask.make_response(NOT_FOUND_MSG, 404)
+        encoding, filename = asset.negotiate(flask.request.accept_encodings)
+        resp = flask.send_file(
+            filename,
+            mimetype=asset.mimetype,
+            conditional=True,
+            etag=f"{asset.fingerprint}-{encoding or 'identity'}",
+        )
+        if encoding is not None:
+            resp.headers["Content-Encoding"] = encoding
+        resp.vary.add("Accept-Encoding")
+        versioned = flask.request.args.get("v") == asset.fingerprint
+        return _cache_headers(resp, versioned)
+
+    app.add_url_rule("/static/<path:filename>", "static", static)
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        # url_for("static", filename=...) links to the fingerprinted URL
+        if endpoint == "static" and "v" not in values:
+            version = static_assets.fingerprint(values.get("filename", ""))
+            if version is not None:
+                values["v"] = version
+
     # Run overloads
     if flask_overload is not None:
         if not path.isfile(flask_overload):
@@ -91,6 +366,42 @@ def build_app(
         for fn in overload_functions.values():
             fn(app, camera)
     urls = app.url_map.bind("localhost", "/")
+    default_routes: typing.Set[str] = set()
+    app.extensions["picamip"] = {
+        "camera": camera,
+        "storage": pictures_storage,
+        "capture_queue": capture_queue,
+        "thumbnails": thumbnails,
+        "timelapse": scheduler,
+        "motion": motion_monitor,
+        "variants": stream_variants,
+        "assets": static_assets,
+        "video": video_recorder,
+        "metadata": metadata_index,
+        "pipeline": post_capture,
+        "stream_port": stream_port,
+        "default_routes": default_routes,
+    }
+    metrics.REGISTRY.gauge(
+        "picamip_stream_clients",
+        "Connected stream viewers",
+        lambda: len(camera.stream_buffer.clients),
+    )
+    metrics.REGISTRY.gauge(
+        "picamip_stream_variant_clients",
+        "Viewers of the re-encoded stream variants",
+        lambda: stream_variants.clients,
+    )
+    metrics.REGISTRY.gauge(
+        "picamip_storage_pictures",
+        "Stored pictures",
+        lambda: len(pictures_storage),
+    )
+    metrics.REGISTRY.gauge(
+        "picamip_capture_queue_depth",
+        "Capture jobs waiting for the camera",
+        lambda: len(capture_queue),
+    )
 
     def try_route(r, methods=["GET", "POST"]):
         def wrap(fn):
@@ -101,61 +412,261 @@ def build_app(
                 )
             except NotFound:
                 app.add_url_rule(r, methods=methods, view_func=fn)
+                default_routes.add(r)
 
         return wrap
 
+    def _conditional(etag, build):
+        """
+        Answers 304 when the client has `etag`, otherwise builds the
+        response with `build()`
+        """
+        if flask.request.if_none_match.contains(etag):
+            resp = flask.make_response("", 304)
+        else:
+            resp = flask.make_response(build())
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
+    def _version(index):
+        try:
+            return pictures_storage.version(index)
+        except KeyError:
+            return ""
+
     # Declare default routes
     @try_route("/", methods=["GET"])
     def index():
-        return flask.render_template(
-            default_route,
-            files=list(sorted(pictures_storage, key=lambda x: -x[0])),
+        """
+        GET:
+            Renders `default_route` with a page of the stored pictures
+
+            Query parameters:
+                page (int): Page number, starting at 1 (optional)
+        """
+        try:
+            page = max(int(flask.request.args.get("page", 1)), 1)
+        except ValueError:
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        pages = max(math.ceil(len(pictures_storage) / PAGE_SIZE), 1)
+        page = min(page, pages)
+        return _conditional(
+            f"{pictures_storage.etag}-{page}",
+            lambda: flask.render_template(
+                default_route,
+                files=[
+                    (index, path.basename(filename), _version(index))
+                    for index, filename in pictures_storage.page(
+                        PAGE_SIZE, (page - 1) * PAGE_SIZE, reverse=True
+                    )
+                ],
+                page=page,
+                pages=pages,
+            ),
         )
 
     @try_route("/files", methods=["GET"])
     def files():
-        return flask.make_response(
-            json.dumps(list(sorted(pictures_storage, key=lambda x: x[0])))
+        """
+        GET:
+            Lists the stored pictures as [[index, filename], ...]
+
+            Query parameters:
+                limit (int): Maximum number of files (optional)
+                offset (int): Number of files to skip (optional)
+                after (int): Only indexes larger than `after` (optional)
+                before (int): Only indexes smaller than `before` (optional)
+                order (str): "asc" or "desc" (optional)
+
+            With the metadata index (--metadata):
+                since (str): Only captured at or after `since`, in
+                    seconds since the epoch or ISO 8601 (optional)
+                until (str): Only captured before `until` (optional)
+                min_size (int): Only files of at least `min_size` bytes
+                    (optional)
+                max_size (int): Only files of at most `max_size` bytes
+                    (optional)
+                details (bool): Lists
+                    [{index, filename, captured, size, width, height,
+                    settings}, ...] instead (optional)
+        """
+        args = flask.request.args
+        filters: typing.Dict[str, typing.Any] = {}
+        try:
+            page_args = {
+                name: int(args[name]) if name in args else None
+                for name in ["limit", "after", "before"]
+            }
+            page_args["offset"] = int(args.get("offset", 0))
+            for name in ["since", "until"]:
+                if name in args:
+                    filters[name] = metadata.parse_time(args[name])
+            for name in ["min_size", "max_size"]:
+                if name in args:
+                    filters[name] = int(args[name])
+        except ValueError:
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        details = args.get("details", "false").lower() == "true"
+        if (filters or details) and metadata_index is None:
+            return flask.make_response("The metadata index is disabled", 400)
+        reverse = args.get("order", "asc").lower() == "desc"
+        etag = "{}-{:08x}".format(
+            pictures_storage.etag, zlib.crc32(flask.request.query_string)
         )
+        listing: typing.List[typing.Any] = []
+        total = [len(pictures_storage)]
+
+        def build():
+            if filters or details:
+                total[0], pictures = metadata_index.query(
+                    **page_args, **filters, reverse=reverse
+                )
+                if details:
+                    listing.extend(pictures)
+                else:
+                    listing.extend(
+                        (picture["index"], picture["filename"])
+                        for picture in pictures
+                    )
+            else:
+                listing.extend(
+                    (index, path.basename(filename))
+                    for index, filename in pictures_storage.page(
+                        **page_args, reverse=reverse
+                    )
+                )
+            return json.dumps(listing)
+
+        resp = _conditional(etag, build)
+        resp.headers["Content-Type"] = "application/json"
+        resp.headers["X-Total-Count"] = total[0]
+        limit = page_args["limit"]
+        if listing and limit is not None and len(listing) == limit:
+            cursor = "before" if reverse else "after"
+            last = listing[-1]
+            next_args = {
+                name: value
+                for name, value in args.items()
+                if name not in ["after", "before", "offset"]
+            }
+            next_args.update(
+                {
+                    cursor: last["index"] if details else last[0],
+                    "limit": limit,
+                    "order": "desc" if reverse else "asc",
+                }
+            )
+            root = flask.request.script_root
+            resp.headers["Link"] = (
+                f'<{root}/files?{urlencode(next_args)}>; rel="next"'
+            )
+        return resp
 
     @try_route("/stream", methods=["GET"])
     def stream():
-        resp = flask.Response(camera.stream_generator())
-        resp.headers["Access-Control-Allow-Origin"] = "*"
-        resp.headers["Age"] = 0
-        resp.headers["Cache-Control"] = "no-cache, private"
-        resp.headers["Pragma"] = "no-cache"
-        resp.headers[
-            "Content-Type"
-        ] = "multipart/x-mixed-replace; boundary=FRAME"
+        """
+        GET:
+            Camera preview (mjpeg)
+
+            Query parameters:
+                fps (float): Maximum frame rate (optional)
+                width (int): Downscales the frames to at most `width`
+                    pixels wide (optional)
+                quality (int): JPEG quality of the downscaled frames,
+                    1-95 (optional)
+        """
+        if stream_port is not None:
+            return _stream_redirect(stream_port)
+        return stream_response(camera, stream_variants)
+
+    @try_route("/frame.jpg", methods=["GET"])
+    def frame():
+        """
+        GET:
+            Latest frame of the stream, from memory. The sequence number
+            of the frame is sent in X-Frame-Sequence and as the ETag.
+
+            Query parameters:
+                after (int): Waits for a frame newer than the sequence
+                    `after`, responds 304 if none arrives (optional)
+                wait (float): Maximum seconds to wait (optional)
+        """
+        if stream_port is not None:
+            return _stream_redirect(stream_port)
+        return frame_response(camera)
+
+    def _cache_headers(resp, versioned):
+        """
+        Versioned URLs never change, the others are revalidated with the
+        ETag
+        """
+        if versioned:
+            resp.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            resp.headers["Cache-Control"] = "no-cache"
         return resp
 
     def _picture_get():
-        index = flask.request.args.get("index")
-        download = flask.request.args.get("download", "false").lower()
+        args = flask.request.args
+        download = args.get("download", "false").lower()
         as_attachment = download in ["true", "1"]
-        if index == "-1":
-            index = pictures_storage.last_index
         try:
-            index = int(index)
-        except TypeError:
+            index = int(args.get("index"))
+        except (TypeError, ValueError):
             return flask.make_response(BAD_REQUEST_MSG, 400)
-        if index not in pictures_storage:
+        if index == -1:
+            index = pictures_storage.last_index
+            if index not in pictures_storage:
+                return flask.make_response(NOT_FOUND_MSG, 404)
+            resp = flask.redirect(
+                f"{flask.request.script_root}/picture?index={index}"
+                + f"&download={download}"
+                + f"&v={pictures_storage.version(index)}"
+            )
+            return _cache_headers(resp, False)
+        try:
+            version = pictures_storage.version(index)
+        except KeyError:
             return flask.make_response(NOT_FOUND_MSG, 404)
-        basename = path.basename(pictures_storage.make_filename(index))
-        return flask.send_from_directory(
-            picture_dir, basename, as_attachment=as_attachment
+        # send_file answers If-None-Match and Range requests and hands
+        # the file to wsgi.file_wrapper (sendfile) when the server has it
+        resp = flask.send_file(
+            path.join(pictures_storage.directory, pictures_storage[index]),
+            mimetype="image/jpeg",
+            as_attachment=as_attachment,
+            conditional=True,
+            etag=f"{index}-{version}",
         )
+        return _cache_headers(resp, args.get("v") == version)
+
+    def _wants_json():
+        accept = flask.request.accept_mimetypes
+        return accept.accept_json and not accept.accept_html
 
     def _picture_post():
-        filename = pictures_storage.next_filename
         try:
-            camera.capture(filename)
-        except picamera.exc.PiCameraValueError:
-            app.logger.warning("To many clicks! Ignoring request...")
-        except picamera.exc.PiCameraAlreadyRecording:
-            app.logger.info("Ok! Camera already recording")
-        return flask.redirect("/")
+            burst = int(flask.request.args.get("burst", 1))
+        except ValueError:
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        if not 0 < burst <= MAX_BURST:
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        try:
+            job = capture_queue.submit(burst)
+        except IndexError as error:
+            return flask.make_response(str(error), 507)
+        if _wants_json():
+            resp = flask.make_response(json.dumps(job.to_dict()), 202)
+            resp.headers["Content-Type"] = "application/json"
+            resp.headers["Location"] = (
+                f"{flask.request.script_root}/pictureStatus?job={job.job_id}"
+            )
+            return resp
+        if not job.wait(CAPTURE_TIMEOUT):
+            return flask.make_response(CAPTURE_TIMEOUT_MSG, 504)
+        if job.status == job.FAILED:
+            return flask.make_response(job.error, 500)
+        return flask.redirect(f"{flask.request.script_root}/")
 
     @try_route("/picture", methods=["GET", "POST"])
     def picture():
@@ -171,6 +682,8 @@ def build_app(
 
             Query parameters:
                 download: Download the file (optional)
+                burst (int): Number of pictures to take back to back
+                    (optional)
         """
         if flask.request.method == "GET":
             response = _picture_get()
@@ -178,14 +691,347 @@ def build_app(
             response = _picture_post()
         return response
 
+    @try_route("/thumbnail", methods=["GET"])
+    def thumbnail_get():
+        """
+        GET:
+            Gets a thumbnail of a stored picture
+
+            Query parameters:
+                index (int): Index of the picture
+                size (int): Maximum width and height (optional)
+        """
+        try:
+            index = int(flask.request.args.get("index"))
+            size = int(flask.request.args.get("size", THUMBNAIL_SIZE))
+        except (TypeError, ValueError):
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        try:
+            key, data = thumbnails.get(index, size)
+        except KeyError:
+            return flask.make_response(NOT_FOUND_MSG, 404)
+        except LookupError:
+            return flask.redirect(
+                f"{flask.request.script_root}/picture?index={index}"
+            )
+        resp = flask.make_response(data)
+        resp.headers["Content-Type"] = "image/jpeg"
+        resp.set_etag("-".join(str(k) for k in key))
+        versioned = flask.request.args.get("v") == f"{key[2]:x}"
+        return _cache_headers(resp.make_conditional(flask.request), versioned)
+
+    @try_route("/pictureStatus", methods=["GET"])
+    def pictureStatus():
+        """
+        GET:
+            Gets the status of a capture job
+
+            Query parameters:
+                job (int): Job id returned by POST /picture
+                wait (float): Seconds to wait for the job to finish
+                    (optional)
+        """
+        try:
+            job_id = int(flask.request.args.get("job"))
+            wait = min(float(flask.request.args.get("wait", 0)), MAX_WAIT)
+        except (TypeError, ValueError):
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        try:
+            job = capture_queue[job_id]
+        except KeyError:
+            return flask.make_response(NOT_FOUND_MSG, 404)
+        if wait > 0:
+            job.wait(wait)
+        resp = flask.make_response(json.dumps(job.to_dict()))
+        resp.headers["Content-Type"] = "application/json"
+        return resp
+
+    def _timelapse_status():
+        resp = flask.make_response(json.dumps(scheduler.to_dict()))
+        resp.headers["Content-Type"] = "application/json"
+        return resp
+
+    @try_route("/timelapseStart", methods=["POST"])
+    def timelapseStart():
+        """
+        POST:
+            Starts a time-lapse, replacing the running one
+
+            Query parameters:
+                interval (float): Seconds between pictures
+                count (int): Number of pictures (optional)
+        """
+        args = flask.request.args
+        try:
+            interval = float(args.get("interval"))
+            count = int(args["count"]) if "count" in args else None
+            scheduler.start(interval, count)
+        except (TypeError, ValueError):
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        return _timelapse_status()
+
+    @try_route("/timelapseStop", methods=["POST"])
+    def timelapseStop():
+        """
+        POST:
+            Stops the time-lapse
+        """
+        scheduler.stop()
+        return _timelapse_status()
+
+    @try_route("/timelapseStatus", methods=["GET"])
+    def timelapseStatus():
+        """
+        GET:
+            Gets the status of the time-lapse
+        """
+        return _timelapse_status()
+
+    def _motion_status():
+        resp = flask.make_response(json.dumps(motion_monitor.to_dict()))
+        resp.headers["Content-Type"] = "application/json"
+        return resp
+
+    @try_route("/motionStart", methods=["POST"])
+    def motionStart():
+        """
+        POST:
+            Starts the motion detection, replacing the running one
+
+            Query parameters:
+                source (str): "yuv" or "mjpeg" (optional)
+                threshold (float): Luma difference of a changed pixel,
+                    0-255 (optional)
+                min_area (float): Fraction of the region that must change
+                    (optional)
+                roi (str): Region of interest as x,y,width,height in
+                    fractions of the frame (optional)
+                cooldown (float): Seconds between captures (optional)
+        """
+        args = flask.request.args
+        try:
+            options = {
+                name: float(args[name])
+                for name in ["threshold", "min_area", "cooldown"]
+                if name in args
+            }
+            if "roi" in args:
+                options["roi"] = motion.parse_roi(args["roi"])
+            motion_monitor.start(args.get("source"), **options)
+        except ValueError:
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        except ImportError as error:
+            return flask.make_response(str(error), 501)
+        return _motion_status()
+
+    @try_route("/motionStop", methods=["POST"])
+    def motionStop():
+        """
+        POST:
+            Stops the motion detection
+        """
+        motion_monitor.stop()
+        return _motion_status()
+
+    @try_route("/motionStatus", methods=["GET"])
+    def motionStatus():
+        """
+        GET:
+            Gets the status of the motion detection
+        """
+        return _motion_status()
+
+    if video_recorder is not None:
+        videos = video_recorder.storage
+
+        @try_route("/video", methods=["GET"])
+        def video_get():
+            """
+            GET:
+                Gets a stored video segment or clip (raw H.264)
+
+                Query parameters:
+                    index (int): Index of the video
+            """
+            try:
+                index = int(flask.request.args.get("index"))
+                version = videos.version(index)
+            except (TypeError, ValueError):
+                return flask.make_response(BAD_REQUEST_MSG, 400)
+            except KeyError:
+                return flask.make_response(NOT_FOUND_MSG, 404)
+            return flask.send_file(
+                path.join(videos.directory, videos[index]),
+                mimetype="video/h264",
+                as_attachment=True,
+                conditional=True,
+                etag=f"{index}-{version}",
+            )
+
+        @try_route("/videoStatus", methods=["GET"])
+        def videoStatus():
+            """
+            GET:
+                Gets the status of the video recording and the stored
+                videos as [[index, filename], ...]
+            """
+            status = video_recorder.to_dict()
+            status["videos"] = [
+                (index, path.basename(filename)) for index, filename in videos
+            ]
+            resp = flask.make_response(json.dumps(status))
+            resp.headers["Content-Type"] = "application/json"
+            return resp
+
+        @try_route("/videoTrigger", methods=["POST"])
+        def videoTrigger():
+            """
+            POST:
+                Writes the circular buffer (the last seconds of video) to
+                a clip
+            """
+            try:
+                index = video_recorder.trigger()
+            except RuntimeError as error:
+                return flask.make_response(str(error), 409)
+            except IndexError as error:
+                return flask.make_response(str(error), 507)
+            resp = flask.make_response(json.dumps({"index": index}), 201)
+            resp.headers["Content-Type"] = "application/json"
+            resp.headers["Location"] = (
+                f"{flask.request.script_root}/video?index={index}"
+            )
+            return resp
+
+    if post_capture is not None:
+
+        @try_route("/pipelineStatus", methods=["GET"])
+        def pipelineStatus():
+            """
+            GET:
+                Gets the queue depth and the timings of each stage of the
+                post-capture pipeline. The results of each picture are in
+                /pictureStatus
+            """
+            resp = flask.make_response(json.dumps(post_capture.to_dict()))
+            resp.headers["Content-Type"] = "application/json"
+            return resp
+
+    def _selected_indexes():
+        """
+        Parses the `indexes` (comma separated) or `from` and `to` query
+        parameters. Returns None when no selection was made.
+        """
+        args = flask.request.args
+        if "indexes" in args:
+            return [int(i) for i in args["indexes"].split(",") if i.strip()]
+        if "from" in args or "to" in args:
+            start = int(args.get("from", 0))
+            stop = int(args.get("to", pictures_storage.last_index))
+            return [i for i in pictures_storage.indexes if start <= i <= stop]
+        return None
+
     @try_route("/downloadAll", methods=["GET"])
     def downloadAll():
-        with TemporaryDirectory() as tmpdir:
-            zipfile = f"{files_prefix}.zip"
-            pictures_storage.zip(path.join(tmpdir, zipfile))
-            return flask.send_from_directory(
-                tmpdir, zipfile, as_attachment=True
+        """
+        GET:
+            Streams a zip file with the stored pictures. Supports byte
+            ranges to resume downloads.
+
+            Query parameters:
+                indexes (str): Comma separated indexes (optional)
+                from (int): First index (optional)
+                to (int): Last index (optional)
+        """
+        try:
+            indexes = _selected_indexes()
+        except ValueError:
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        return _ranged_response(
+            pictures_storage.zip_stream(indexes),
+            "application/zip",
+            f"{files_prefix}.zip",
+        )
+
+    @try_route("/export", methods=["GET"])
+    def export():
+        """
+        GET:
+            Streams the stored pictures as a MJPEG video, one picture per
+            frame, without re-encoding them. The AVI supports byte ranges,
+            so players can seek in it.
+
+            Query parameters:
+                indexes (str): Comma separated indexes (optional)
+                from (int): First index (optional)
+                to (int): Last index (optional)
+                fps (float): Frames per second (optional)
+                format (str): "avi" or "mjpeg", a multipart stream played
+                    at `fps`, for browsers (optional)
+        """
+        args = flask.request.args
+        try:
+            indexes = _selected_indexes()
+            fps = float(args.get("fps", EXPORT_FPS))
+        except ValueError:
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        export_format = args.get("format", EXPORT_FORMATS[0])
+        if not 0 < fps <= MAX_EXPORT_FPS or export_format not in (
+            EXPORT_FORMATS
+        ):
+            return flask.make_response(BAD_REQUEST_MSG, 400)
+        avi_stream = pictures_storage.avi_stream(indexes, fps)
+        if not avi_stream.frames:
+            return flask.make_response(NOT_FOUND_MSG, 404)
+        if export_format == "mjpeg":
+            return play_response(
+                [frame.filename for frame in avi_stream.frames], fps
+            )
+        return _ranged_response(
+            avi_stream, "video/x-msvideo", f"{files_prefix}.avi"
+        )
+
+    def _ranged_response(body, mimetype, filename):
+        """
+        Streams `body`, a `picamip.zipstream.ZipStream` or
+        `picamip.avistream.AviStream`, with support for byte ranges
+        """
+        length = len(body)
+        etag = body.etag
+
+        start, stop, status = 0, length, 200
+        byte_range = flask.request.range
+        if_range = flask.request.if_range
+        # There is no Last-Modified, so an If-Range date never matches
+        if (
+            byte_range is not None
+            and if_range.date is None
+            and if_range.etag in (None, etag)
+        ):
+            span = byte_range.range_for_length(length)
+            if span is None:
+                resp = flask.make_response("", 416)
+                resp.headers["Content-Range"] = f"bytes */{length}"
+                return resp
+            start, stop = span
+            status = 206
+
+        resp = flask.Response(
+            body.generate(start, stop),
+            status=status,
+            mimetype=mimetype,
+        )
+        resp.headers["Content-Length"] = stop - start
+        resp.headers["Accept-Ranges"] = "bytes"
+        resp.headers["Content-Disposition"] = (
+            f"attachment; filename={filename}"
+        )
+        resp.set_etag(etag)
+        if status == 206:
+            resp.headers["Content-Range"] = (
+                f"bytes {start}-{stop - 1}/{length}"
             )
+        return resp
 
     @try_route("/deleteAll", methods=["DELETE"])
     def deleteAll():
@@ -205,6 +1051,17 @@ def build_app(
         pictures_storage.delete_index(index)
         return flask.make_response()
 
+    @try_route("/metrics", methods=["GET"])
+    def metrics_get():
+        """
+        GET:
+            Metrics in the Prometheus text format
+        """
+        resp = flask.make_response(metrics.REGISTRY.render())
+        resp.headers["Content-Type"] = metrics.CONTENT_TYPE
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
     @try_route("/brewCoffee")
     def brewCoffee():
         return flask.make_response("I'm a teapot", 418)
@@ -215,6 +1072,9 @@ def build_app(
         return flask.render_template("shutdown.html")
 
     def sleep_then_shutdown(timeout: int):
+        import asyncio
+        import subprocess
+
         def _shutdown():
             time.sleep(timeout)
             app.logger.warning("Shutting down!")
@@ -227,14 +1087,6 @@ def build_app(
     return app
 
 
-def _linktree(src, dst):
-    for f in os.listdir(src):
-        _dst = path.join(dst, f)
-        if path.exists(_dst):
-            os.remove(_dst)
-        os.symlink(path.join(src, f), _dst)
-
-
 def run(
     host: str,
     port: int,
@@ -244,6 +1096,33 @@ def run(
     flask_static: str = None,
     flask_overload: str = None,
     default_route: str = "index.html",
+    server: str = "flask",
+    capture_mode: str = "restart",
+    timelapse_interval: float = None,
+    timelapse_count: int = None,
+    video_dir: str = None,
+    video_mode: str = "segments",
+    video_segment: float = video.SEGMENT_SECONDS,
+    video_pre_event: float = video.PRE_EVENT_SECONDS,
+    video_max_files: int = None,
+    video_max_bytes: int = None,
+    storage_layout: str = "flat",
+    max_pictures: int = None,
+    max_bytes: int = None,
+    max_age: float = None,
+    metadata_db: bool = False,
+    motion_detection: bool = False,
+    motion_source: str = None,
+    motion_threshold: float = motion.MOTION_THRESHOLD,
+    motion_area: float = motion.MOTION_AREA,
+    motion_roi: motion.Roi = None,
+    motion_cooldown: float = motion.MOTION_COOLDOWN,
+    relay_url: str = None,
+    stream_workers: int = 0,
+    stream_port: int = None,
+    cameras: typing.List[typing.Tuple[str, str, typing.Optional[str]]] = None,
+    pipeline_stages: typing.List[str] = None,
+    pipeline_workers: int = pipeline.WORKERS,
 ) -> None:
     """
     Builds and starts the flask app for picamip
@@ -257,31 +1136,247 @@ def run(
         flask_static (str): Additional static files directory
         flask_overload (str): Flask app functions overload
         default_route (str): Default root route. Eg: index.html
+        server (str): "flask" for the flask development server or "asgi"
+            for the asyncio server, which serves many stream viewers
+            from a single producer task
+        capture_mode (str): "restart" stops the stream to take stills,
+            "video_port" takes them from the video port while streaming
+        timelapse_interval (float): Starts a time-lapse with a picture
+            every `timelapse_interval` seconds (optional)
+        timelapse_count (int): Number of pictures of the time-lapse
+            (optional)
+        video_dir (str): Records H.264 video to `video_dir` (optional).
+            Requires the "video_port" capture mode.
+        video_mode (str): "segments" records continuously in files of
+            `video_segment` seconds. "circular" keeps the last
+            `video_pre_event` seconds in memory and writes them on
+            POST /videoTrigger
+        video_segment (float): Seconds per segment
+        video_pre_event (float): Seconds kept by the circular buffer
+        video_max_files (int): Maximum number of videos kept (optional)
+        video_max_bytes (int): Maximum size of the videos kept (optional)
+        storage_layout (str): "flat" keeps the pictures in `picture_dir`,
+            up to 9999. "sharded" keeps them in subdirectories, without
+            limit
+        max_pictures (int): Deletes the oldest pictures when there are
+            more (optional)
+        max_bytes (int): Deletes the oldest pictures when they take more
+            bytes (optional)
+        max_age (float): Deletes the pictures older than `max_age`
+            seconds (optional)
+        metadata_db (bool): Keeps an SQLite index of the pictures
+            metadata, to filter /files by capture time and size
+        motion_detection (bool): Takes a picture when there is motion
+        motion_source (str): "yuv" analyzes frames from a splitter port
+            (requires the "video_port" capture mode), "mjpeg" decodes the
+            stream. Default: "yuv" when possible
+        motion_threshold (float): Luma difference of a changed pixel
+        motion_area (float): Fraction of the region that must change
+        motion_roi (tuple[float, float, float, float]): Region of
+            interest as (x, y, width, height) fractions (optional)
+        motion_cooldown (float): Seconds between motion captures
+        relay_url (str): Relays the stream of another picamip server
+            instead of using the camera, eg: http://raspberrypi:8000
+            (optional). Pictures are the newest frames of the stream.
+        stream_workers (int): Serves /stream and /frame.jpg from this
+            many worker processes, which read the frames from shared
+            memory. The app redirects those routes to them
+        stream_port (int): Port of the stream workers. Default: port + 1
+        cameras (list[tuple[str, str, str]]): Serves several cameras,
+            as (name, source, argument), see
+            `picamip.cameras.parse_camera`. Each camera is served at
+            /cam/<name>/ and stores its pictures in `picture_dir`/<name>,
+            the first one is also served at /. Default: the Raspberry Pi
+            camera
+        pipeline_stages (list[str]): Processes the pictures after they
+            are stored, in this order, see `picamip.pipeline.parse_stages`
+            (optional)
+        pipeline_workers (int): Number of pipeline worker processes
     """
-    with picamera.StreamPiCamera() as camera, TemporaryDirectory() as template_tmp, TemporaryDirectory() as static_tmp:
+    if server not in SERVERS:
+        raise ValueError(f"server must be one of {SERVERS}")
+    if capture_mode not in stream.CAPTURE_MODES:
+        raise ValueError(
+            f"capture_mode must be one of {stream.CAPTURE_MODES}"
+        )
+    if storage_layout not in storage.STORAGE_LAYOUTS:
+        raise ValueError(
+            f"storage_layout must be one of {storage.STORAGE_LAYOUTS}"
+        )
+    if video_dir is not None and capture_mode != "video_port":
+        raise ValueError("video recording requires capture_mode video_port")
+    if stream_workers < 0:
+        raise ValueError("stream_workers must not be negative")
+    if stream_workers and stream_port is None:
+        stream_port = port + 1
+    if cameras and relay_url is not None:
+        raise ValueError("relay_url can't be used with cameras, add a relay")
+    if cameras and len(cameras) > 1 and stream_workers:
+        raise ValueError("stream workers serve a single camera")
+    if pipeline_workers < 1:
+        raise ValueError("pipeline_workers must be positive")
+    stages = pipeline.parse_stages(pipeline_stages or [])
+    post_capture = None
 
-        base_template = path.join(ROOT, "template")
-        _linktree(base_template, template_tmp)
-        if flask_template is not None:
-            _linktree(path.abspath(flask_template), template_tmp)
+    def serve_camera(
+        stack: ExitStack,
+        camera: stream.StreamCamera,
+        picture_dir: str,
+        video_dir: str = None,
+    ) -> flask.Flask:
+        """
+        Builds the app of a camera and starts its services. They are
+        stopped when `stack` closes.
+        """
+        camera.capture_mode = capture_mode
+        retention: typing.Dict[str, typing.Any] = dict(
+            max_count=max_pictures, max_bytes=max_bytes, max_age=max_age
+        )
+        pictures_storage: storage.IndexedFilesStorage
+        if storage_layout == "sharded":
+            pictures_storage = storage.ShardedFilesStorage(
+                picture_dir,
+                files_prefix,
+                PICTURE_SUFFIX,
+                INDEX_DIGITS,
+                **retention,
+            )
+        else:
+            pictures_storage = storage.IndexedFilesStorage(
+                picture_dir,
+                files_prefix,
+                PICTURE_SUFFIX,
+                INDEX_DIGITS,
+                **retention,
+            )
+
+        metadata_index = None
+        if metadata_db:
+            metadata_index = metadata.MetadataIndex(pictures_storage, camera)
+            stack.callback(metadata_index.close)
+
+        @stack.callback
+        def stop_camera():
+            if camera.recording:
+                camera.stop_recording()
 
-        base_static = path.join(ROOT, "static")
-        _linktree(base_static, static_tmp)
-        if flask_static is not None:
-            _linktree(path.abspath(flask_static), static_tmp)
+        video_recorder = None
+        if video_dir is not None:
+            if not camera.splitter_ports:
+                raise ValueError("video recording requires a Pi camera")
+            video_recorder = video.VideoRecorder(
+                camera,
+                storage.IndexedFilesStorage(
+                    video_dir,
+                    files_prefix,
+                    video.VIDEO_SUFFIX,
+                    video.VIDEO_INDEX_DIGITS,
+                    max_count=video_max_files,
+                    max_bytes=video_max_bytes,
+                ),
+                video_mode,
+                video_segment,
+                video_pre_event,
+            )
 
         app = build_app(
             camera,
             picture_dir,
             files_prefix,
-            template_tmp,
-            static_tmp,
+            path.abspath(flask_template) if flask_template else None,
+            path.abspath(flask_static) if flask_static else None,
             flask_overload,
             default_route,
+            video_recorder,
+            pictures_storage,
+            metadata_index,
+            stream_port if stream_workers else None,
+            post_capture,
         )
-
+        # Templates compiled on a previous run are loaded from the cache
         try:
+            os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+            app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(
+                BYTECODE_CACHE_DIR
+            )
+        except OSError as error:
+            app.logger.warning(f"Jinja bytecode cache disabled: {error}")
+        if video_recorder is not None:
+            video_recorder.start()
+            stack.callback(video_recorder.stop)
+        motion_monitor = app.extensions["picamip"]["motion"]
+        if motion_detection:
+            motion_monitor.start(
+                motion_source,
+                motion_threshold,
+                motion_area,
+                motion_roi,
+                motion_cooldown,
+            )
+        stack.callback(motion_monitor.stop)
+        scheduler = app.extensions["picamip"]["timelapse"]
+        if timelapse_interval is not None:
+            scheduler.start(timelapse_interval, timelapse_count)
+        stack.callback(scheduler.stop)
+        return app
+
+    # Closes in reverse order: services, then cameras
+    with ExitStack() as stack:
+        if stages:
+            # Shared by the cameras, it finishes after their captures
+            post_capture = pipeline.Pipeline(stages, pipeline_workers)
+            stack.callback(post_capture.close)
+        mounts = None
+        if cameras:
+            from . import cameras as camera_sources
+
+            registry = camera_sources.CameraRegistry()
+            for name, source, argument in cameras:
+                camera = stack.enter_context(
+                    camera_sources.open_camera(source, argument)  # type: ignore
+                )
+                registry.add(name, source, camera)
+                camera_dirs = [path.join(picture_dir, name)]
+                if video_dir is not None:
+                    camera_dirs.append(path.join(video_dir, name))
+                for directory in camera_dirs:
+                    os.makedirs(directory, exist_ok=True)
+                registry.mount(name, serve_camera(stack, camera, *camera_dirs))
+            app = registry.default_app
+            mounts = registry.mounts
+        else:
+            if relay_url is not None:
+                from . import relay
+
+                camera = stack.enter_context(relay.RelayCamera(relay_url))
+            else:
+                from . import picamera
+
+                camera = stack.enter_context(picamera.StreamPiCamera())
+            app = serve_camera(stack, camera, picture_dir, video_dir)
+
+        if stream_workers:
+            from . import shared
+
+            ring = shared.SharedFrameRing()
+            stack.callback(ring.close)
+            shared.collect_worker_metrics(ring)
+            publisher = shared.RingPublisher(camera, ring)
+            publisher.start()
+            stack.callback(publisher.stop)
+            for worker in shared.start_workers(
+                ring, host, stream_port, server, stream_workers
+            ):
+                stack.callback(worker.join)
+                stack.callback(worker.terminate)
+
+        if server == "asgi":
+            from . import asgi
+
+            asgi.serve(app, host, port, mounts=mounts)
+        elif mounts:
+            from werkzeug.serving import run_simple
+
+            run_simple(host, port, registry.wsgi_app(), threaded=True)
+        else:
             app.run(host=host, port=port, use_reloader=False)
-        finally:
-            if camera.recording:
-                camera.stop_recording()
@@ -0,0 +1,463 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Serves the stream from worker processes. The process that owns the camera
+publishes the frames to a ring in shared memory and the workers, which
+don't hold the GIL of the camera process, serve /stream and /frame.jpg
+from it.
+"""
+
+import logging
+import multiprocessing
+from multiprocessing.process import BaseProcess
+import socket
+import struct
+from threading import Event, Lock, Thread
+import time
+import typing
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python 3.7
+    shared_memory = None  # type: ignore
+
+from . import metrics, server, stream
+
+RING_SLOTS = stream.RING_SIZE
+SLOT_BYTES = 1024 * 1024
+# Workers without a wakeup semaphore check the ring at this interval
+POLL_INTERVAL = 0.005
+# Workers with viewers renew their request for frames at this interval,
+# the camera process keeps streaming until IDLE_SECONDS after the last one
+REQUEST_INTERVAL = 1.0
+IDLE_SECONDS = 5.0
+# The camera process checks for requests at this interval while idle
+IDLE_POLL = 0.1
+STREAM_READY_TIMEOUT = 5.0
+READ_RETRIES = 3
+MAX_WORKERS = 64
+# Workers copy their stream metrics to the ring at this interval
+REPORT_INTERVAL = 1.0
+# sequence of the newest frame, time of the last request for frames
+HEADER = struct.Struct("<Qd")
+# frames sent, frames dropped, of each worker
+WORKER_METRICS = struct.Struct("<QQ")
+# sequence, length of the chunk
+SLOT_HEADER = struct.Struct("<QQ")
+
+logger = logging.getLogger(__name__)
+
+
+class SharedFrameRing:
+    """
+    Ring of the last `slots` multipart chunks of the stream in shared
+    memory. A single process writes it, any number of processes read it.
+    Each reader added with `add_reader` has a semaphore released on every
+    chunk. Releasing never blocks, even if the reader died.
+
+    Each slot is tagged with the sequence of its chunk. The writer clears
+    the tag while it writes the slot, and readers check the tag before and
+    after copying the chunk, so a chunk overwritten during the copy is
+    discarded.
+
+    Args:
+        name (str): Name of an existing ring. Default: create a new one
+        slots (int): Number of chunks kept
+        slot_bytes (int): Maximum size of a chunk
+    Raises:
+        ImportError: Python < 3.8, without multiprocessing.shared_memory
+    """
+
+    def __init__(
+        self,
+        name: str = None,
+        slots: int = RING_SLOTS,
+        slot_bytes: int = SLOT_BYTES,
+    ):
+        if shared_memory is None:
+            raise ImportError("Stream workers require Python 3.8 or newer")
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.owner = name is None
+        self.slots_offset = HEADER.size + MAX_WORKERS * WORKER_METRICS.size
+        size = self.slots_offset + slots * (SLOT_HEADER.size + slot_bytes)
+        # Spawned workers share the resource tracker of the camera
+        # process, which frees the ring if the owner doesn't
+        self.memory = shared_memory.SharedMemory(
+            name, create=self.owner, size=size
+        )
+        self.name = self.memory.name
+        self.skipped = 0
+        self.readers: typing.List[typing.Any] = []
+        self._lock = Lock()
+
+    def add_reader(self) -> typing.Any:
+        """
+        Returns:
+            wakeup (multiprocessing.Semaphore): Released on every chunk
+                published, to pass to a spawned process
+        """
+        wakeup = multiprocessing.get_context("spawn").Semaphore(0)
+        self.readers.append(wakeup)
+        return wakeup
+
+    def close(self) -> None:
+        """
+        Detaches from the ring, the owner also frees it
+        """
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    @property
+    def sequence(self) -> int:
+        return HEADER.unpack_from(self.memory.buf)[0]
+
+    @property
+    def requested(self) -> float:
+        """
+        Returns:
+            requested (float): time.time() of the last request for frames
+        """
+        return HEADER.unpack_from(self.memory.buf)[1]
+
+    def request(self) -> None:
+        """
+        Asks the writer to keep the stream running
+        """
+        struct.pack_into(
+            "<d", self.memory.buf, struct.calcsize("<Q"), time.time()
+        )
+
+    def report(self, worker: int, sent: int, dropped: int) -> None:
+        """
+        Writes the stream metrics of a worker
+
+        Args:
+            worker (int): Number of the worker, below MAX_WORKERS
+            sent (int): Frames sent to its viewers
+            dropped (int): Frames its viewers skipped
+        """
+        WORKER_METRICS.pack_into(
+            self.memory.buf,
+            HEADER.size + worker * WORKER_METRICS.size,
+            sent,
+            dropped,
+        )
+
+    def worker_metrics(self) -> typing.Tuple[int, int]:
+        """
+        Returns:
+            sent (int): Frames sent by all the workers
+            dropped (int): Frames dropped by all the workers
+        """
+        sent = dropped = 0
+        for worker in range(MAX_WORKERS):
+            worker_sent, worker_dropped = WORKER_METRICS.unpack_from(
+                self.memory.buf, HEADER.size + worker * WORKER_METRICS.size
+            )
+            sent += worker_sent
+            dropped += worker_dropped
+        return sent, dropped
+
+    def _slot(self, sequence: int) -> int:
+        return self.slots_offset + (sequence % self.slots) * (
+            SLOT_HEADER.size + self.slot_bytes
+        )
+
+    def publish(self, chunk: bytes) -> typing.Optional[int]:
+        """
+        Writes a chunk to the ring
+
+        Args:
+            chunk (bytes): Multipart chunk, see
+                `picamip.stream.JpegStreamIO.frame_header`
+        Returns:
+            sequence (int): Sequence of the chunk, or None if the chunk
+                doesn't fit in a slot
+        """
+        if len(chunk) > self.slot_bytes:
+            self.skipped += 1
+            logger.warning(
+                f"Skipping a frame of {len(chunk)} bytes, the slots of the"
+                + f" shared ring have {self.slot_bytes} bytes"
+            )
+            return None
+        with self._lock:
+            buf = self.memory.buf
+            sequence = self.sequence + 1
+            offset = self._slot(sequence)
+            SLOT_HEADER.pack_into(buf, offset, 0, 0)
+            start = offset + SLOT_HEADER.size
+            buf[start : start + len(chunk)] = chunk
+            SLOT_HEADER.pack_into(buf, offset, sequence, len(chunk))
+            struct.pack_into("<Q", buf, 0, sequence)
+        for wakeup in self.readers:
+            wakeup.release()
+        return sequence
+
+    def read(self, after: int) -> typing.Tuple[int, typing.Optional[bytes]]:
+        """
+        Copies the newest chunk if it's newer than `after`
+
+        Args:
+            after (int): Sequence of the last chunk read
+        Returns:
+            sequence (int): Sequence of the chunk
+            chunk (bytes): Multipart chunk or None if there is no newer
+                chunk
+        """
+        buf = self.memory.buf
+        for _ in range(READ_RETRIES):
+            sequence = self.sequence
+            if sequence <= after:
+                break
+            offset = self._slot(sequence)
+            tag, length = SLOT_HEADER.unpack_from(buf, offset)
+            if tag != sequence:
+                continue
+            start = offset + SLOT_HEADER.size
+            chunk = bytes(buf[start : start + length])
+            if SLOT_HEADER.unpack_from(buf, offset)[0] == sequence:
+                return sequence, chunk
+        return after, None
+
+
+class RingPublisher:
+    """
+    Copies the frames of the camera to a `SharedFrameRing` and keeps the
+    stream running while the workers request frames. Runs in the process
+    that owns the camera.
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+        ring (SharedFrameRing)
+    """
+
+    def __init__(self, camera: stream.StreamCamera, ring: SharedFrameRing):
+        self.camera = camera
+        self.ring = ring
+        # Counts as a viewer, so the stream restarts after stills
+        self.client = stream.StreamClient()
+        self._stop = Event()
+        self._thread: typing.Optional[Thread] = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = Thread(target=self._publish, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.camera.stream_buffer.clients.discard(self.client)
+
+    def _publish(self) -> None:
+        stream_buffer = self.camera.stream_buffer
+        sequence = stream_buffer.sequence
+        while not self._stop.is_set():
+            if time.time() - self.ring.requested > IDLE_SECONDS:
+                stream_buffer.clients.discard(self.client)
+                self._stop.wait(IDLE_POLL)
+                continue
+            if self.client not in stream_buffer.clients:
+                stream_buffer.clients.add(self.client)
+                self.camera.start_stream()
+            sequence, chunk = stream_buffer.read_chunk(
+                sequence, stream.STREAM_TIMEOUT, latest=True
+            )
+            if chunk is None:
+                # Not started yet or a capture stopped the camera
+                self.camera.start_stream()
+                continue
+            self.ring.publish(chunk)
+
+
+class SharedRingCamera(stream.StreamCamera):
+    """
+    Camera of the worker processes. Reads the frames of a
+    `SharedFrameRing` into `stream_buffer` while there are viewers. Each
+    frame is copied once from the ring, then shared by all the viewers of
+    the worker.
+
+    Args:
+        name (str): Name of the ring
+        wakeup (multiprocessing.Semaphore): Reader semaphore of the ring,
+            see `SharedFrameRing.add_reader`. Default: poll the ring
+    """
+
+    def __init__(self, name: str, wakeup: typing.Any = None):
+        self.ring = SharedFrameRing(name)
+        self.wakeup = wakeup
+        self._lock = Lock()
+        self._requested = 0.0
+        self._thread: typing.Optional[Thread] = None
+
+    def close(self) -> None:
+        self.ring.close()
+
+    def start_stream(self) -> None:
+        """
+        Requests frames from the camera process and waits for the first one
+        """
+        with self._lock:
+            self._requested = time.monotonic()
+            self.ring.request()
+            if self._thread is not None:
+                return
+            sequence = self.stream_buffer.sequence
+            self._thread = Thread(target=self._read, daemon=True)
+            self._thread.start()
+        self.stream_buffer.read_chunk(sequence, STREAM_READY_TIMEOUT)
+
+    def _read(self) -> None:
+        stream_buffer = self.stream_buffer
+        sequence = max(self.ring.sequence - 1, 0)
+        requested = time.monotonic()
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                if (
+                    not stream_buffer.clients
+                    and now - self._requested > IDLE_SECONDS
+                ):
+                    self._thread = None
+                    return
+            if stream_buffer.clients and now - requested > REQUEST_INTERVAL:
+                self.ring.request()
+                requested = now
+            if self.wakeup is not None:
+                # Drained before reading, a chunk published after the read
+                # releases it again
+                while self.wakeup.acquire(False):
+                    pass
+            sequence, chunk = self.ring.read(sequence)
+            if chunk is None:
+                if self.wakeup is None:
+                    time.sleep(POLL_INTERVAL)
+                else:
+                    self.wakeup.acquire(timeout=REQUEST_INTERVAL)
+                continue
+            stream_buffer.publish(chunk)
+
+    def capture_burst(self, filenames: typing.List[str]) -> None:
+        raise NotImplementedError("Stream workers don't take pictures")
+
+
+def collect_worker_metrics(ring: SharedFrameRing) -> None:
+    """
+    Adds the stream metrics the workers report to `ring` to the metrics
+    of this process
+    """
+    metrics.STREAM_SENT.function = lambda: ring.worker_metrics()[0]
+    metrics.STREAM_DROPPED.function = lambda: ring.worker_metrics()[1]
+
+
+def _report_metrics(ring: SharedFrameRing, worker: int) -> None:
+    while True:
+        ring.report(
+            worker,
+            int(metrics.STREAM_SENT.value),
+            int(metrics.STREAM_DROPPED.value),
+        )
+        time.sleep(REPORT_INTERVAL)
+
+
+def serve_worker(
+    name: str,
+    worker: int,
+    host: str,
+    port: int,
+    server_type: str,
+    wakeup: typing.Any = None,
+) -> None:
+    """
+    Serves /stream and /frame.jpg from the ring `name`. The port is shared
+    with the other workers with SO_REUSEPORT, the kernel balances the
+    connections between them. The stream metrics of the worker are
+    reported to the ring.
+
+    Args:
+        name (str): Name of the ring
+        worker (int): Number of the worker, below MAX_WORKERS
+        host (str): Host
+        port (int): Stream port
+        server_type (str): "flask" or "asgi", see `picamip.server.SERVERS`
+        wakeup (multiprocessing.Semaphore): Reader semaphore of the ring
+            (optional)
+    """
+    camera = SharedRingCamera(name, wakeup)
+    app = server.build_stream_app(camera)
+    Thread(
+        target=_report_metrics, args=(camera.ring, worker), daemon=True
+    ).start()
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    try:
+        if server_type == "asgi":
+            from . import asgi
+
+            asgi.serve(app, host, port, fd=sock.fileno())
+        else:
+            from werkzeug.serving import make_server
+
+            make_server(
+                host, port, app, threaded=True, fd=sock.fileno()
+            ).serve_forever()
+    finally:
+        sock.close()
+        camera.close()
+
+
+def start_workers(
+    ring: SharedFrameRing, host: str, port: int, server_type: str, count: int
+) -> typing.List[BaseProcess]:
+    """
+    Starts `count` processes running `serve_worker`. They are spawned, not
+    forked, so they don't inherit the camera.
+
+    Args:
+        ring (SharedFrameRing)
+        host (str): Host
+        port (int): Stream port
+        server_type (str): "flask" or "asgi"
+        count (int): Number of workers
+    Returns:
+        workers (list[multiprocessing.process.BaseProcess])
+    Raises:
+        ValueError: More than MAX_WORKERS workers
+    """
+    if count > MAX_WORKERS:
+        raise ValueError(f"At most {MAX_WORKERS} stream workers")
+    context = multiprocessing.get_context("spawn")
+    workers: typing.List[BaseProcess] = [
+        context.Process(
+            target=serve_worker,
+            args=(ring.name, i, host, port, server_type, ring.add_reader()),
+            name=f"picamip-stream-{i}",
+            daemon=True,
+        )
+        for i in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
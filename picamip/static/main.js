@@ -15,12 +15,17 @@
 */
 let delIdx;  // Communicate delete index with this. Ugly but it works :(
 
+// Prefix of the routes of this camera, eg: /cam/door
+function route(path) {
+  return document.body.dataset.root + path
+}
+
 function pictureThenDownload() {
-  const uri = "/picture"
+  const uri = route("/picture")
   const method = "POST"
   const request = new Request(uri, {method})
   fetch(request).then(response => {
-    downloadURI("/picture?index=-1&download=true")
+    downloadURI(route("/picture?index=-1&download=true"))
     location.reload()
   })
 }
@@ -36,7 +41,7 @@ function downloadURI(uri) {
 }
 
 function deleteIndex() {
-  const uri = "/delete?index=" + parseInt(delIdx)
+  const uri = route("/delete?index=" + parseInt(delIdx))
   const method = "DELETE"
   const request = new Request(uri, {method})
   fetch(request).then(response => {
@@ -45,7 +50,7 @@ function deleteIndex() {
 }
 
 function deleteAll() {
-  const uri = "/deleteAll"
+  const uri = route("/deleteAll")
   const method = "DELETE"
   const request = new Request(uri, {method})
   fetch(request).then(response => {
@@ -57,20 +62,14 @@ function openModal(id) {
   $('#'+id).modal('show');
 }
 
-function addPaginator() {
-  const box = paginator({
-    table: $("#files")[0],
-    rows_per_page: 10,
-    page_options: false,
-    active_class: "active",
-    box_mode: "list",
-  });
-  box.className = "pagination";
-  $(".table-index").append(box);
-  $( ".table tr:first-child td" ).addClass("bg-primary");
-  $( ".table tr:first-child td a" ).addClass("text-light");
+function highlightLast() {
+  const params = new URLSearchParams(window.location.search);
+  if (parseInt(params.get("page") || "1") == 1) {
+    $( ".table tr:first-child td" ).addClass("bg-primary");
+    $( ".table tr:first-child td a" ).addClass("text-light");
+  }
 }
 
 $(document).ready(() => {
-  addPaginator();
+  highlightLast();
 })
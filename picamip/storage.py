@@ -13,11 +13,23 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import bisect
 from os import path
 import os
 import re
+from threading import RLock
+import time
 import typing
-from zipfile import ZipFile
+import uuid
+
+from . import metrics
+from .avistream import AviStream
+from .zipstream import ZipStream
+
+STORAGE_LAYOUTS = ["flat", "sharded"]
+SHARD_SIZE = 1000
+SHARD_DIGITS = 4
+SHARD_RE = re.compile(r"^[0-9]+$")
 
 
 class IndexedFilesStorage:
@@ -25,11 +37,34 @@ class IndexedFilesStorage:
     Manages a file storage at `directory` with indexed files.
     The files names will match {prefix}{index}{suffix}, where `index`
     is a zero paded number with `number_digits` digits.
+
+    The indexes are kept in memory and updated on the storage's own writes
+    and deletes. The directory is only scanned again when its mtime
+    changes, which means something outside picamip touched it.
+
+    Functions in `register_callbacks` and `delete_callbacks` are called
+    with the index of every file registered and deleted by the storage,
+    and functions in `update_callbacks` with the index of every file
+    rewritten in place.
+
+    Files still being written are marked with `start_writing` and left out
+    of the index until they are registered, or removed by
+    `cancel_writing`.
+
+    `generation` is incremented on every change of the index, together
+    with `instance_id` it identifies a version of the storage listing.
+
+    The retention policy is applied on every `register`: the oldest files
+    (smallest indexes) are deleted while there are more than `max_count`,
+    they take more than `max_bytes` or the oldest is older than `max_age`.
     Args:
         directory (str)
         prefix (str)
         suffix (str)
         index_digits (int): Number of digits to match
+        max_count (int): Maximum number of files (optional)
+        max_bytes (int): Maximum size of the files (optional)
+        max_age (float): Maximum age of the files in seconds (optional)
     """
 
     SANE_PREFIX_RE = r"^[a-zA-Z0-9\-_\(\).]+$"
@@ -41,6 +76,9 @@ class IndexedFilesStorage:
         prefix: str = "",
         suffix: str = "",
         index_digits: int = 4,
+        max_count: int = None,
+        max_bytes: int = None,
+        max_age: float = None,
     ):
         if not path.isdir(directory):
             raise NotADirectoryError(
@@ -60,18 +98,54 @@ class IndexedFilesStorage:
         self.prefix = prefix
         self.suffix = suffix
         self.index_digits = index_digits
+        self.file_re = re.compile(
+            rf"^{self.prefix}([0-9]{{{self.index_digits}}}){self.suffix}$"
+        )
+        for name, limit in [
+            ("max_count", max_count),
+            ("max_bytes", max_bytes),
+            ("max_age", max_age),
+        ]:
+            if limit is not None and not limit > 0:
+                raise ValueError(f"{name} must be positive, got {limit}")
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = RLock()
+        self._files: typing.Dict[int, str] = {}
+        self._indexes: typing.List[int] = []
+        self._mtime: typing.Any = None
+        self._sizes: typing.Optional[typing.Dict[int, int]] = None
+        self._bytes = 0
+        self._generation = 0
+        self._writing: typing.Set[int] = set()
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.register_callbacks: typing.List[
+            typing.Callable[[int], None]
+        ] = []
+        self.delete_callbacks: typing.List[typing.Callable[[int], None]] = []
+        self.update_callbacks: typing.List[typing.Callable[[int], None]] = []
 
     def __getitem__(self, index):
-        return self.files[index]
+        with self._lock:
+            self._refresh()
+            return self._files[index]
 
     def __iter__(self):
-        yield from self.files.items()
+        with self._lock:
+            self._refresh()
+            items = [(index, self._files[index]) for index in self._indexes]
+        yield from items
 
     def __contains__(self, index):
-        return index in dict(self)
+        with self._lock:
+            self._refresh()
+            return index in self._files
 
     def __len__(self):
-        return len(self.files)
+        with self._lock:
+            self._refresh()
+            return len(self._indexes)
 
     def __repr__(self):
         return (
@@ -83,36 +157,327 @@ class IndexedFilesStorage:
             + ")"
         )
 
-    @property
-    def files(self) -> typing.Dict[int, str]:
+    def _directory_mtime(self) -> typing.Any:
+        return os.stat(self.directory).st_mtime_ns
+
+    def _scan(self) -> typing.Dict[int, str]:
         """
         Returns:
-            files (list[tuple[int, str]]): List of tuples of the indexes
-                as integers and the files
+            files (dict[int, str]): Mapping of the indexes to the filenames
+                relative to `directory`
         """
-        file_re = (
-            rf"^{self.prefix}([0-9]{{{self.index_digits}}}){self.suffix}$"
-        )
-        files = {
+        return {
             int(match[1]): match[0]
             for match in [
-                re.match(file_re, f) for f in os.listdir(self.directory)
+                self.file_re.match(f) for f in os.listdir(self.directory)
             ]
             if match is not None
         }
-        return files
+
+    def _refresh(self) -> None:
+        """
+        Rescans the directory if it was modified since the last scan.
+        Must be called with `_lock` held.
+        """
+        mtime = self._directory_mtime()
+        if mtime == self._mtime:
+            return
+        with metrics.STORAGE_SCAN_SECONDS.time():
+            files = self._scan()
+        for index in self._writing:
+            files.pop(index, None)
+        if files != self._files:
+            self._files = files
+            self._indexes = sorted(files)
+            self._generation += 1
+            self._sizes = None
+        self._mtime = mtime
+
+    def _seen(self, index: int) -> None:
+        """
+        Records the directory state after the storage's own write or delete
+        of `index`, so it isn't taken for an external change. Must be
+        called with `_lock` held.
+        """
+        self._mtime = self._directory_mtime()
+
+    def rescan(self) -> None:
+        """
+        Forces a full scan of the directory
+        """
+        with self._lock:
+            self._mtime = None
+            self._refresh()
+
+    def start_writing(self, index: int) -> None:
+        """
+        Keeps `index` out of the index, and of the retention policy, until
+        it's registered
+
+        Args:
+            index (int)
+        """
+        with self._lock:
+            self._writing.add(index)
+
+    def cancel_writing(self, index: int) -> None:
+        """
+        Removes what was written of `index`, marked with `start_writing`,
+        when the write failed
+
+        Args:
+            index (int)
+        """
+        filename = self.make_filename(index)
+        with self._lock:
+            self._writing.discard(index)
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                return
+            self._seen(index)
+
+    def register(self, index: int) -> bool:
+        """
+        Adds a file written by picamip to the index without scanning the
+        directory.
+
+        Args:
+            index (int)
+        Returns:
+            registered (bool): True if the file exists and was indexed
+        """
+        filename = self.make_filename(index)
+        with self._lock:
+            self._writing.discard(index)
+            # Writing the file changed the directory mtime, a refresh here
+            # would always rescan
+            if self._mtime is None:
+                self._refresh()
+            if not path.isfile(filename):
+                return False
+            size = path.getsize(filename)
+            if index not in self._files:
+                bisect.insort(self._indexes, index)
+                self._generation += 1
+            elif self._sizes is None or self._sizes.get(index) != size:
+                # Listings filtered by size may change
+                self._generation += 1
+            self._files[index] = path.relpath(filename, self.directory)
+            if self._sizes is not None:
+                self._bytes += size - self._sizes.get(index, 0)
+                self._sizes[index] = size
+            self._seen(index)
+        for callback in self.register_callbacks:
+            callback(index)
+        self.apply_retention(keep=index)
+        return True
+
+    def update(self, index: int) -> bool:
+        """
+        Updates the size of a file picamip rewrote in place, eg: in the
+        post-capture pipeline. Unlike `register`, the retention policy
+        isn't applied again and `update_callbacks` are called instead of
+        `register_callbacks`.
+
+        Args:
+            index (int)
+        Returns:
+            updated (bool): True if the file is in the index
+        """
+        with self._lock:
+            filename = self._files.get(index)
+            if filename is None:
+                return False
+            try:
+                size = path.getsize(path.join(self.directory, filename))
+            except FileNotFoundError:
+                return False
+            if self._sizes is not None:
+                self._bytes += size - self._sizes.get(index, 0)
+                self._sizes[index] = size
+            # The version of the file in the listings changed
+            self._generation += 1
+            self._seen(index)
+        for callback in self.update_callbacks:
+            callback(index)
+        return True
+
+    def _unregister(self, index: int) -> None:
+        """
+        Removes `index` from the index. Must be called with `_lock` held.
+        """
+        if self._files.pop(index, None) is not None:
+            del self._indexes[bisect.bisect_left(self._indexes, index)]
+            self._generation += 1
+        if self._sizes is not None:
+            self._bytes -= self._sizes.pop(index, 0)
+        self._seen(index)
+
+    def _expired(self, index: int, now: float) -> bool:
+        try:
+            mtime = os.stat(path.join(self.directory, self._files[index]))
+        except FileNotFoundError:
+            return True
+        return now - mtime.st_mtime > self.max_age
+
+    def _over_limit(self, now: float) -> bool:
+        """
+        Must be called with `_lock` held and `_sizes` loaded if there is
+        a `max_bytes` limit.
+        """
+        if self.max_count is not None and len(self._indexes) > self.max_count:
+            return True
+        if self.max_bytes is not None and self._bytes > self.max_bytes:
+            return True
+        return self.max_age is not None and self._expired(
+            self._indexes[0], now
+        )
+
+    def _load_sizes(self) -> None:
+        self._sizes = {}
+        for index, filename in self._files.items():
+            try:
+                self._sizes[index] = path.getsize(
+                    path.join(self.directory, filename)
+                )
+            except FileNotFoundError:
+                pass
+        self._bytes = sum(self._sizes.values())
+
+    def apply_retention(self, keep: int = None) -> typing.List[int]:
+        """
+        Deletes the oldest files until the storage is within the
+        retention policy
+
+        Args:
+            keep (int): Index that is never deleted, eg: the one that was
+                just written
+        Returns:
+            deleted (list[int]): Deleted indexes
+        """
+        deleted: typing.List[int] = []
+        if (self.max_count, self.max_bytes, self.max_age) == (None,) * 3:
+            return deleted
+        now = time.time()
+        with self._lock:
+            self._refresh()
+            if self.max_bytes is not None and self._sizes is None:
+                # Loaded once, then kept up to date by the writes
+                self._load_sizes()
+            while (
+                self._indexes
+                and self._indexes[0] != keep
+                and self._over_limit(now)
+            ):
+                deleted.append(self._indexes[0])
+                self.delete_index(deleted[-1])
+        return deleted
+
+    @property
+    def files(self) -> typing.Dict[int, str]:
+        """
+        Returns:
+            files (dict[int, str]): Mapping of the indexes as integers
+                to the filenames, sorted by index
+        """
+        return dict(self)
+
+    @property
+    def indexes(self) -> typing.List[int]:
+        """
+        Returns:
+            indexes (list[int]): Sorted list of the stored indexes
+        """
+        with self._lock:
+            self._refresh()
+            return list(self._indexes)
+
+    def version(self, index: int) -> str:
+        """
+        Args:
+            index (int)
+        Returns:
+            version (str): Identifies the contents of the file, changes
+                if the index is deleted and written again
+        Raises:
+            KeyError: index is not in the storage
+        """
+        try:
+            stat = os.stat(path.join(self.directory, self[index]))
+        except FileNotFoundError:
+            raise KeyError(index)
+        return f"{stat.st_mtime_ns:x}"
+
+    @property
+    def generation(self) -> int:
+        """
+        Returns:
+            generation (int): Counter incremented on every change
+        """
+        with self._lock:
+            self._refresh()
+            return self._generation
+
+    @property
+    def etag(self) -> str:
+        """
+        Returns:
+            etag (str): Identifies the current version of the listing
+        """
+        return f"{self.instance_id}-{self.generation}"
+
+    def page(
+        self,
+        limit: int = None,
+        offset: int = 0,
+        after: int = None,
+        before: int = None,
+        reverse: bool = False,
+    ) -> typing.List[typing.Tuple[int, str]]:
+        """
+        Slices the sorted listing without copying the whole index
+
+        Args:
+            limit (int): Maximum number of files. Default: no limit
+            offset (int): Number of files to skip
+            after (int): Cursor, only indexes larger than `after`
+            before (int): Cursor, only indexes smaller than `before`
+            reverse (bool): Sort from the largest index to the smallest
+        Returns:
+            files (list[tuple[int, str]]): List of (index, filename)
+        """
+        with self._lock:
+            self._refresh()
+            lo = 0
+            hi = len(self._indexes)
+            if after is not None:
+                lo = bisect.bisect_right(self._indexes, after)
+            if before is not None:
+                hi = bisect.bisect_left(self._indexes, before)
+            if reverse:
+                hi = max(hi - offset, lo)
+                if limit is not None:
+                    lo = max(hi - limit, lo)
+                indexes = self._indexes[lo:hi][::-1]
+            else:
+                lo = min(lo + offset, hi)
+                if limit is not None:
+                    hi = min(lo + limit, hi)
+                indexes = self._indexes[lo:hi]
+            return [(index, self._files[index]) for index in indexes]
 
     @property
     def last_index(self) -> int:
         """
         Returns:
             last_index (int): Last (largest) index
-            last_index_filename (int): Last (largest) filename
         """
-        indexes = self.files.keys()
-        if len(indexes) == 0:
-            return 0
-        return max(indexes)
+        with self._lock:
+            self._refresh()
+            if len(self._indexes) == 0:
+                return 0
+            return self._indexes[-1]
 
     @property
     def next_filename(self) -> str:
@@ -134,23 +499,79 @@ class IndexedFilesStorage:
                 f"Index out of range {self.prefix}(index){self.suffix}."
                 + f" Index {index}, max index: {'9'*self.index_digits}"
             )
+        return self._path(index)
+
+    def _path(self, index: int) -> str:
         return path.join(
             self.directory,
             f"{self.prefix}{str(index).zfill(self.index_digits)}{self.suffix}",
         )
 
-    def zip(self, output: str) -> None:
+    def _filenames(
+        self, indexes: typing.Iterable[int] = None
+    ) -> typing.List[str]:
+        """
+        Args:
+            indexes (list[int]): Indexes to include. Default: all files.
+                Indexes not in the storage are ignored.
+        Returns:
+            filenames (list[str]): Filenames relative to `directory`, in
+                index order
+        """
+        with self._lock:
+            self._refresh()
+            if indexes is None:
+                indexes = self._indexes
+            else:
+                indexes = sorted(set(indexes) & self._files.keys())
+            return [self._files[index] for index in indexes]
+
+    def zip_stream(self, indexes: typing.Iterable[int] = None) -> ZipStream:
+        """
+        Builds a streaming zip archive of the files in the storage
+
+        Args:
+            indexes (list[int]): Indexes to include. Default: all files.
+                Indexes not in the storage are ignored.
+        Returns:
+            zip_stream (picamip.zipstream.ZipStream)
+        """
+        filenames = self._filenames(indexes)
+        return ZipStream(
+            (path.join(self.directory, filename), path.basename(filename))
+            for filename in filenames
+        )
+
+    def avi_stream(
+        self, indexes: typing.Iterable[int] = None, fps: float = 10
+    ) -> AviStream:
+        """
+        Builds a streaming MJPEG AVI of the pictures in the storage, one
+        picture per frame
+
+        Args:
+            indexes (list[int]): Indexes to include. Default: all files.
+                Indexes not in the storage are ignored.
+            fps (float): Frames per second
+        Returns:
+            avi_stream (picamip.avistream.AviStream)
+        """
+        filenames = self._filenames(indexes)
+        return AviStream(
+            (path.join(self.directory, filename) for filename in filenames),
+            fps,
+        )
+
+    def zip(self, output: str, indexes: typing.Iterable[int] = None) -> None:
         """
         Zips all files in the storage and writes to `output`
 
         Args:
             output (str): Target zip file
+            indexes (list[int]): Indexes to include. Default: all files.
         """
-        with ZipFile(output, "w") as zip_out:
-            for filename in self.files.values():
-                zip_out.write(
-                    path.join(self.directory, filename), arcname=filename
-                )
+        with open(output, "wb") as fp:
+            self.zip_stream(indexes).write(fp)
 
     def delete_index(self, index) -> bool:
         """
@@ -162,11 +583,22 @@ class IndexedFilesStorage:
             deleted (bool): True if the file was deleted successfully
                 and False if the file doesn't exists
         """
-        try:
-            os.remove(path.join(self.directory, self.make_filename(index)))
-            return True
-        except FileNotFoundError:
-            return False
+        with self._lock:
+            self._refresh()
+            filename = self._files.get(index)
+            try:
+                os.remove(
+                    self._path(index)
+                    if filename is None
+                    else path.join(self.directory, filename)
+                )
+                deleted = True
+            except FileNotFoundError:
+                deleted = False
+            self._unregister(index)
+        for callback in self.delete_callbacks:
+            callback(index)
+        return deleted
 
     def delete_all(self) -> int:
         """
@@ -175,7 +607,205 @@ class IndexedFilesStorage:
         Returns:
             deleted (int): Number of deleted files
         """
-        fileindexes = dict(self).keys()
-        for index in fileindexes:
-            self.delete_index(index)
-        return len(fileindexes)
+        with self._lock:
+            fileindexes = self.indexes
+            for index in fileindexes:
+                self.delete_index(index)
+            return len(fileindexes)
+
+
+class ShardedFilesStorage(IndexedFilesStorage):
+    """
+    `IndexedFilesStorage` that keeps the files in subdirectories of
+    `shard_size` indexes: {directory}/{index // shard_size}/{filename}.
+    Indexes have at least `index_digits` digits and no upper limit.
+
+    The directory and the newest shard are checked for changes on every
+    access. When they change, only the shards whose mtime changed are
+    listed again.
+
+    Args:
+        directory (str)
+        prefix (str)
+        suffix (str)
+        index_digits (int): Minimum number of digits
+        shard_size (int): Number of indexes per subdirectory
+        max_count (int): Maximum number of files (optional)
+        max_bytes (int): Maximum size of the files (optional)
+        max_age (float): Maximum age of the files in seconds (optional)
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        prefix: str = "",
+        suffix: str = "",
+        index_digits: int = 4,
+        shard_size: int = SHARD_SIZE,
+        max_count: int = None,
+        max_bytes: int = None,
+        max_age: float = None,
+    ):
+        super().__init__(
+            directory,
+            prefix,
+            suffix,
+            index_digits,
+            max_count,
+            max_bytes,
+            max_age,
+        )
+        if not shard_size > 0:
+            raise ValueError(f"shard_size must be positive, got {shard_size}")
+        self.shard_size = shard_size
+        self.file_re = re.compile(
+            rf"^{self.prefix}([0-9]{{{self.index_digits},}}){self.suffix}$"
+        )
+        self._shard_mtimes: typing.Dict[str, int] = {}
+
+    def shard(self, index: int) -> str:
+        """
+        Args:
+            index (int)
+        Returns:
+            shard (str): Name of the subdirectory of `index`
+        """
+        return str(index // self.shard_size).zfill(SHARD_DIGITS)
+
+    def _newest_shard(self) -> typing.Optional[str]:
+        if not self._shard_mtimes:
+            return None
+        return max(self._shard_mtimes, key=int)
+
+    def _directory_mtime(self) -> typing.Any:
+        shard = self._newest_shard()
+        try:
+            shard_mtime = (
+                os.stat(path.join(self.directory, shard)).st_mtime_ns
+                if shard is not None
+                else None
+            )
+        except FileNotFoundError:
+            shard_mtime = None
+        return os.stat(self.directory).st_mtime_ns, shard_mtime
+
+    def _scan_shard(self, shard: str) -> typing.Dict[int, str]:
+        return {
+            int(match[1]): path.join(shard, match[0])
+            for match in [
+                self.file_re.match(f)
+                for f in os.listdir(path.join(self.directory, shard))
+            ]
+            if match is not None
+        }
+
+    def _scan(self) -> typing.Dict[int, str]:
+        by_shard: typing.Dict[str, typing.Dict[int, str]] = {}
+        for index, filename in self._files.items():
+            shard = path.dirname(filename)
+            by_shard.setdefault(shard, {})[index] = filename
+        files: typing.Dict[int, str] = {}
+        shard_mtimes = {}
+        for entry in os.scandir(self.directory):
+            if not SHARD_RE.match(entry.name) or not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            shard_mtimes[entry.name] = mtime
+            if self._shard_mtimes.get(entry.name) == mtime:
+                files.update(by_shard.get(entry.name, {}))
+            else:
+                files.update(self._scan_shard(entry.name))
+        self._shard_mtimes = shard_mtimes
+        return files
+
+    def _refresh(self) -> None:
+        scanned = self._mtime
+        super()._refresh()
+        if self._mtime is not scanned:
+            # The scan may have found a newer shard
+            self._mtime = (
+                self._mtime[0],
+                self._shard_mtimes.get(self._newest_shard()),
+            )
+
+    def _seen(self, index: int) -> None:
+        shard = self.shard(index)
+        try:
+            self._shard_mtimes[shard] = os.stat(
+                path.join(self.directory, shard)
+            ).st_mtime_ns
+        except FileNotFoundError:
+            self._shard_mtimes.pop(shard, None)
+        super()._seen(index)
+
+    def rescan(self) -> None:
+        """
+        Forces a full scan of the directory and all the shards
+        """
+        with self._lock:
+            self._shard_mtimes = {}
+            super().rescan()
+
+    def make_filename(self, index) -> str:
+        """
+        Creates the shard of `index` if needed
+
+        Args:
+            index (int)
+        Returns:
+            filename (str): Absolute filename for given index
+        """
+        filename = self._path(index)
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        return filename
+
+    def _path(self, index: int) -> str:
+        return path.join(
+            self.directory,
+            self.shard(index),
+            f"{self.prefix}{str(index).zfill(self.index_digits)}{self.suffix}",
+        )
+
+    def delete_index(self, index) -> bool:
+        deleted = super().delete_index(index)
+        with self._lock:
+            try:
+                # Removes the shard when it's empty
+                os.rmdir(path.join(self.directory, self.shard(index)))
+            except OSError:
+                pass
+            else:
+                self._seen(index)
+        return deleted
+
+
+def migrate_to_shards(
+    directory: str,
+    prefix: str = "",
+    suffix: str = "",
+    index_digits: int = 4,
+    shard_size: int = SHARD_SIZE,
+) -> int:
+    """
+    Moves the files of a flat `IndexedFilesStorage` at `directory` into
+    the subdirectories of a `ShardedFilesStorage`. Files are renamed, not
+    copied.
+
+    Args:
+        directory (str)
+        prefix (str)
+        suffix (str)
+        index_digits (int)
+        shard_size (int)
+    Returns:
+        moved (int): Number of files moved
+    """
+    flat = IndexedFilesStorage(directory, prefix, suffix, index_digits)
+    sharded = ShardedFilesStorage(
+        directory, prefix, suffix, index_digits, shard_size
+    )
+    moved = 0
+    for index, filename in flat:
+        os.rename(path.join(directory, filename), sharded.make_filename(index))
+        moved += 1
+    return moved
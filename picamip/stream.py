@@ -0,0 +1,374 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import deque
+import io
+from threading import Condition, Lock, RLock
+from time import monotonic, sleep
+import typing
+
+from . import metrics
+
+BOUNDARY = b"FRAME"
+RING_SIZE = 4
+STREAM_TIMEOUT = 1.0
+CAPTURE_MODES = ["restart", "video_port"]
+
+
+def read_frames(
+    fp: typing.BinaryIO, boundary: bytes
+) -> typing.Generator[bytes, None, None]:
+    """
+    Parses a multipart/x-mixed-replace stream. Parts must have a
+    Content-Length header, like the ones sent by picamip.
+
+    Args:
+        fp (file): Response body
+        boundary (bytes): Multipart boundary
+    Yields:
+        frame (bytes): Body of each part, until the stream ends
+    Raises:
+        ValueError: a part has no valid Content-Length
+    """
+    delimiter = b"--" + boundary
+    while True:
+        line = fp.readline()
+        if not line:
+            return
+        line = line.strip()
+        if line == delimiter + b"--":
+            return
+        if line != delimiter:
+            continue
+        length = None
+        while True:
+            line = fp.readline()
+            if not line:
+                return
+            name, _, value = line.strip().partition(b":")
+            if not name:
+                break
+            if name.strip().lower() == b"content-length":
+                length = int(value)
+        if length is None:
+            raise ValueError("The stream parts have no Content-Length")
+        frame = fp.read(length)
+        if len(frame) < length:
+            return
+        yield frame
+
+
+class StreamClient:
+    """
+    Per connection state of a stream viewer. Tracks the last sequence sent,
+    paces the frames to `fps` and counts sent and dropped frames.
+
+    Args:
+        fps (float): Maximum frame rate. Default: no limit
+    """
+
+    def __init__(self, fps: float = None, sequence: int = 0):
+        if fps is not None and fps <= 0:
+            raise ValueError("fps must be positive")
+        self.fps = fps
+        self.interval = 1 / fps if fps else 0.0
+        self.sequence = sequence
+        self.sent = 0
+        self.dropped = 0
+        self.next_time = monotonic()
+
+    def delay(self) -> float:
+        """
+        Returns:
+            delay (float): Seconds to wait before sending the next frame
+        """
+        return max(self.next_time - monotonic(), 0.0)
+
+    def account(self, sequence: int) -> None:
+        """
+        Records that the frame `sequence` is being sent. Frames between the
+        last one sent and `sequence` are counted as dropped.
+        """
+        dropped = max(sequence - self.sequence - 1, 0)
+        if dropped:
+            self.dropped += dropped
+            metrics.STREAM_DROPPED.inc(dropped)
+        self.sequence = sequence
+        self.sent += 1
+        metrics.STREAM_SENT.inc()
+        self.next_time = max(self.next_time + self.interval, monotonic())
+
+
+class JpegStreamIO(io.BytesIO):
+    """
+    Receives the MJPEG stream from the camera and publishes each frame
+    as a multipart chunk ready to be sent to the clients.
+
+    The chunk (boundary, headers, frame and trailer) is built once per
+    frame and kept in a ring of the last `ring_size` frames, tagged with
+    a sequence number. Clients share the same immutable bytes object, so
+    the cost per frame doesn't grow with the number of viewers.
+
+    Args:
+        ring_size (int): Number of frames kept in the ring
+    """
+
+    def __init__(self, *args, ring_size: int = RING_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring: typing.Deque[typing.Tuple[int, bytes]] = deque(
+            maxlen=ring_size
+        )
+        self.sequence = 0
+        self.condition = Condition()
+        self.clients: typing.Set[StreamClient] = set()
+
+    @staticmethod
+    def frame_header(length: int) -> bytes:
+        return (
+            b"--"
+            + BOUNDARY
+            + b"\r\nContent-Type: image/jpeg\r\n"
+            + b"Content-Length: "
+            + str(length).encode()
+            + b"\r\n\r\n"
+        )
+
+    def write(self, buf: bytes):
+        if buf.startswith(b"\xff\xd8"):
+            self.truncate()
+            if self.tell() > 0:
+                with self.getbuffer() as frame:
+                    chunk = b"".join(
+                        (self.frame_header(len(frame)), frame, b"\r\n")
+                    )
+                self.publish(chunk)
+            self.seek(0)
+        return super().write(buf)
+
+    def publish_frame(self, frame: bytes) -> int:
+        """
+        Publishes a JPEG frame received whole, eg: from another stream
+
+        Args:
+            frame (bytes): JPEG
+        Returns:
+            sequence (int): Sequence number of the chunk
+        """
+        return self.publish(
+            b"".join((self.frame_header(len(frame)), frame, b"\r\n"))
+        )
+
+    def publish(self, chunk: bytes) -> int:
+        """
+        Appends a framed multipart chunk to the ring and wakes the clients
+
+        Args:
+            chunk (bytes): Multipart chunk, see `frame_header`
+        Returns:
+            sequence (int): Sequence number of the chunk
+        """
+        sequence = self._append(chunk)
+        metrics.STREAM_FRAMES.inc()
+        metrics.STREAM_BYTES.inc(len(chunk))
+        return sequence
+
+    def _append(self, chunk: bytes) -> int:
+        with self.condition:
+            self.sequence += 1
+            self.ring.append((self.sequence, chunk))
+            self.condition.notify_all()
+            return self.sequence
+
+    @property
+    def chunk(self) -> typing.Optional[bytes]:
+        """
+        Returns:
+            chunk (bytes): Latest multipart chunk or None
+        """
+        with self.condition:
+            return self.ring[-1][1] if self.ring else None
+
+    @property
+    def frame(self) -> typing.Optional[memoryview]:
+        """
+        Returns:
+            frame (memoryview): View of the latest JPEG frame or None
+        """
+        chunk = self.chunk
+        if chunk is None:
+            return None
+        return self.chunk_frame(chunk)
+
+    @staticmethod
+    def chunk_frame(chunk: bytes) -> memoryview:
+        """
+        Args:
+            chunk (bytes): Multipart chunk, see `frame_header`
+        Returns:
+            frame (memoryview): View of the JPEG frame of the chunk
+        """
+        return memoryview(chunk)[chunk.index(b"\r\n\r\n") + 4 : -2]
+
+    def read_chunk(
+        self, after: int = 0, timeout: float = None, latest: bool = False
+    ) -> typing.Tuple[int, typing.Optional[bytes]]:
+        """
+        Waits for a chunk newer than `after`. Returns the next chunk in
+        sequence if it's still in the ring, otherwise the oldest available.
+
+        Args:
+            after (int): Sequence number of the last chunk read
+            timeout (float): Seconds to wait. Default: wait forever
+            latest (bool): Return the newest chunk, skipping older ones
+        Returns:
+            sequence (int): Sequence number of the chunk
+            chunk (bytes): Multipart chunk or None on timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.sequence > after, timeout
+            ):
+                return after, None
+            if latest:
+                return self.ring[-1]
+            for sequence, chunk in self.ring:
+                if sequence > after:
+                    return sequence, chunk
+        return after, None
+
+
+class StreamCamera:
+    """
+    Base class for cameras that record a MJPEG stream to `stream_buffer`.
+    Subclasses implement `start_stream` and `capture_burst`.
+    """
+
+    capture_mode = "restart"
+    # Records other formats from extra splitter ports while streaming
+    splitter_ports = False
+    _setup_lock = Lock()
+
+    @property
+    def stream_buffer(self) -> JpegStreamIO:
+        if not hasattr(self, "_stream_buffer"):
+            with self._setup_lock:
+                if not hasattr(self, "_stream_buffer"):
+                    self._stream_buffer = JpegStreamIO()
+        return self._stream_buffer
+
+    @property
+    def camera_lock(self) -> typing.ContextManager:
+        """
+        Held while the camera starts the stream or takes stills, so a
+        viewer never starts recording in the middle of a capture
+        """
+        if not hasattr(self, "_camera_lock"):
+            with self._setup_lock:
+                if not hasattr(self, "_camera_lock"):
+                    self._camera_lock = RLock()
+        return self._camera_lock
+
+    def start_stream(self) -> None:
+        """
+        Starts recording to `stream_buffer` if the camera is idle and waits
+        for the first frame
+        """
+        raise NotImplementedError
+
+    def stream_generator(
+        self, fps: float = None, stream_buffer: JpegStreamIO = None
+    ) -> typing.Generator[bytes, None, None]:
+        """
+        Starts the camera and yields video stream frames. The generator
+        resumes only after the previous frame was sent, then it skips to the
+        newest frame, so slow clients don't accumulate latency.
+
+        Args:
+            fps (float): Maximum frame rate. Default: no limit
+            stream_buffer (JpegStreamIO): Ring to read the frames from, eg:
+                a `picamip.variants.VariantStreamIO`. Default:
+                `self.stream_buffer`
+        """
+        if stream_buffer is None:
+            stream_buffer = self.stream_buffer
+        self.start_stream()
+        client = StreamClient(fps, stream_buffer.sequence)
+        stream_buffer.clients.add(client)
+        try:
+            while True:
+                sleep(client.delay())
+                sequence, chunk = stream_buffer.read_chunk(
+                    client.sequence, STREAM_TIMEOUT, latest=True
+                )
+                if chunk is None:
+                    # A capture stopped the camera while nobody was viewing
+                    self.start_stream()
+                    continue
+                client.account(sequence)
+                yield chunk
+        finally:
+            stream_buffer.clients.discard(client)
+
+    def camera_settings(self) -> dict:
+        """
+        Returns:
+            settings (dict): Current camera settings, stored with the
+                pictures' metadata
+        """
+        return {}
+
+    def capture(self, filename: str) -> None:
+        """
+        Takes a still and writes it to `filename`
+
+        Args:
+            filename (str)
+        """
+        self.capture_burst([filename])
+
+    def capture_burst(self, filenames: typing.List[str]) -> None:
+        """
+        Takes one still per filename, back to back
+
+        Args:
+            filenames (list[str])
+        """
+        raise NotImplementedError
+
+    def capture_frames(
+        self, filenames: typing.List[str], timeout: float
+    ) -> None:
+        """
+        Writes one stream frame per filename, each newer than the previous.
+        Stills of the cameras that have no still port.
+
+        Args:
+            filenames (list[str])
+            timeout (float): Seconds to wait for each frame
+        Raises:
+            TimeoutError: the stream has no frames
+        """
+        self.start_stream()
+        stream_buffer = self.stream_buffer
+        sequence = max(stream_buffer.sequence - 1, 0)
+        for filename in filenames:
+            sequence, chunk = stream_buffer.read_chunk(
+                sequence, timeout, latest=True
+            )
+            if chunk is None:
+                raise TimeoutError("The stream has no frames")
+            with open(filename, "wb") as fp:
+                fp.write(stream_buffer.chunk_frame(chunk))
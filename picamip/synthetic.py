@@ -0,0 +1,152 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import io
+from threading import Event, Thread
+from time import monotonic, sleep
+import typing
+
+try:
+    from PIL import Image  # type: ignore
+except ImportError:
+    Image = None
+
+from .stream import StreamCamera
+
+FRAMES = 30
+STREAM_READY_TIMEOUT = 5.0
+# Typical size of a camera JPEG relative to its number of pixels
+BYTES_PER_PIXEL = 0.1
+
+
+def make_jpeg(
+    resolution: typing.Tuple[int, int], step: int = 0, steps: int = 1
+) -> bytes:
+    """
+    Builds a synthetic JPEG of `resolution` with a bar at position
+    `step`/`steps`. Without Pillow the result only has the JPEG markers and
+    the typical size of a camera frame, which is enough for the stream.
+
+    Args:
+        resolution (tuple[int, int]): (width, height)
+        step (int): Position of the bar
+        steps (int): Number of positions
+    Returns:
+        jpeg (bytes)
+    """
+    width, height = resolution
+    if Image is None:
+        size = max(int(width * height * BYTES_PER_PIXEL), 4)
+        return b"\xff\xd8" + bytes([step % 256]) * (size - 4) + b"\xff\xd9"
+    image = Image.new("RGB", resolution, (32, 32, 32))
+    bar = Image.new("RGB", (max(width // steps, 1), height), (200, 80, 40))
+    image.paste(bar, (width * step // steps, 0))
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=85)
+    return output.getvalue()
+
+
+class SyntheticCamera(StreamCamera):
+    """
+    Camera without hardware. Writes synthetic MJPEG frames to
+    `stream_buffer` at `framerate`, through the same `JpegStreamIO` path as
+    the Raspberry Pi camera, and writes synthetic stills.
+
+    Args:
+        resolution (tuple[int, int]): Stream resolution
+        framerate (float): Stream frame rate
+        still_resolution (tuple[int, int]): Stills resolution
+        capture_latency (float): Simulated seconds to take a still
+        frames (int): Number of distinct frames in the stream
+    """
+
+    def __init__(
+        self,
+        resolution: typing.Tuple[int, int] = (640, 480),
+        framerate: float = 30,
+        still_resolution: typing.Tuple[int, int] = (2592, 1944),
+        capture_latency: float = 0.0,
+        frames: int = FRAMES,
+    ):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.capture_latency = capture_latency
+        self.frames = [make_jpeg(resolution, i, frames) for i in range(frames)]
+        self.still_resolution = still_resolution
+        self.still = make_jpeg(still_resolution)
+        self.recording = False
+        self._stop = Event()
+        self._thread: typing.Optional[Thread] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self.recording:
+            self.stop_recording()
+
+    def start_recording(self, output: typing.BinaryIO, **kwargs) -> None:
+        self._stop.clear()
+        self._thread = Thread(target=self._record, args=(output,), daemon=True)
+        self.recording = True
+        self._thread.start()
+
+    def stop_recording(self, **kwargs) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.recording = False
+
+    def _record(self, output: typing.BinaryIO) -> None:
+        interval = 1 / self.framerate
+        next_time = monotonic()
+        count = 0
+        while not self._stop.is_set():
+            output.write(self.frames[count % len(self.frames)])
+            count += 1
+            next_time += interval
+            delay = next_time - monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                # Behind schedule, skip the missed frames
+                next_time = monotonic()
+
+    def start_stream(self) -> None:
+        with self.camera_lock:
+            if self.recording:
+                return
+            sequence = self.stream_buffer.sequence
+            self.start_recording(self.stream_buffer)
+            self.stream_buffer.read_chunk(sequence, STREAM_READY_TIMEOUT)
+
+    def camera_settings(self) -> dict:
+        return {"resolution": list(self.still_resolution)}
+
+    def capture_burst(self, filenames: typing.List[str]) -> None:
+        with self.camera_lock:
+            restart = self.capture_mode == "restart"
+            if restart and self.recording:
+                self.stop_recording()
+            for filename in filenames:
+                sleep(self.capture_latency)
+                with open(filename, "wb") as fp:
+                    fp.write(self.still)
+            if restart and self.stream_buffer.clients:
+                self.start_recording(self.stream_buffer)
@@ -0,0 +1,372 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
+from os import path
+import os
+import struct
+from threading import Lock
+import typing
+
+from . import optional, storage
+
+THUMBNAIL_SIZES = [64, 160, 320, 640]
+THUMBNAIL_QUALITY = 80
+MEMORY_CACHE_BYTES = 8 * 1024 * 1024
+DISK_CACHE_BYTES = 64 * 1024 * 1024
+CACHE_DIRNAME = ".thumbnails"
+EXIF_READ_BYTES = 64 * 1024
+WORKERS = 2
+
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data: bytes) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Reads the dimensions of a JPEG from its SOF segment
+
+    Args:
+        data (bytes): JPEG data
+    Returns:
+        size (tuple[int, int]): (width, height) or None if not found
+    """
+    position = 2
+    while position + 9 < len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", data, position + 5)
+            return width, height
+        (length,) = struct.unpack_from(">H", data, position + 2)
+        position += 2 + length
+    return None
+
+
+def exif_thumbnail(data: bytes) -> typing.Optional[bytes]:
+    """
+    Extracts the JPEG thumbnail embedded in the EXIF (APP1) segment
+
+    Args:
+        data (bytes): Beginning of the JPEG file. The APP1 segment is
+            usually within the first 64 KiB.
+    Returns:
+        thumbnail (bytes): Embedded JPEG or None if there is none
+    """
+    if not data.startswith(b"\xff\xd8"):
+        return None
+    position = 2
+    while position + 4 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        (length,) = struct.unpack_from(">H", data, position + 2)
+        if marker == 0xE1 and data[position + 4 : position + 10] == (
+            b"Exif\x00\x00"
+        ):
+            return _tiff_thumbnail(data[position + 10 : position + 2 + length])
+        if marker == 0xDA:
+            return None
+        position += 2 + length
+    return None
+
+
+def _tiff_thumbnail(tiff: bytes) -> typing.Optional[bytes]:
+    try:
+        order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        (ifd0,) = struct.unpack_from(order + "L", tiff, 4)
+        (count,) = struct.unpack_from(order + "H", tiff, ifd0)
+        (ifd1,) = struct.unpack_from(order + "L", tiff, ifd0 + 2 + 12 * count)
+        if ifd1 == 0:
+            return None
+        (count,) = struct.unpack_from(order + "H", tiff, ifd1)
+        tags = {}
+        for i in range(count):
+            tag, _, _, value = struct.unpack_from(
+                order + "HHLL", tiff, ifd1 + 2 + 12 * i
+            )
+            tags[tag] = value
+        offset, length = tags[0x0201], tags[0x0202]
+    except (KeyError, struct.error):
+        return None
+    thumbnail = tiff[offset : offset + length]
+    if len(thumbnail) != length or not thumbnail.startswith(b"\xff\xd8"):
+        return None
+    return thumbnail
+
+
+def downscale(filename: str, size: int, quality: int) -> bytes:
+    """
+    Downscales the JPEG `filename` to fit in a `size` x `size` box
+
+    Args:
+        filename (str)
+        size (int): Maximum width and height
+        quality (int): JPEG quality
+    Returns:
+        thumbnail (bytes): JPEG data
+    """
+    Image = optional.load("PIL.Image")
+    with Image.open(filename) as image:
+        # Lets the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding
+        image.draft("RGB", (size, size))
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=quality)
+    return output.getvalue()
+
+
+def best_size(size: int) -> int:
+    """
+    Rounds `size` up to the next size in THUMBNAIL_SIZES
+    """
+    for candidate in THUMBNAIL_SIZES:
+        if size <= candidate:
+            return candidate
+    return THUMBNAIL_SIZES[-1]
+
+
+class ThumbnailCache:
+    """
+    Thumbnails of the pictures of an `IndexedFilesStorage`.
+
+    The embedded EXIF thumbnail is used when it's large enough, otherwise
+    the picture is downscaled in a pool of `workers` threads (requires
+    Pillow). The results are kept in a LRU in memory and in a LRU on disk
+    at `{directory}/.thumbnails`, both bounded by size in bytes. Entries
+    are dropped when the storage deletes the picture.
+
+    Args:
+        pictures_storage (picamip.storage.IndexedFilesStorage)
+        memory_bytes (int): Size of the memory cache
+        disk_bytes (int): Size of the disk cache
+        workers (int): Number of downscaling threads
+        quality (int): JPEG quality of the downscaled thumbnails
+    """
+
+    def __init__(
+        self,
+        pictures_storage: storage.IndexedFilesStorage,
+        memory_bytes: int = MEMORY_CACHE_BYTES,
+        disk_bytes: int = DISK_CACHE_BYTES,
+        workers: int = WORKERS,
+        quality: int = THUMBNAIL_QUALITY,
+    ):
+        self.storage = pictures_storage
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.quality = quality
+        self.directory = path.join(pictures_storage.directory, CACHE_DIRNAME)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = Lock()
+        self._memory: typing.Dict[tuple, bytes] = OrderedDict()
+        self._memory_used = 0
+        self._disk: typing.Dict[str, int] = OrderedDict()
+        self._disk_used = 0
+        self._by_index: typing.Dict[int, typing.Set[tuple]] = {}
+        self._pending: typing.Dict[tuple, Future] = {}
+        self._load_disk()
+        pictures_storage.delete_callbacks.append(self.invalidate)
+
+    def _load_disk(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            filename = path.join(self.directory, name)
+            if not path.isfile(filename):
+                continue
+            key = self._disk_key(name)
+            if key is None:
+                os.remove(filename)
+                continue
+            stat = os.stat(filename)
+            entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[self._disk_name(key)] = size
+            self._disk_used += size
+            self._by_index.setdefault(key[0], set()).add(key)
+
+    @staticmethod
+    def _disk_name(key: tuple) -> str:
+        return "{}_{}_{}.jpg".format(*key)
+
+    @staticmethod
+    def _disk_key(name: str) -> typing.Optional[tuple]:
+        try:
+            stem, extension = name.split(".")
+            key = tuple(int(n) for n in stem.split("_"))
+        except ValueError:
+            return None
+        if extension != "jpg" or len(key) != 3:
+            return None
+        return key
+
+    def _forget(self, key: tuple) -> None:
+        """
+        Drops `key` from `_by_index` once it's in neither cache. Must be
+        called with `_lock` held.
+        """
+        if key in self._memory or self._disk_name(key) in self._disk:
+            return
+        keys = self._by_index.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_index[key[0]]
+
+    def _remember(self, key: tuple, data: bytes) -> None:
+        """
+        Stores `data` in the memory LRU. Must be called with `_lock` held.
+        """
+        if key in self._memory:
+            return
+        self._memory[key] = data
+        self._memory_used += len(data)
+        self._by_index.setdefault(key[0], set()).add(key)
+        while self._memory_used > self.memory_bytes:
+            old_key, evicted = self._memory.popitem(last=False)  # type: ignore
+            self._memory_used -= len(evicted)
+            self._forget(old_key)
+
+    def _store(self, key: tuple, data: bytes) -> None:
+        name = self._disk_name(key)
+        filename = path.join(self.directory, name)
+        with open(filename + ".tmp", "wb") as fp:
+            fp.write(data)
+        os.replace(filename + ".tmp", filename)
+        with self._lock:
+            # Rewritten, eg: a concurrent build of the same key
+            self._disk_used -= self._disk.pop(name, 0)
+            self._disk[name] = len(data)
+            self._disk_used += len(data)
+            self._by_index.setdefault(key[0], set()).add(key)
+            evicted = []
+            while self._disk_used > self.disk_bytes and self._disk:
+                old_name, size = self._disk.popitem(last=False)  # type: ignore
+                self._disk_used -= size
+                self._forget(self._disk_key(old_name))  # type: ignore
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+
+    def _load(self, key: tuple) -> typing.Optional[bytes]:
+        name = self._disk_name(key)
+        with self._lock:
+            known = name in self._disk
+            if known:
+                self._disk.move_to_end(name)  # type: ignore
+        try:
+            with open(path.join(self.directory, name), "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return None
+        if not known:
+            # Written by another process, eg: the post-capture pipeline
+            self._adopt(key, len(data))
+        return data
+
+    def _adopt(self, key: tuple, size: int) -> None:
+        name = self._disk_name(key)
+        with self._lock:
+            if name in self._disk:
+                return
+            self._disk[name] = size
+            self._disk_used += size
+            self._by_index.setdefault(key[0], set()).add(key)
+
+    def _build(self, key: tuple, filename: str, size: int) -> bytes:
+        data = self._load(key)
+        if data is None:
+            with open(filename, "rb") as fp:
+                thumbnail = exif_thumbnail(fp.read(EXIF_READ_BYTES))
+            thumbnail_size = jpeg_size(thumbnail) if thumbnail else None
+            pillow = optional.available("PIL")
+            if thumbnail is not None and (
+                not pillow or (thumbnail_size and max(thumbnail_size) >= size)
+            ):
+                data = thumbnail
+            elif pillow:
+                try:
+                    data = downscale(filename, size, self.quality)
+                except OSError as error:
+                    raise LookupError(f"Cannot decode {filename}") from error
+            else:
+                raise LookupError(f"No thumbnail for {filename}")
+            self._store(key, data)
+        with self._lock:
+            self._remember(key, data)
+        return data
+
+    def get(self, index: int, size: int) -> typing.Tuple[tuple, bytes]:
+        """
+        Gets the thumbnail of `index`
+
+        Args:
+            index (int)
+            size (int): Maximum width and height, rounded up to one of
+                THUMBNAIL_SIZES
+        Returns:
+            key (tuple): (index, size, mtime_ns) of the thumbnail
+            thumbnail (bytes): JPEG data
+        Raises:
+            KeyError: index is not in the storage
+            LookupError: The picture has no EXIF thumbnail and can't be
+                downscaled (Pillow is not installed or can't decode it)
+        """
+        filename = path.join(self.storage.directory, self.storage[index])
+        size = best_size(size)
+        try:
+            mtime_ns = os.stat(filename).st_mtime_ns
+        except FileNotFoundError:
+            raise KeyError(index)
+        key = (index, size, mtime_ns)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)  # type: ignore
+                return key, data
+            future = self._pending.get(key)
+            if future is None:
+                future = self.executor.submit(self._build, key, filename, size)
+                self._pending[key] = future
+        try:
+            return key, future.result()
+        finally:
+            with self._lock:
+                if self._pending.get(key) is future and future.done():
+                    self._pending.pop(key)
+
+    def invalidate(self, index: int) -> None:
+        """
+        Drops the cached thumbnails of `index`
+        """
+        names = []
+        with self._lock:
+            for key in self._by_index.pop(index, ()):
+                if key in self._memory:
+                    self._memory_used -= len(self._memory.pop(key))
+                name = self._disk_name(key)
+                if name in self._disk:
+                    self._disk_used -= self._disk.pop(name)
+                    names.append(name)
+        for name in names:
+            try:
+                os.remove(path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
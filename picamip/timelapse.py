@@ -0,0 +1,144 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+from threading import Event, Lock, Thread
+import time
+from time import monotonic
+import typing
+
+from . import capture, metrics
+
+
+class TimelapseScheduler:
+    """
+    Takes a picture every `interval` seconds through a `CaptureQueue`.
+
+    The shots are scheduled on a grid of the monotonic clock, starting
+    when the time-lapse starts, so the delays of the captures don't add
+    up. When a capture takes longer than the interval, the slots that
+    were missed are skipped and counted instead of being taken late.
+
+    Args:
+        capture_queue (picamip.capture.CaptureQueue)
+    """
+
+    def __init__(self, capture_queue: capture.CaptureQueue):
+        self.capture_queue = capture_queue
+        self.interval: typing.Optional[float] = None
+        self.count: typing.Optional[int] = None
+        self.started: typing.Optional[float] = None
+        self.shots = 0
+        self.skipped = 0
+        self.failed = 0
+        self.last_index: typing.Optional[int] = None
+        self.error: typing.Optional[str] = None
+        self._next_time: typing.Optional[float] = None
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread: typing.Optional[Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float, count: int = None) -> None:
+        """
+        Starts a time-lapse, replacing the running one
+
+        Args:
+            interval (float): Seconds between shots
+            count (int): Number of shots. Default: until stopped
+        Raises:
+            ValueError: interval or count are not positive
+        """
+        if not interval > 0:
+            raise ValueError(f"interval must be positive, got {interval}")
+        if count is not None and count <= 0:
+            raise ValueError(f"count must be positive, got {count}")
+        with self._lock:
+            self._halt()
+            self.interval = interval
+            self.count = count
+            self.started = time.time()
+            self.shots = self.skipped = self.failed = 0
+            self.last_index = None
+            self.error = None
+            self._stop = Event()
+            self._thread = Thread(
+                target=self._run, args=(self._stop, monotonic()), daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the time-lapse. A capture in progress is finished.
+        """
+        with self._lock:
+            self._halt()
+
+    def _halt(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._next_time = None
+
+    def _run(self, stop: Event, start: float) -> None:
+        slot = 0
+        while self.count is None or self.shots + self.failed < self.count:
+            self._next_time = start + slot * self.interval
+            if stop.wait(max(self._next_time - monotonic(), 0)):
+                return
+            try:
+                job = self.capture_queue.submit()
+            except IndexError as error:
+                self.error = str(error)
+                break
+            job.wait()
+            if job.status == capture.CaptureJob.DONE:
+                self.shots += 1
+                self.last_index = job.indexes[-1]
+                metrics.TIMELAPSE_SHOTS.inc()
+            else:
+                self.failed += 1
+                self.error = job.error
+            # First slot that hasn't passed yet
+            elapsed = (monotonic() - start) / self.interval
+            next_slot = max(slot + 1, math.ceil(elapsed))
+            if next_slot > slot + 1:
+                self.skipped += next_slot - slot - 1
+                metrics.TIMELAPSE_SKIPPED.inc(next_slot - slot - 1)
+            slot = next_slot
+        self._next_time = None
+
+    def to_dict(self) -> dict:
+        next_time = self._next_time
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "count": self.count,
+            "started": self.started,
+            "shots": self.shots,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "last_index": self.last_index,
+            "next_shot_in": (
+                max(next_time - monotonic(), 0.0)
+                if next_time is not None and self.running
+                else None
+            ),
+            "error": self.error,
+        }
@@ -0,0 +1,245 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import io
+import logging
+from threading import Lock, Thread
+from time import monotonic, perf_counter
+import typing
+
+from . import metrics, optional, stream
+
+VARIANT_QUALITY = 75
+MIN_WIDTH = 16
+MAX_VARIANTS = 8
+WORKERS = 2
+# The dispatcher keeps running this long without viewers, so a viewer
+# that is connecting doesn't restart it
+IDLE_SECONDS = 2.0
+
+logger = logging.getLogger(__name__)
+
+VariantKey = typing.Tuple[typing.Optional[int], int]
+
+
+def parse_variant(
+    width: typing.Optional[str], quality: typing.Optional[str]
+) -> typing.Optional[VariantKey]:
+    """
+    Parses the `width` and `quality` query parameters of the stream
+
+    Args:
+        width (str): Maximum width or None
+        quality (str): JPEG quality, 1-95, or None
+    Returns:
+        variant (tuple[int, int]): (width, quality), or None for the
+            original stream. width is None to keep the original width.
+    Raises:
+        ValueError: invalid width or quality
+    """
+    if width is None and quality is None:
+        return None
+    value = int(width) if width is not None else None
+    if value is not None and value < MIN_WIDTH:
+        raise ValueError(f"width must be at least {MIN_WIDTH}, got {width}")
+    level = int(quality) if quality is not None else VARIANT_QUALITY
+    if not 1 <= level <= 95:
+        raise ValueError(f"quality must be in [1, 95], got {quality}")
+    return value, level
+
+
+def encode(
+    frame: typing.Union[bytes, memoryview],
+    width: typing.Optional[int],
+    quality: int,
+) -> bytes:
+    """
+    Re-encodes a JPEG frame, downscaled to at most `width` pixels wide.
+    The frame is decoded at the smallest scale of 1/2, 1/4 or 1/8 that is
+    still larger than the result.
+
+    Args:
+        frame (bytes): JPEG, or a view of it
+        width (int): Maximum width or None to keep the width
+        quality (int): JPEG quality
+    Returns:
+        jpeg (bytes)
+    """
+    Image = optional.load("PIL.Image")
+    image = Image.open(io.BytesIO(frame))
+    source_width, source_height = image.size
+    width = min(width or source_width, source_width)
+    size = (width, max(round(source_height * width / source_width), 1))
+    image.draft("RGB", size)
+    if image.size != size:
+        image = image.resize(size, Image.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=quality)
+    return output.getvalue()
+
+
+class VariantStreamIO(stream.JpegStreamIO):
+    """
+    Ring of the frames of the stream re-encoded at `width` and `quality`.
+    Viewers read it like the camera `stream_buffer`.
+
+    Args:
+        width (int): Maximum width or None to keep the width
+        quality (int): JPEG quality
+    """
+
+    def __init__(self, width: typing.Optional[int], quality: int):
+        super().__init__()
+        self.width = width
+        self.quality = quality
+        self.pending: typing.Optional[Future] = None
+        self.requested = monotonic()
+        self.skipped = 0
+
+    def publish(self, chunk: bytes) -> int:
+        return self._append(chunk)
+
+    def encode(self, frame: typing.Union[bytes, memoryview]) -> None:
+        start = perf_counter()
+        try:
+            data = encode(frame, self.width, self.quality)
+        except OSError as error:
+            logger.warning(f"Skipping a frame that can't be decoded: {error}")
+            return
+        self.publish_frame(data)
+        metrics.VARIANT_SECONDS.observe(perf_counter() - start)
+        metrics.VARIANT_FRAMES.inc()
+
+
+class StreamVariants:
+    """
+    Re-encoded versions of the camera stream, shared by all their viewers.
+
+    A single dispatcher thread reads the camera frames while any variant
+    has viewers, and hands the newest frame of each variant to a pool of
+    `workers` threads. A variant that is still encoding the previous frame
+    skips the new one, so each variant is encoded at most once per camera
+    frame and the cost grows with the number of variants, not viewers.
+
+    Args:
+        camera (picamip.stream.StreamCamera)
+        max_variants (int): Maximum number of variants at once
+        workers (int): Encoding threads
+    """
+
+    def __init__(
+        self,
+        camera: stream.StreamCamera,
+        max_variants: int = MAX_VARIANTS,
+        workers: int = WORKERS,
+    ):
+        self.camera = camera
+        self.max_variants = max_variants
+        self.variants: typing.Dict[VariantKey, VariantStreamIO] = {}
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="picamip-variants"
+        )
+        self._lock = Lock()
+        self._requested = 0.0
+        self._thread: typing.Optional[Thread] = None
+
+    def __len__(self):
+        return len(self.variants)
+
+    @property
+    def clients(self) -> int:
+        return sum(len(v.clients) for v in list(self.variants.values()))
+
+    def get(
+        self, width: typing.Optional[int], quality: int
+    ) -> VariantStreamIO:
+        """
+        Gets the ring of a variant and starts encoding it. The encoding
+        stops when the variant has no viewers.
+
+        Args:
+            width (int): Maximum width or None to keep the width
+            quality (int): JPEG quality
+        Returns:
+            variant (VariantStreamIO)
+        Raises:
+            ImportError: Pillow is not installed
+            LookupError: there are `max_variants` variants in use
+        """
+        if not optional.available("PIL"):
+            raise ImportError(
+                "Stream variants require Pillow: pip install Pillow"
+            )
+        with self._lock:
+            variant = self.variants.get((width, quality))
+            if variant is None:
+                if len(self.variants) >= self.max_variants:
+                    now = monotonic()
+                    for key, idle in list(self.variants.items()):
+                        if (
+                            not idle.clients
+                            and now - idle.requested > IDLE_SECONDS
+                        ):
+                            del self.variants[key]
+                if len(self.variants) >= self.max_variants:
+                    raise LookupError("Too many stream variants")
+                variant = VariantStreamIO(width, quality)
+                self.variants[(width, quality)] = variant
+            variant.requested = self._requested = monotonic()
+            if self._thread is None:
+                self._thread = Thread(target=self._dispatch, daemon=True)
+                self._thread.start()
+        return variant
+
+    def _dispatch(self) -> None:
+        stream_buffer = self.camera.stream_buffer
+        # Keeps the stream running after stills in the "restart" mode
+        client = stream.StreamClient()
+        stream_buffer.clients.add(client)
+        try:
+            self.camera.start_stream()
+            sequence = stream_buffer.sequence
+            while True:
+                with self._lock:
+                    active = [v for v in self.variants.values() if v.clients]
+                    if not active and (
+                        monotonic() - self._requested > IDLE_SECONDS
+                    ):
+                        self._thread = None
+                        return
+                sequence, chunk = stream_buffer.read_chunk(
+                    sequence, stream.STREAM_TIMEOUT, latest=True
+                )
+                if chunk is None:
+                    # A capture stopped the camera
+                    self.camera.start_stream()
+                    continue
+                frame = stream_buffer.chunk_frame(chunk)
+                for variant in active:
+                    if variant.pending is None or variant.pending.done():
+                        variant.pending = self._executor.submit(
+                            variant.encode, frame
+                        )
+                    else:
+                        variant.skipped += 1
+                        metrics.VARIANT_SKIPPED.inc()
+        except Exception:
+            logger.exception("Stream variants failed")
+            with self._lock:
+                self._thread = None
+        finally:
+            stream_buffer.clients.discard(client)
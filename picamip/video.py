@@ -0,0 +1,254 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+from threading import Event, Lock, Thread
+from time import monotonic
+import typing
+
+from . import metrics, storage, stream
+
+if typing.TYPE_CHECKING:
+    from .picamera import StreamPiCamera
+
+VIDEO_MODES = ["segments", "circular"]
+VIDEO_SUFFIX = ".h264"
+VIDEO_INDEX_DIGITS = 6
+VIDEO_PORT = 2
+VIDEO_RESOLUTION = (1280, 960)
+VIDEO_BITRATE = 4000000
+SEGMENT_SECONDS = 60.0
+PRE_EVENT_SECONDS = 10.0
+
+logger = logging.getLogger(__name__)
+
+
+class VideoRecorder:
+    """
+    Records H.264 from the splitter port `VIDEO_PORT` of the camera while
+    the MJPEG stream keeps running on its own port. The sensor must stay
+    at the same resolution for both, so the camera must take stills in
+    the "video_port" capture mode.
+
+    Modes:
+        segments: Writes files of `segment_seconds` to `video_storage`.
+            Segments are split on the first keyframe after each boundary
+            of a fixed schedule.
+        circular: Keeps the last `pre_event_seconds` in memory, in a
+            `picamera.PiCameraCircularIO`. `trigger` writes them to
+            `video_storage`, so nothing is written to the SD card until
+            something happens.
+
+    The retention policy of `video_storage` is applied after every file.
+
+    Args:
+        camera (picamip.picamera.StreamPiCamera)
+        video_storage (picamip.storage.IndexedFilesStorage)
+        mode (str): One of VIDEO_MODES
+        segment_seconds (float): Length of the segments
+        pre_event_seconds (float): Seconds kept by the circular buffer
+        resolution (tuple[int, int]): Video resolution
+        bitrate (int): Video bitrate in bits per second
+    """
+
+    def __init__(
+        self,
+        camera: stream.StreamCamera,
+        video_storage: storage.IndexedFilesStorage,
+        mode: str = "segments",
+        segment_seconds: float = SEGMENT_SECONDS,
+        pre_event_seconds: float = PRE_EVENT_SECONDS,
+        resolution: typing.Tuple[int, int] = VIDEO_RESOLUTION,
+        bitrate: int = VIDEO_BITRATE,
+    ):
+        if mode not in VIDEO_MODES:
+            raise ValueError(f"mode must be one of {VIDEO_MODES}")
+        if not segment_seconds > 0 or not pre_event_seconds > 0:
+            raise ValueError("segment and pre-event seconds must be positive")
+        # Cameras with splitter ports, see `picamip.server.run`
+        self.camera = typing.cast("StreamPiCamera", camera)
+        self.storage = video_storage
+        self.mode = mode
+        self.segment_seconds = segment_seconds
+        self.pre_event_seconds = pre_event_seconds
+        self.resolution = resolution
+        self.bitrate = bitrate
+        self.buffer: typing.Any = None
+        self.current: typing.Optional[int] = None
+        self.error: typing.Optional[str] = None
+        self._lock = Lock()
+        self._trigger_lock = Lock()
+        self._stop = Event()
+        self._thread: typing.Optional[Thread] = None
+
+    @property
+    def recording(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _reserve(self) -> int:
+        with self._lock:
+            index = max(self.storage.last_index, self.current or 0) + 1
+            self.storage.make_filename(index)  # Raises IndexError
+            # Hidden from the listing and the retention until _finish
+            self.storage.start_writing(index)
+            return index
+
+    def start(self) -> None:
+        """
+        Starts the stream, if needed, and the H.264 recording
+        """
+        if self.camera.capture_mode != "video_port":
+            raise ValueError(
+                "video recording requires the 'video_port' capture mode"
+            )
+        if self.recording:
+            return
+        self.camera.start_stream()
+        options = dict(
+            format="h264",
+            splitter_port=VIDEO_PORT,
+            resize=self.resolution,
+            bitrate=self.bitrate,
+        )
+        if self.mode == "circular":
+            from picamera import PiCameraCircularIO  # type: ignore
+
+            self.buffer = PiCameraCircularIO(
+                self.camera,
+                seconds=self.pre_event_seconds,
+                bitrate=self.bitrate,
+                splitter_port=VIDEO_PORT,
+            )
+            output = self.buffer
+        else:
+            self.current = self._reserve()
+            output = self.storage.make_filename(self.current)
+        try:
+            with self.camera.camera_lock:
+                self.camera.start_recording(output, **options)
+        except Exception:
+            self._cancel()
+            raise
+        self.error = None
+        self._stop = Event()
+        self._thread = Thread(
+            target=self._run, args=(self._stop,), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the H.264 recording. The current segment is kept.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self.camera.camera_lock:
+            try:
+                self.camera.stop_recording(splitter_port=VIDEO_PORT)
+            except Exception as error:
+                # The encoder failed or it wasn't recording
+                logger.warning(f"Stopping the video recording: {error}")
+        finished, self.current = self.current, None
+        if finished is not None:
+            self._finish(finished)
+        self.buffer = None
+
+    def _run(self, stop: Event) -> None:
+        start = monotonic()
+        boundary = 1
+        while not stop.wait(
+            max(start + boundary * self.segment_seconds - monotonic(), 0)
+        ):
+            try:
+                # Raises the errors of the encoder
+                self.camera.wait_recording(0, splitter_port=VIDEO_PORT)
+                if self.mode == "segments":
+                    self._split()
+            except Exception as error:
+                logger.exception("Video recording failed")
+                self.error = str(error)
+                return
+            # Boundaries missed by a slow split are skipped
+            elapsed = (monotonic() - start) / self.segment_seconds
+            boundary = max(boundary + 1, int(elapsed) + 1)
+
+    def _split(self) -> None:
+        finished = self.current
+        index = self._reserve()
+        try:
+            # Blocks until the next keyframe
+            self.camera.split_recording(
+                self.storage.make_filename(index), splitter_port=VIDEO_PORT
+            )
+        except Exception:
+            # The recording goes on in the current segment, if at all
+            self.storage.cancel_writing(index)
+            raise
+        self.current = index
+        self._finish(finished)
+
+    def _cancel(self) -> None:
+        """
+        Releases the segment reserved by `start` when the recording didn't
+        start
+        """
+        cancelled, self.current = self.current, None
+        if cancelled is not None:
+            self.storage.cancel_writing(cancelled)
+
+    def _finish(self, index: int) -> None:
+        # Applies the retention policy
+        self.storage.register(index)
+        metrics.VIDEO_FILES.inc()
+
+    def trigger(self) -> int:
+        """
+        Writes the last `pre_event_seconds` of the circular buffer to the
+        storage
+
+        Returns:
+            index (int): Index of the clip
+        Raises:
+            RuntimeError: The circular buffer isn't recording
+        """
+        buffer = self.buffer
+        if self.mode != "circular" or not self.recording or buffer is None:
+            raise RuntimeError("The circular buffer isn't recording")
+        with self._trigger_lock:
+            index = self._reserve()
+            try:
+                # copy_to holds the buffer lock and starts at a SPS header,
+                # so the clip can be played on its own
+                buffer.copy_to(
+                    self.storage.make_filename(index),
+                    seconds=self.pre_event_seconds,
+                )
+            except Exception:
+                self.storage.cancel_writing(index)
+                raise
+            self._finish(index)
+        return index
+
+    def to_dict(self) -> dict:
+        return {
+            "mode": self.mode,
+            "recording": self.recording,
+            "files": len(self.storage),
+            "current": self.current,
+            "last_index": self.storage.last_index,
+            "error": self.error,
+        }
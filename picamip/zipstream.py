@@ -0,0 +1,360 @@
+"""
+Python simple Raspberry-Pi camera module web interface
+Copyright (C) 2021 Luiz Eduardo Amaral <luizamaral306@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import struct
+from threading import Lock
+import time
+import typing
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+# CRCs of the files streamed recently, ~200 bytes each
+CRC_CACHE_ENTRIES = 10000
+ZIP32_LIMIT = (1 << 31) - 1
+ZIP32_MAX_ENTRIES = 0xFFFF
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHLLLHH")
+DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+DATA_DESCRIPTOR64 = struct.Struct("<4sLQQ")
+CENTRAL_HEADER = struct.Struct("<4sHHHHHHLLLHHHHHLL")
+ZIP64_LOCAL_EXTRA = struct.Struct("<HHQQ")
+ZIP64_CENTRAL_EXTRA = struct.Struct("<HHQQQ")
+END_RECORD = struct.Struct("<4sHHHHLLH")
+END_RECORD64 = struct.Struct("<4sQHHLLQQQQ")
+END_LOCATOR64 = struct.Struct("<4sLQL")
+
+FLAG_DATA_DESCRIPTOR = 0x08
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+
+_crc_cache: typing.Dict[typing.Tuple[str, int, int], int] = OrderedDict()
+_crc_lock = Lock()
+
+
+def _cached_crc(key: typing.Tuple[str, int, int]) -> typing.Optional[int]:
+    with _crc_lock:
+        crc = _crc_cache.get(key)
+        if crc is not None:
+            _crc_cache.move_to_end(key)  # type: ignore
+        return crc
+
+
+def _cache_crc(key: typing.Tuple[str, int, int], crc: int) -> None:
+    with _crc_lock:
+        _crc_cache[key] = crc
+        _crc_cache.move_to_end(key)  # type: ignore
+        while len(_crc_cache) > CRC_CACHE_ENTRIES:
+            _crc_cache.popitem(last=False)  # type: ignore
+
+
+class _Entry:
+    def __init__(self, filename: str, arcname: str):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.arcname = arcname.encode("utf-8")
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.offset = 0
+        self.crc: typing.Optional[int] = None
+        t = time.localtime(stat.st_mtime)
+        year = max(t.tm_year, 1980)
+        self.dos_date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+        self.dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+    @property
+    def cache_key(self) -> typing.Tuple[str, int, int]:
+        return (self.filename, self.size, self.mtime_ns)
+
+
+class ZipStream:
+    """
+    Streaming ZIP archive of stored (uncompressed) entries.
+
+    The archive is generated while the files are read, with bounded
+    memory and without temporary files. Since the entries are stored
+    the length of the archive is known before any file is read, which
+    allows sending `Content-Length` and serving byte ranges.
+
+    Args:
+        files (list[tuple[str, str]]): List of (filename, arcname). Files
+            that don't exist are skipped.
+        chunk_size (int): Size of the chunks read from the files
+    """
+
+    def __init__(
+        self,
+        files: typing.Iterable[typing.Tuple[str, str]],
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        self.entries = []
+        for filename, arcname in files:
+            try:
+                self.entries.append(_Entry(filename, arcname))
+            except FileNotFoundError:
+                continue
+        self.chunk_size = chunk_size
+        self.zip64 = False
+        self._layout()
+        if (
+            self.central_offset + self.central_size > ZIP32_LIMIT
+            or len(self.entries) >= ZIP32_MAX_ENTRIES
+        ):
+            self.zip64 = True
+            self._layout()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        yield from self.generate()
+
+    @property
+    def etag(self) -> str:
+        """
+        Returns:
+            etag (str): Digest of the names, sizes and mtimes of the entries
+        """
+        digest = hashlib.sha1()
+        for entry in self.entries:
+            digest.update(entry.arcname)
+            digest.update(struct.pack("<QQ", entry.size, entry.mtime_ns))
+        return digest.hexdigest()
+
+    def _local_header_size(self, entry: _Entry) -> int:
+        extra = ZIP64_LOCAL_EXTRA.size if self.zip64 else 0
+        return LOCAL_HEADER.size + len(entry.arcname) + extra
+
+    def _descriptor_size(self) -> int:
+        if self.zip64:
+            return DATA_DESCRIPTOR64.size
+        return DATA_DESCRIPTOR.size
+
+    def _central_header_size(self, entry: _Entry) -> int:
+        extra = ZIP64_CENTRAL_EXTRA.size if self.zip64 else 0
+        return CENTRAL_HEADER.size + len(entry.arcname) + extra
+
+    def _end_size(self) -> int:
+        if self.zip64:
+            return END_RECORD64.size + END_LOCATOR64.size + END_RECORD.size
+        return END_RECORD.size
+
+    def _layout(self) -> None:
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset += (
+                self._local_header_size(entry)
+                + entry.size
+                + self._descriptor_size()
+            )
+        self.central_offset = offset
+        self.central_size = sum(
+            self._central_header_size(entry) for entry in self.entries
+        )
+        self.length = self.central_offset + self.central_size
+        self.length += self._end_size()
+
+    def _local_header(self, entry: _Entry) -> bytes:
+        if self.zip64:
+            version, size = VERSION_ZIP64, 0xFFFFFFFF
+            extra = ZIP64_LOCAL_EXTRA.pack(1, 16, 0, 0)
+        else:
+            version, size, extra = VERSION_DEFAULT, 0, b""
+        return (
+            LOCAL_HEADER.pack(
+                b"PK\x03\x04",
+                version,
+                FLAG_DATA_DESCRIPTOR,
+                0,
+                entry.dos_time,
+                entry.dos_date,
+                0,
+                size,
+                size,
+                len(entry.arcname),
+                len(extra),
+            )
+            + entry.arcname
+            + extra
+        )
+
+    def _descriptor(self, entry: _Entry) -> bytes:
+        self._ensure_crc(entry)
+        fmt = DATA_DESCRIPTOR64 if self.zip64 else DATA_DESCRIPTOR
+        return fmt.pack(b"PK\x07\x08", entry.crc, entry.size, entry.size)
+
+    def _central_header(self, entry: _Entry) -> bytes:
+        self._ensure_crc(entry)
+        if self.zip64:
+            version = VERSION_ZIP64
+            size = offset = 0xFFFFFFFF
+            extra = ZIP64_CENTRAL_EXTRA.pack(
+                1, 24, entry.size, entry.size, entry.offset
+            )
+        else:
+            version, size, offset = VERSION_DEFAULT, entry.size, entry.offset
+            extra = b""
+        return (
+            CENTRAL_HEADER.pack(
+                b"PK\x01\x02",
+                version,
+                version,
+                FLAG_DATA_DESCRIPTOR,
+                0,
+                entry.dos_time,
+                entry.dos_date,
+                entry.crc,
+                size,
+                size,
+                len(entry.arcname),
+                len(extra),
+                0,
+                0,
+                0,
+                0,
+                offset,
+            )
+            + entry.arcname
+            + extra
+        )
+
+    def _end(self) -> bytes:
+        count = len(self.entries)
+        if not self.zip64:
+            return END_RECORD.pack(
+                b"PK\x05\x06",
+                0,
+                0,
+                count,
+                count,
+                self.central_size,
+                self.central_offset,
+                0,
+            )
+        end64_offset = self.central_offset + self.central_size
+        return (
+            END_RECORD64.pack(
+                b"PK\x06\x06",
+                END_RECORD64.size - 12,
+                VERSION_ZIP64,
+                VERSION_ZIP64,
+                0,
+                0,
+                count,
+                count,
+                self.central_size,
+                self.central_offset,
+            )
+            + END_LOCATOR64.pack(b"PK\x06\x07", 0, end64_offset, 1)
+            + END_RECORD.pack(
+                b"PK\x05\x06",
+                0,
+                0,
+                min(count, 0xFFFF),
+                min(count, 0xFFFF),
+                0xFFFFFFFF,
+                0xFFFFFFFF,
+                0,
+            )
+        )
+
+    def _read(self, entry: _Entry, start: int = 0, stop: int = None):
+        """
+        Yields the contents of `entry` computing its crc on the way.
+        Bytes outside [start, stop) are read but not yielded.
+        """
+        stop = entry.size if stop is None else stop
+        crc = 0
+        position = 0
+        with open(entry.filename, "rb") as fp:
+            while position < entry.size:
+                chunk = fp.read(min(self.chunk_size, entry.size - position))
+                if not chunk:
+                    raise IOError(f"{entry.filename} changed while zipping")
+                crc = zlib.crc32(chunk, crc)
+                lo = max(start - position, 0)
+                hi = min(stop - position, len(chunk))
+                if lo < hi:
+                    yield chunk[lo:hi]
+                position += len(chunk)
+        entry.crc = crc
+        _cache_crc(entry.cache_key, crc)
+
+    def _ensure_crc(self, entry: _Entry) -> None:
+        if entry.crc is None:
+            entry.crc = _cached_crc(entry.cache_key)
+        if entry.crc is None:
+            for _ in self._read(entry, 0, 0):
+                pass
+
+    def _segments(self):
+        """
+        Yields (size, producer) for every contiguous part of the archive,
+        where producer(start, stop) yields the bytes in that slice.
+        """
+
+        def static(build):
+            def produce(start, stop):
+                yield build()[start:stop]
+
+            return produce
+
+        for entry in self.entries:
+            yield self._local_header_size(entry), static(
+                lambda entry=entry: self._local_header(entry)
+            )
+            yield entry.size, lambda start, stop, entry=entry: self._read(
+                entry, start, stop
+            )
+            yield self._descriptor_size(), static(
+                lambda entry=entry: self._descriptor(entry)
+            )
+        for entry in self.entries:
+            yield self._central_header_size(entry), static(
+                lambda entry=entry: self._central_header(entry)
+            )
+        yield self._end_size(), static(self._end)
+
+    def generate(
+        self, start: int = 0, stop: int = None
+    ) -> typing.Generator[bytes, None, None]:
+        """
+        Yields the bytes of the archive in the range [start, stop)
+
+        Args:
+            start (int): First byte
+            stop (int): Byte after the last one. Default: end of archive
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        offset = 0
+        for size, produce in self._segments():
+            if offset >= stop:
+                break
+            if offset + size > start and size > 0:
+                yield from produce(
+                    max(start - offset, 0), min(stop - offset, size)
+                )
+            offset += size
+
+    def write(self, fp: typing.BinaryIO) -> None:
+        """
+        Writes the whole archive to the file object `fp`
+        """
+        for chunk in self.generate():
+            fp.write(chunk)
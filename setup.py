@@ -47,7 +47,13 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=["picamera", "flask"],
-    extras_require={"test": ["pytest", "coverage", "mypy", "pre-commit"]},
+    extras_require={
+        "test": ["pytest", "coverage", "mypy", "pre-commit"],
+        "asgi": ["uvicorn", "asgiref"],
+        "thumbnails": ["Pillow"],
+        "pipeline": ["Pillow"],
+        "motion": ["numpy", "Pillow"],
+    },
     keywords=["raspberrypi", "camera", "http"],
     classifiers=[
         "Development Status :: 4 - Beta",